@@ -1,9 +1,35 @@
+import os
+import time
+
+_import_started = time.time()
+
 from aggregatorcomparor.core import (
   app,
   db,
-  login,
-  admin,
 )
 import aggregatorcomparor.models
-from aggregatorcomparor import admin_ui, models, views
-import aggregatorcomparor.views
+from aggregatorcomparor import models
+from aggregatorcomparor import changes  # Publishes molecule changes on flush, for loaders as well as admin edits
+from aggregatorcomparor import summaries  # Refreshes citation and report counts after commits that change them
+
+
+def load_web():
+    """ Register the public views and admin pages (data-only manage.py commands skip this)
+
+    Flask-Admin, Flask-Login and WTForms are only imported here: admin_ui sets up the login manager
+    and the admin site when imported.
+    """
+    from aggregatorcomparor import admin_ui, views
+    if app.config.get('TRAFFIC_RECORD_PATH'):
+        from aggregatorcomparor.loadtest import install_traffic_recorder
+        install_traffic_recorder(app, app.config['TRAFFIC_RECORD_PATH'])
+
+
+if os.environ.get('AGGREGATORCOMPAROR_SKIP_WEB') != '1':
+    load_web()
+
+
+startup_seconds = time.time() - _import_started
+if startup_seconds > app.config.get('STARTUP_TIME_BUDGET', 2.0):
+    app.logger.warning("Importing aggregatorcomparor took %.2fs (budget %.2fs); see manage.py profile_startup",
+                       startup_seconds, app.config.get('STARTUP_TIME_BUDGET', 2.0))
@@ -1,16 +1,76 @@
 from __future__ import absolute_import, print_function
 
 import itertools
+import json
+import multiprocessing
+import os
+import subprocess
 import sys
+import time
 
+from rdkit import Chem as C
 from rdkit.RDLogger import logger, CRITICAL
+from sqlalchemy import bindparam, text
 
-from .core import db
-from . import models
+from .core import app, db
+from .progress import LoadProgress
+from . import changes, clustering, migrations, models, readers, summaries
 
 
 def init_db():
     db.create_all()
+    summaries.create_summary_views()
+
+
+def refresh_summaries():
+    """ Create missing citation/aggregator summary views and bring all of them up to date """
+    created = summaries.create_summary_views()
+    for name in created:
+        print("Created {0}".format(name), file=sys.stderr)
+    summaries.refresh_summary_views()
+
+
+def create_indexes():
+    """ Add missing columns and create indexes declared on models that are missing (e.g. new fingerprint types) """
+    for change in migrations.upgrade_schema():
+        print(change.capitalize(), file=sys.stderr)
+    for model in (models.Aggregator, models.Ligand, models.AggregatorReport):
+        table = model.__table__
+        # The inspector skips expression indexes, so ask the catalog directly
+        existing = set(name for name, in db.engine.execute(
+            text('SELECT indexname FROM pg_indexes WHERE tablename = :table'), table=table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                print("Creating {0}".format(index.name), file=sys.stderr)
+                index.create(bind=db.engine)
+        _create_child_indexes(table.name)
+
+
+def _index_body(definition):
+    # "CREATE [UNIQUE] INDEX name ON table USING method (...)" -> ("CREATE [UNIQUE] INDEX", "USING method (...)")
+    return definition.split(' INDEX ', 1)[0] + ' INDEX', definition[definition.index(' USING ') + 1:]
+
+
+def _create_child_indexes(table):
+    """ Copy indexes of `table` missing from its inheritance children (partition_ligands copies only existing ones)
+
+    Children name their copies differently, so indexes are matched by definition.
+    """
+    indexes = lambda relation: db.engine.execute(text(
+        'SELECT indexname, indexdef FROM pg_indexes WHERE tablename = :relation ORDER BY indexname'),
+        relation=relation).fetchall()
+    parent = [(name,) + _index_body(definition) for name, definition in indexes(table)]
+    children = [child for child, in db.engine.execute(text(
+        'SELECT CAST(CAST(inhrelid AS regclass) AS text) FROM pg_inherits '
+        'WHERE inhparent = CAST(:table AS regclass)'), table=table)]
+    for child in children:
+        present = set(_index_body(definition)[1] for _name, definition in indexes(child))
+        for name, create, body in parent:
+            if body in present:
+                continue
+            child_index = child + name[len(table):] if name.startswith(table) else '{0}_{1}'.format(child, name)
+            print("Creating {0}".format(child_index), file=sys.stderr)
+            db.engine.execute('{0} {1} ON {2} {3}'.format(create, child_index, child, body))
 
 
 def wipe_all_data(yes_really=False):
@@ -20,90 +80,500 @@ def wipe_all_data(yes_really=False):
     models.Ligand.query.delete()
     if yes_really == 'yes':
         db.session.commit()
+        summaries.refresh_summary_views()  # Bulk deletes bypass the session events
     else:
         db.session.rollback()
         print("Make sure you really mean it!")
 
 
-def init_aggregator_data(sources, aggregators):
-    print("Loading citation sources", file=sys.stderr)
-    with open(sources) as f:
-        try:
-            for line in f:
-                citation = models.ref_line_to_citation(line)
-                db.session.add(citation)
-                print("\rAdding {!r}".format(citation), end='', file=sys.stderr)
-        except Exception as e:
-            print("\nReverting because {0!s}".format(e))
-            db.session.rollback()
-            raise
-        else:
-            db.session.commit()
-            print("\nAll changes saved", file=sys.stderr)
+def init_aggregator_data(sources, aggregators, rejects=None, summary=None, format=None, name_property=None,
+                         citation_property='citation'):
+    with summaries.refresh_once():  # Not once per committed batch
+        print("Loading citation sources", file=sys.stderr)
+        progress = LoadProgress.for_file('citations', sources, rejects=rejects)
+        with readers.open_input(sources) as f:
+            try:
+                for idx, line in enumerate(f, start=1):
+                    try:
+                        citation = models.ref_line_to_citation(line)
+                    except (ValueError, IndexError) as e:
+                        progress.reject(idx, "parse error: {0!s}".format(e), line, nbytes=len(line))
+                        continue
+                    db.session.add(citation)
+                    progress.add(nbytes=len(line))
+            except Exception as e:
+                print("\nReverting because {0!s}".format(e), file=sys.stderr)
+                db.session.rollback()
+                raise
+            else:
+                db.session.commit()
+                progress.finish(summary)
+                print("All changes saved", file=sys.stderr)
 
-    print("Loading aggregators and reports", file=sys.stderr)
-    with open(aggregators) as f:
-        try:
-            idx = 0
-            for idx, line in enumerate(f):
-                try:
-                    compound, extra = models.smiles_line_to_molecule_extra(models.Aggregator, line)
-                except ValueError as e:
-                    print("\nIgnoring aggregator #{0:d} because {1!s}".format(idx, e))
-                    continue
-
-                if len(extra) > 0:
-                    citation_fk = int(extra[0])
-                    report = models.AggregatorReport(citation_fk=citation_fk)
-                    compound.reports.append(report)
-                db.session.add(compound)
-                print("\rAdding {!r}".format(compound), end='', file=sys.stderr)
-        except Exception as e:
-            print("\nReverting because {0!s}".format(e))
-            db.session.rollback()
-            raise
-        else:
-            db.session.commit()
-            print("\nAll changes saved", file=sys.stderr)
+        print("Loading aggregators and reports", file=sys.stderr)
+        progress = LoadProgress.for_file('aggregators', aggregators, rejects=rejects)
+        records = readers.read_molecules(aggregators, format=format, name_property=name_property,
+                                         extra_properties=(citation_property,))
 
+        def parse(record):
+            if record.error is not None:
+                return record, None, record.error
+            try:
+                compound = models.Aggregator(smiles=record.smiles, name=record.name or '')
+                if record.extra and record.extra[0] is not None:
+                    compound.reports.append(models.AggregatorReport(citation_fk=int(record.extra[0])))
+            except (ValueError, IndexError) as e:
+                return record, None, "parse error: {0!s}".format(e)
+            return record, compound, None
 
-def load_ligands(smiles, verbose=False):
+        _load_parsed(itertools.imap(parse, records), progress, summary)
+
+
+def load_ligands(smiles, verbose=False, rejects=None, summary=None, format=None, name_property=None):
+    """ Load ligands from SMILES or SDF input, optionally gzip, bz2 or xz compressed """
     if not verbose:
         logger().setLevel(CRITICAL)
     print("Loading ligands", file=sys.stderr)
-    with open(smiles) as f:
+    progress = LoadProgress.for_file('ligands', smiles, rejects=rejects)
+    records = readers.read_molecules(smiles, format=format, name_property=name_property)
+
+    def parse(record):
+        if record.error is not None:
+            return record, None, record.error
+        if not record.name:
+            return record, None, "missing name"
         try:
-            numbered = enumerate(f, start=1)
-            groups = _grouper(numbered, 10000, None)
-            for group_idx, group in enumerate(groups, start=1):
-                group = (item for item in group if item is not None)
-                for idx, line in group:
-                    try:
-                        compound, extra = models.smiles_line_to_molecule_extra(models.Ligand, line)
-                    except ValueError as e:
-                        print("\nIgnoring compound #{0:d} because {1!s}".format(idx, e))
-                        continue
-                    else:
-                        if compound.mol is None:
-                            print("\nIgnoring compound #{0:d} because structure is invalid ({1!s}".format(idx, e))
-                            continue
-                        else:
-                            db.session.add(compound)
-                            print("\r(Group: {:d}) Adding {!r}".format(group_idx, compound), end='', file=sys.stderr)
-                # For memory efficiency
-                db.session.flush()
+            compound = models.Ligand(smiles=record.smiles, name=record.name)
+        except (ValueError, IndexError) as e:
+            return record, None, "parse error: {0!s}".format(e)
+        if compound.depiction is None:  # Only set when RDKit could read the structure
+            return record, None, "invalid structure"
+        return record, compound, None
+
+    # For memory efficiency every batch is flushed and expunged
+    _load_parsed(itertools.imap(parse, records), progress, summary, expunge=True)
+
+
+def _load_parsed(parsed, progress, summary=None, batch_size=10000, expunge=False):
+    """ Add parsed (record, compound, error) items, parsing on a background thread while the database writes """
+    position = 0
+    try:
+        for batch in readers.prefetch(parsed, batch_size=batch_size):
+            for record, compound, error in batch:
+                nbytes, position = record.position - position, record.position
+                if error is not None:
+                    progress.reject(record.number, error, record.text, nbytes=nbytes)
+                else:
+                    db.session.add(compound)
+                    progress.add(nbytes=nbytes)
+            db.session.flush()
+            if expunge:
                 db.session.expunge_all()
-        except Exception as e:
-            print("\nReverting because {0!s}".format(e), file=sys.stderr)
-            db.session.rollback()
-            raise
-        else:
+    except Exception as e:
+        print("\nReverting because {0!s}".format(e), file=sys.stderr)
+        db.session.rollback()
+        raise
+    else:
+        db.session.commit()
+        progress.finish(summary)
+        print("All changes saved", file=sys.stderr)
+
+
+def partition_ligands(partitions):
+    """ Split csdcompound into `partitions` inheritance children by id modulo, each with its own indexes
+
+    Inserts through the parent are routed by a trigger and similarity searches fan out across the
+    children concurrently. Running again with a different count redistributes the rows; 0 or 1
+    collapses everything back into the parent table.
+    """
+    table = models.Ligand.__tablename__
+    partitions = int(partitions)
+    connection = db.session.connection()
+
+    def execute(sql, **params):
+        return connection.execute(text(sql.replace('{table}', table)), **params)
+
+    execute('DROP TRIGGER IF EXISTS {table}_partition_insert ON {table}')
+    children = [name for name, in execute('SELECT CAST(CAST(inhrelid AS regclass) AS text) FROM pg_inherits '
+                                          'WHERE inhparent = CAST(:table AS regclass)', table=table)]
+    for child in children:
+        print("Merging {0} back into {1}".format(child, table), file=sys.stderr)
+        execute('INSERT INTO {table} SELECT * FROM ' + child)
+        execute('DROP TABLE ' + child)
+
+    if partitions > 1:
+        for partition in range(partitions):
+            child = '{0}_p{1:d}'.format(table, partition)
+            check = 'id % {0:d} = {1:d}'.format(partitions, partition)
+            print("Creating {0}".format(child), file=sys.stderr)
+            # LIKE ... INCLUDING ALL copies the id sequence default and every (functional) index
+            execute('CREATE TABLE {0} (LIKE {{table}} INCLUDING ALL, '
+                    'CONSTRAINT {0}_partition_check CHECK ({1}))'.format(child, check))
+            execute('ALTER TABLE ' + child + ' INHERIT {table}')
+            execute('INSERT INTO ' + child + ' SELECT * FROM ONLY {table} WHERE ' + check)
+        execute('TRUNCATE ONLY {table}')
+        execute("CREATE OR REPLACE FUNCTION {table}_partition_insert() RETURNS trigger AS $$ "
+                "BEGIN "
+                "EXECUTE format('INSERT INTO %I SELECT ($1).*', '{table}_p' || (NEW.id % " + str(partitions) + ")) "
+                "USING NEW; "
+                "RETURN NULL; "
+                "END $$ LANGUAGE plpgsql")
+        execute('CREATE TRIGGER {table}_partition_insert BEFORE INSERT ON {table} '
+                'FOR EACH ROW EXECUTE PROCEDURE {table}_partition_insert()')
+    db.session.commit()
+    print("{0} now has {1:d} partitions (restart workers to pick this up)".format(table, max(partitions, 0)),
+          file=sys.stderr)
+
+
+def compute_depictions(overwrite=False, batch_size=1000):
+    """ Backfill stored 2D depictions for molecules loaded before they were computed at load time """
+    logger().setLevel(CRITICAL)
+    migrations.add_missing_columns(names=('depiction',))
+    for model in (models.Aggregator, models.Ligand):
+        query = model.query.filter(model.structure != None)
+        if not overwrite:
+            query = query.filter(model.depiction == None)
+        print("Computing depictions for {0}".format(model.__tablename__), file=sys.stderr)
+        last_id, done = 0, 0
+        while True:
+            batch = query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not batch:
+                break
+            for molecule in batch:
+                molecule.depiction = models.compute_depiction(molecule.structure)
+            last_id = batch[-1].id
+            done += len(batch)
             db.session.commit()
-            print("\nAll changes saved", file=sys.stderr)
+            db.session.expunge_all()
+            print("\r{0:d} depictions saved".format(done), end='', file=sys.stderr)
+        print("", file=sys.stderr)
+
+
+def compute_conformers(ligands=False, overwrite=False, processes=None, batch_size=200):
+    """ Embed and minimize 3D conformers for aggregators (and ligands) in parallel, stored by InChIKey """
+    from . import conformers
+
+    logger().setLevel(CRITICAL)
+    models.Conformer.__table__.create(bind=db.engine, checkfirst=True)
+    for model in (models.Aggregator, models.Ligand) if ligands else (models.Aggregator,):
+        jobs = conformers.missing_conformers(model, overwrite=overwrite)
+        db.session.remove()  # Connections must not be shared with the forked workers
+        print("Embedding {0:d} {1} conformers".format(len(jobs), model.__tablename__), file=sys.stderr)
+        done, failed, batch = 0, 0, []
+        for result in conformers.embed_conformers(jobs, processes=processes):
+            batch.append(result)
+            failed += result[1] is None
+            if len(batch) >= batch_size:
+                conformers.store_conformers(batch, replace=overwrite)
+                done += len(batch)
+                batch = []
+                print("\r{0:d}/{1:d} conformers saved".format(done, len(jobs)), end='', file=sys.stderr)
+        conformers.store_conformers(batch, replace=overwrite)
+        print("\r{0:d}/{1:d} conformers saved ({2:d} could not be embedded)".format(
+            done + len(batch), len(jobs), failed), file=sys.stderr)
+
+
+def _scaffold_job(row):
+    molecule_id, smiles = row
+    values = models.scaffold_columns(C.MolFromSmiles(smiles) if smiles else None)
+    values['molecule_id'] = molecule_id
+    return values
+
+
+def compute_scaffolds(overwrite=False, processes=None, batch_size=5000):
+    """ Backfill Murcko and generic scaffold columns (and their hash indexes) across a process pool """
+    logger().setLevel(CRITICAL)
+    create_indexes()  # Adds the scaffold columns as well
+    for model in (models.Aggregator, models.Ligand):
+        table = model.__table__
+        query = db.session.query(model.id, models.func.mol_to_smiles(model.structure))\
+                          .filter(model.structure != None)
+        if not overwrite:
+            query = query.filter(model.scaffold == None)
+        rows = query.order_by(model.id).all()
+        db.session.remove()  # Connections must not be shared with the forked workers
+        update = table.update().where(table.c.id == bindparam('molecule_id'))  # SET from the parameter keys
+        print("Computing scaffolds for {0:d} {1} rows".format(len(rows), model.__tablename__), file=sys.stderr)
+        pool = multiprocessing.Pool(processes)
+        try:
+            done, batch = 0, []
+            for values in pool.imap_unordered(_scaffold_job, rows, chunksize=256):
+                batch.append(values)
+                if len(batch) >= batch_size:
+                    db.engine.execute(update, batch)
+                    done, batch = done + len(batch), []
+                    print("\r{0:d} scaffolds saved".format(done), end='', file=sys.stderr)
+            if batch:
+                db.engine.execute(update, batch)
+            print("\r{0:d} scaffolds saved".format(done + len(batch)), file=sys.stderr)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def cluster_aggregators(method='butina', cutoff=0.7, fp_type='rdkit', block_size=500, processes=None):
+    """ Cluster aggregator fingerprints and replace the stored clusters and centroids """
+    if method not in ('butina', 'leader'):
+        raise ValueError("Unknown clustering method {0!r} (expected butina or leader)".format(method))
+    for model in (models.AggregatorCluster, models.AggregatorClusterMember):
+        model.__table__.create(bind=db.engine, checkfirst=True)
+
+    print("Fetching {0} fingerprints".format(fp_type), file=sys.stderr)
+    ids, fingerprints = clustering.fetch_fingerprints(models.Aggregator, fp_type)
+    print("Clustering {0:d} aggregators ({1}, cutoff {2})".format(len(ids), method, cutoff), file=sys.stderr)
+    if method == 'butina':
+        neighbours = clustering.sparse_neighbours(fingerprints, cutoff, block_size=block_size, processes=processes)
+        clusters = clustering.butina_clusters(neighbours)
+    else:
+        clusters = clustering.leader_clusters(fingerprints, cutoff)
+
+    try:
+        models.AggregatorClusterMember.query.delete()
+        models.AggregatorCluster.query.delete()
+        for centroid, members in clusters:
+            cluster = models.AggregatorCluster(centroid_fk=ids[centroid], method=method, fp_type=fp_type,
+                                               cutoff=cutoff, size=len(members))
+            db.session.add(cluster)
+            db.session.add_all(models.AggregatorClusterMember(aggregator_fk=ids[member],
+                                                              cluster=cluster,
+                                                              centroid_similarity=similarity)
+                               for member, similarity in members)
+        changes.publish_table_change(db.session.connection(), models.AggregatorCluster.__tablename__)
+    except Exception as e:
+        print("Reverting because {0!s}".format(e), file=sys.stderr)
+        db.session.rollback()
+        raise
+    else:
+        db.session.commit()
+        singletons = sum(1 for _centroid, members in clusters if len(members) == 1)
+        print("Saved {0:d} clusters ({1:d} singletons)".format(len(clusters), singletons), file=sys.stderr)
+
+
+def build_snapshot(path, ligands=False, fp_type=None):
+    """ Export a read-only SQLite snapshot (plus packed fingerprints) for serving without PostgreSQL """
+    from .snapshot import build_snapshot as build, fingerprint_path
+
+    fp_type = fp_type or app.config.get('MOLECULE_SEARCH_FINGERPRINT', 'rdkit')
+    logger().setLevel(CRITICAL)
+    build(path, ligands=ligands, fp_type=fp_type)
+    print("Wrote {0} and {1}".format(path, fingerprint_path(path)), file=sys.stderr)
+
+
+def train_scorer(path, background=50000, fp_type=None, recall=0.99, specificity=0.99, processes=None):
+    """ Fit the naive Bayes aggregation scorer on aggregators against a random ligand background """
+    from . import scorer
+
+    fp_type = fp_type or app.config.get('MOLECULE_SEARCH_FINGERPRINT', 'rdkit')
+    if fp_type not in scorer.SNAPSHOT_FINGERPRINTS:
+        raise ValueError("Unknown fingerprint type {0!r} (expected one of: {1})".format(
+            fp_type, ', '.join(sorted(scorer.SNAPSHOT_FINGERPRINTS))))
+    logger().setLevel(CRITICAL)
+    aggregators, ligands = scorer.training_smiles(background=background)
+    db.session.remove()  # Connections must not be shared with the forked workers
+    print("Fingerprinting {0:d} aggregators and {1:d} background ligands".format(len(aggregators), len(ligands)),
+          file=sys.stderr)
+    positives = scorer.fingerprint_matrix(aggregators, fp_type, processes=processes)
+    negatives = scorer.fingerprint_matrix(ligands, fp_type, processes=processes)
+    if not len(positives) or not len(negatives):
+        raise ValueError("Training needs both aggregators and ligands")
+    model = scorer.fit_scorer(positives, negatives, fp_type, recall=recall, specificity=specificity)
+    model.save(path)
+    triaged = lambda matrix: [model.triage(score) for score in model.score_matrix(matrix)]
+    borderline = sum(1 for triage in triaged(negatives) if triage == scorer.TRIAGE_BORDERLINE)
+    print("Wrote {0} (thresholds {1:.2f} and {2:.2f}; {3:.1%} of the background is borderline)".format(
+        path, model.low, model.high, float(borderline) / len(negatives)), file=sys.stderr)
+
+
+def screen(path, output=None, format=None, batch_size=1000):
+    """ Triage a SMILES or SDF file with the scorer, running full aggregator reports only where it cannot decide
+
+    Borderline scores and reported aggregators (by InChIKey) get the same report as the web page,
+    reusing the score; the rest get the scorer's own predicted status.
+    """
+    from .helpers import SCORER_STATUSES, aggregator_report, is_reported_aggregator
+    from .scorer import TRIAGE_BORDERLINE, get_scorer
+
+    model = get_scorer()
+    if model is None:
+        raise ValueError("Set AGGREGATION_SCORER_PATH to a model written by manage.py train_scorer")
+    logger().setLevel(CRITICAL)
+    out = open(output, 'w') if output else sys.stdout
+    counts = dict.fromkeys(('negative', 'borderline', 'positive', 'known', 'invalid'), 0)
+
+    def screen_batch(batch):
+        for record, mol, score, triage in batch:
+            known = triage != TRIAGE_BORDERLINE and is_reported_aggregator(C.MolToInchiKey(mol))
+            if triage == TRIAGE_BORDERLINE or known:
+                status = aggregator_report(record.smiles, scored=(model.probability(score), triage),
+                                           known=known)['status']
+                counts['known' if known else triage] += 1
+            else:
+                status = SCORER_STATUSES[triage]
+                counts[triage] += 1
+            print('\t'.join([str(record.number), record.name or '', record.smiles,
+                              '{0:.4f}'.format(model.probability(score)), triage, status]), file=out)
+        db.session.remove()
+
+    try:
+        print('\t'.join(('number', 'name', 'smiles', 'aggregation_score', 'triage', 'status')), file=out)
+        batch = []
+        for record in readers.read_molecules(path, format=format):
+            mol = C.MolFromSmiles(record.smiles) if record.error is None else None
+            if mol is None:
+                counts['invalid'] += 1
+                continue
+            score = model.score(mol)
+            batch.append((record, mol, score, model.triage(score)))
+            if len(batch) >= batch_size:
+                screen_batch(batch)
+                batch = []
+        screen_batch(batch)
+    finally:
+        if output:
+            out.close()
+    print("Screened {0:d} molecules: {1:d} ruled out, {2:d} flagged, {3:d} searched, {4:d} known, {5:d} invalid"
+          .format(sum(counts.values()), counts['negative'], counts['positive'], counts['borderline'],
+                  counts['known'], counts['invalid']), file=sys.stderr)
+
 
+def prerender(output, processes=None, force=False):
+    """ Render aggregator, citation and image pages that changed since the last run to static files """
+    from .prerender import prerender as render
+
+    rendered, removed, failures = render(output, processes=processes, force=force)
+    for path, status in sorted(failures.items()):
+        print("Failed {0} ({1})".format(path, status), file=sys.stderr)
+    print("Rendered {0:d} pages, removed {1:d}, {2:d} failed".format(rendered, removed, len(failures)),
+          file=sys.stderr)
+
+
+def resolve_identifiers(path='-', output=None, as_json=False):
+    """ Resolve one identifier per line (InChIKey, CSD refcode or aggregator name) to molecules, as TSV or JSON """
+    from .resolver import resolve_identifiers as resolve
+
+    stream = sys.stdin if path == '-' else readers.open_input(path)
+    try:
+        results = resolve(line.strip() for line in stream)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    out = open(output, 'w') if output else sys.stdout
+    try:
+        if as_json:
+            json.dump(results, out, indent=2)
+            out.write('\n')
+        else:
+            columns = ('type', 'id', 'name', 'smiles', 'status', 'aggregator_id')
+            print('\t'.join(('query', 'kind') + columns), file=out)
+            for result in results:
+                for match in result['matches'] or [dict.fromkeys(columns, '')]:
+                    print('\t'.join([result['query'], result['kind']] +
+                                    ['' if match[column] is None else unicode(match[column]) for column in columns]),
+                          file=out)
+    finally:
+        if output:
+            out.close()
+    unresolved = sum(1 for result in results if not result['matches'])
+    print("Resolved {0:d} of {1:d} identifiers".format(len(results) - unresolved, len(results)), file=sys.stderr)
+
+
+def warmup(traffic=None, url=None, skip_relations=False, ready_file=None):
+    """ Prewarm indexes and tables and replay the most frequent recent requests (at `url` if given) """
+    from .warmup import warmup as run
+
+    started = time.time()
+    report = run(traffic=traffic, url=url, relations=not skip_relations, caches=False)
+    for name, (result, seconds) in report.items():
+        if isinstance(result, list):
+            detail = "{0:d} items".format(len(result))
+        elif isinstance(result, dict):
+            detail = ', '.join("{0}: {1:d}".format(status, count) for status, count in sorted(result.items()))
+        else:
+            detail = str(result)
+        print("{0:10s} {1:8.2f}s  {2}".format(name, seconds, detail), file=sys.stderr)
+    print("Ready after {0:.2f}s".format(time.time() - started), file=sys.stderr)
+    if ready_file:
+        with open(ready_file, 'w') as f:
+            json.dump({'ready': time.time(), 'steps': list(report)}, f)
+
+
+def check_query_plans(analyze=True, as_json=False):
+    """ Verify the hot query shapes can use their indexes; exits non-zero when any cannot """
+    from .queryplans import check_query_plans as check
+
+    reports = check(analyze=analyze)
+    if as_json:
+        print(json.dumps([report.as_dict() for report in reports], indent=2, default=str))
+    else:
+        for report in reports:
+            print("{0:36s} {1:4s} {2}".format(report.name, 'ok' if report.ok else 'FAIL',
+                                              ', '.join(report.indexes) or report.problem))
+            if not report.ok:
+                print('\n'.join('    ' + line for line in report.plan_text.splitlines()))
+    failing = [report for report in reports if not report.ok]
+    if failing:
+        print("{0:d} of {1:d} query shapes cannot use their indexes".format(len(failing), len(reports)),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+STARTUP_PROFILE = (
+    ('rdkit.Chem', {}),
+    ('rdkit.Chem.Draw', {}),
+    ('rdalchemy', {}),
+    ('flask.ext.admin', {}),
+    ('aggregatorcomparor', {'AGGREGATORCOMPAROR_SKIP_WEB': '1'}),
+    ('aggregatorcomparor', {}),
+)
+
+
+def profile_startup(budget=None):
+    """ Time importing the heavy modules, each in a fresh interpreter, against the startup budget """
+    budget = budget or app.config.get('STARTUP_TIME_BUDGET', 2.0)
+    for module, environment in STARTUP_PROFILE:
+        env = dict(os.environ, **environment)
+        code = "import time; started = time.time(); import {0}; print(time.time() - started)".format(module)
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        seconds = float(output.strip().splitlines()[-1])
+        label = module + (' (data commands)' if environment else '')
+        flag = '  OVER BUDGET' if module == 'aggregatorcomparor' and seconds > budget else ''
+        print("{0:8.3f}s  {1}{2}".format(seconds, label, flag))
+
+
+def loadtest(requests=1000, concurrency=8, url=None, traffic=None, save=None, local_postgres=False,
+             ligands=None, seed=None, report=None, admission_control=True):
+    """ Replay recorded or synthesized traffic and report throughput, latency and errors per route """
+    from . import loadtest as harness
+
+    server = harness.LocalPostgres() if local_postgres else None
+    try:
+        if server is not None:
+            print("Starting a local PostgreSQL in {0}".format(server.start().directory), file=sys.stderr)
+            app.config['SQLALCHEMY_DATABASE_URI'] = server.uri
+            data = os.path.join(os.path.dirname(app.root_path), 'data')
+            init_db()
+            init_aggregator_data(os.path.join(data, 'aggref.txt'), os.path.join(data, 'aggpage.txt'))
+            if ligands:
+                load_ligands(ligands)
+
+        if traffic:
+            paths = harness.read_traffic(traffic)[:requests]
+        else:
+            paths = harness.synthesize_traffic(requests, seed=seed)
+            db.session.remove()
+        if save:
+            harness.write_traffic(paths, save)
 
-def _grouper(iterable, n, fillvalue=None):
-    "Collect data into fixed-length chunks or blocks"
-    # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx
-    args = [iter(iterable)] * n
-    return itertools.izip_longest(fillvalue=fillvalue, *args)
\ No newline at end of file
+        print("Replaying {0:d} requests with {1:d} clients against {2}".format(
+            len(paths), concurrency, url or 'the application in process'), file=sys.stderr)
+        results = harness.replay_traffic(paths, concurrency=concurrency, base_url=url,
+                                         admission_control=admission_control)
+        print(harness.format_report(results))
+        if report:
+            with open(report, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if server is not None:
+            db.session.remove()
+            db.get_engine(app).dispose()
+            server.stop()
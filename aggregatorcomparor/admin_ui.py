@@ -1,12 +1,13 @@
 from urllib import quote
-from flask import url_for
-from flask.ext.admin import form
+from flask import request, url_for
+from flask.ext.admin import Admin, BaseView, expose, form
 from flask.ext.admin.contrib.sqla import ModelView
 from flask.ext import login
 from jinja2 import Markup
 from wtforms import fields
 from aggregatorcomparor import (
-    admin,
+    admin_auth,
+    app,
     db,
 )
 from aggregatorcomparor.models import (
@@ -16,6 +17,12 @@ from aggregatorcomparor.models import (
     AggregatorReport,
 )
 from aggregatorcomparor.helpers import image_url_for
+from aggregatorcomparor.queryplans import check_query_plans
+
+
+login_manager = login.LoginManager(app)
+login_manager.user_loader(admin_auth.get_administrator)
+admin = Admin(app, index_view=admin_auth.AuthenticatedAdminIndexView())
 
 
 # Require administrator access to admin forms (trivial but important)
@@ -80,7 +87,19 @@ class CitationView(AuthenticatedModelView):
     }
 
 
+class QueryPlanView(BaseView):
+    """ EXPLAIN output for the hot query shapes, and whether each can use its index """
+    def is_accessible(self):
+        return login.current_user.is_authenticated()
+
+    @expose('/')
+    def index(self):
+        analyze = request.args.get('analyze', '1') != '0'
+        return self.render('admin/query_plans.html', reports=check_query_plans(analyze=analyze), analyze=analyze)
+
+
 admin.add_view(CitationView(Citation, db.session))
 admin.add_view(AggregatorView(Aggregator, db.session))
 admin.add_view(AuthenticatedModelView(AggregatorReport, db.session))
 admin.add_view(LigandView(Ligand, db.session))
+admin.add_view(QueryPlanView(name='Query Plans', endpoint='query_plans'))
@@ -0,0 +1,168 @@
+from __future__ import absolute_import, division
+
+import functools
+import math
+import threading
+import time
+
+from flask import (
+    current_app,
+    make_response,
+    request,
+    Response,
+)
+
+
+# WSGI environ key set by in-process replays (warm-up, load tests); clients cannot set environ keys
+EXEMPT_ENVIRON_KEY = 'aggregatorcomparor.admission_exempt'
+
+
+class TokenBucket(object):
+    """ Classic token bucket: `rate` tokens per second up to `burst` tokens """
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def consume(self, tokens=1):
+        """ Take `tokens` from the bucket, returning seconds to wait if there are not enough """
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0
+        elif self.rate <= 0:
+            return float('inf')
+        else:
+            return (tokens - self.tokens) / self.rate
+
+    @property
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class ClientRateLimiter(object):
+    """ Per-client token buckets, pruning idle (full) buckets once `max_clients` is reached """
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        idle = [client for client, bucket in self._buckets.items() if bucket.is_full]
+        for client in idle:
+            del self._buckets[client]
+
+    def consume(self, client, tokens=1):
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                if len(self._buckets) >= self.max_clients:
+                    self._prune()
+                bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+            return bucket.consume(tokens)
+
+
+class ConcurrencyLimiter(object):
+    """ Counting semaphore that queues callers for up to `timeout` seconds """
+    def __init__(self, max_concurrent):
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self.active >= self.max_concurrent:
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+# Limiters are per worker process and built lazily from the application config
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiters(config=None):
+    config = config or current_app.config
+    with _limiters_lock:
+        if not _limiters:
+            _limiters['rate'] = ClientRateLimiter(config.get('SEARCH_RATE_LIMIT', 2.0),
+                                                  config.get('SEARCH_RATE_BURST', 10),
+                                                  max_clients=config.get('SEARCH_RATE_MAX_CLIENTS', 10000))
+            _limiters['concurrency'] = ConcurrencyLimiter(config.get('SEARCH_MAX_CONCURRENT', 4))
+        return _limiters['rate'], _limiters['concurrency']
+
+
+def get_client_id(this_request=None, config=None):
+    this_request = this_request or request
+    config = config or current_app.config
+    if config.get('SEARCH_RATE_TRUST_FORWARDED_FOR', False):
+        forwarded = this_request.headers.get('X-Forwarded-For', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return this_request.remote_addr or 'unknown'
+
+
+def too_many_requests(retry_after):
+    retry_after = int(math.ceil(max(retry_after, 1)))
+    response = make_response("Too many expensive requests. Please retry in {0:d} seconds.\n".format(retry_after), 429)
+    response.headers['Retry-After'] = str(retry_after)
+    response.mimetype = 'text/plain'
+    return response
+
+
+def heavy_query(view):
+    """ Admission control for views that run unbounded similarity searches
+
+    Each client draws from a token bucket (SEARCH_RATE_LIMIT/SEARCH_RATE_BURST) and each worker
+    runs at most SEARCH_MAX_CONCURRENT of these views at once, queueing for SEARCH_QUEUE_TIMEOUT
+    seconds before giving up with a 429 Retry-After.
+    """
+    @functools.wraps(view)
+    def admitted_view(*args, **kwargs):
+        config = current_app.config
+        if not config.get('SEARCH_ADMISSION_CONTROL', True) or request.environ.get(EXEMPT_ENVIRON_KEY):
+            return view(*args, **kwargs)
+
+        rate, concurrency = get_limiters(config)
+        wait = rate.consume(get_client_id(config=config))
+        if wait > 0:
+            return too_many_requests(wait)
+
+        queue_timeout = config.get('SEARCH_QUEUE_TIMEOUT', 5.0)
+        if not concurrency.acquire(timeout=queue_timeout):
+            return too_many_requests(config.get('SEARCH_RETRY_AFTER', queue_timeout))
+        try:
+            response = view(*args, **kwargs)
+        except Exception:
+            concurrency.release()
+            raise
+        if isinstance(response, Response) and response.is_streamed:
+            response.call_on_close(concurrency.release)  # The search keeps running while the body is sent
+        else:
+            concurrency.release()
+        return response
+    return admitted_view
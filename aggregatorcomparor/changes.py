@@ -0,0 +1,187 @@
+from __future__ import absolute_import
+
+import json
+import logging
+import select
+import threading
+import time
+
+from sqlalchemy import event, func, select as sql_select
+
+from .core import db
+from .models import MoleculeMixin
+
+
+CHANNEL = 'molecule_changes'
+PAYLOAD_CHUNK = 500  # ids per notification, keeping payloads well under PostgreSQL's 8000 byte limit
+
+log = logging.getLogger(__name__)
+
+
+def _changed_molecules(session):
+    for state, objects in (('upserted', session.new), ('upserted', session.dirty), ('deleted', session.deleted)):
+        for obj in objects:
+            if isinstance(obj, MoleculeMixin) and obj.id is not None:
+                yield obj.__tablename__, state, obj.id
+
+
+def change_payloads(changes):
+    """ Split {table: {'upserted': ids, 'deleted': ids}} into JSON notification payloads """
+    for table, states in sorted(changes.items()):
+        for state in ('upserted', 'deleted'):
+            ids = sorted(states.get(state, ()))
+            for start in range(0, len(ids), PAYLOAD_CHUNK):
+                yield json.dumps({'table': table, state: ids[start:start + PAYLOAD_CHUNK]})
+
+
+def publish_flushed_changes(session, flush_context):
+    """ NOTIFY listeners of molecules written by this flush; delivered only if the transaction commits """
+    changes = {}
+    for table, state, molecule_id in _changed_molecules(session):
+        changes.setdefault(table, {}).setdefault(state, set()).add(molecule_id)
+    if not changes:
+        return
+    connection = session.connection()
+    for payload in change_payloads(changes):
+        connection.execute(sql_select([func.pg_notify(CHANNEL, payload)]))
+
+
+event.listen(db.session, 'after_flush', publish_flushed_changes)
+
+
+def publish_table_change(connection, table):
+    """ NOTIFY listeners that `table` was rewritten as a whole (e.g. clusters rebuilt) once this transaction commits """
+    connection.execute(sql_select([func.pg_notify(CHANNEL, json.dumps({'table': table}))]))
+
+
+class DeltaLog(object):
+    """ Append-only segments of changed ids plus tombstones, so caches and indexes can patch themselves
+
+    `generation` increases with every applied change; a consumer remembers the generation it last
+    synced at and asks for `since(generation)` instead of rebuilding. Only `max_segments` segments
+    are kept, so a consumer that falls behind `floor` gets None and has to rebuild.
+    """
+    def __init__(self, segment_size=1024, max_segments=256):
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.segments = [[]]
+        self.tombstones = {}
+        self.generation = 0
+        self.floor = 0
+        self._lock = threading.Lock()
+
+    def apply(self, change):
+        table = change['table']
+        with self._lock:
+            for molecule_id in change.get('upserted', ()):
+                self.generation += 1
+                self.tombstones.get(table, {}).pop(molecule_id, None)
+                if len(self.segments[-1]) >= self.segment_size:
+                    self.segments.append([])
+                    if len(self.segments) > self.max_segments:
+                        self._compact(self.segments[0][-1][0])
+                self.segments[-1].append((self.generation, table, molecule_id))
+            for molecule_id in change.get('deleted', ()):
+                self.generation += 1
+                self.tombstones.setdefault(table, {})[molecule_id] = self.generation
+            return self.generation
+
+    def since(self, generation, table=None):
+        """ Ids upserted and deleted after `generation` (optionally for one table) """
+        with self._lock:
+            if generation < self.floor:
+                return None
+            upserted = set()
+            for segment in self.segments:
+                if segment and segment[-1][0] <= generation:
+                    continue  # Whole segment already seen
+                upserted.update(molecule_id for change_generation, change_table, molecule_id in segment
+                                if change_generation > generation and table in (None, change_table))
+            deleted = set()
+            for tombstone_table, tombstones in self.tombstones.items():
+                if table in (None, tombstone_table):
+                    deleted.update(molecule_id for molecule_id, change_generation in tombstones.items()
+                                   if change_generation > generation)
+            return upserted - deleted, deleted
+
+    def compact(self, generation):
+        """ Drop segments and tombstones every consumer has already applied """
+        with self._lock:
+            self._compact(generation)
+
+    def _compact(self, generation):
+        self.floor = max(self.floor, generation)
+        self.segments = [segment for segment in self.segments
+                         if not segment or segment[-1][0] > generation] or [[]]
+        for tombstones in self.tombstones.values():
+            for molecule_id in [molecule_id for molecule_id, change_generation in tombstones.items()
+                                if change_generation <= generation]:
+                del tombstones[molecule_id]
+
+
+delta_log = DeltaLog()
+_handlers = [delta_log.apply]
+
+
+def register_change_handler(handler):
+    """ Call `handler(change)` for every change notification this worker receives """
+    _handlers.append(handler)
+    return handler
+
+
+def dispatch_change(change):
+    for handler in _handlers:
+        try:
+            handler(change)
+        except Exception:
+            log.exception("Change handler %r failed", handler)
+
+
+class ChangeListener(threading.Thread):
+    """ Background LISTEN on a dedicated connection, reconnecting with backoff """
+    daemon = True
+
+    def __init__(self, engine, poll_interval=5.0):
+        super(ChangeListener, self).__init__(name='molecule-change-listener')
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.running = True
+
+    def run(self):
+        backoff = 1
+        while self.running:
+            try:
+                self._listen()
+                backoff = 1
+            except Exception:
+                log.exception("Molecule change listener lost its connection, retrying in %ds", backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def _listen(self):
+        connection = self.engine.raw_connection()
+        connection.detach()  # Never hand an autocommit connection back to the pool
+        try:
+            connection.connection.set_isolation_level(0)  # Autocommit, required for LISTEN
+            connection.cursor().execute('LISTEN {0}'.format(CHANNEL))
+            raw = connection.connection
+            while self.running:
+                if select.select([raw], [], [], self.poll_interval) == ([], [], []):
+                    continue
+                raw.poll()
+                while raw.notifies:
+                    notification = raw.notifies.pop(0)
+                    dispatch_change(json.loads(notification.payload))
+        finally:
+            connection.close()
+
+
+_listener = []
+
+
+def start_change_listener(app):
+    if not _listener and app.config.get('MOLECULE_CHANGE_LISTENER', True):
+        listener = ChangeListener(db.get_engine(app), app.config.get('MOLECULE_CHANGE_POLL_INTERVAL', 5.0))
+        listener.start()
+        _listener.append(listener)
+    return _listener[0] if _listener else None
@@ -0,0 +1,149 @@
+from __future__ import absolute_import, division
+
+import binascii
+import multiprocessing
+
+from rdkit import DataStructs
+from rdkit.SimDivFilters import rdSimDivPickers
+
+from .changes import delta_log
+from .core import db
+from .models import func
+
+
+def fetch_fingerprints(model, fp_type='rdkit', session=None, ids=None):
+    """ (ids, bit vectors) computed by the cartridge, so similarities match the SQL searches exactly """
+    session = session or db.session
+    rows = session.query(model.id, func.bfp_to_binary_text(model.fingerprint(fp_type))).order_by(model.id)
+    if ids is not None:
+        rows = rows.filter(model.id.in_(sorted(ids)))
+    ids, fingerprints = [], []
+    for molecule_id, raw in rows:
+        ids.append(molecule_id)
+        # Tanimoto and Dice only count set and shared bits, so any consistent bit layout gives the same scores
+        fingerprints.append(DataStructs.CreateFromFPSText(binascii.hexlify(bytes(raw))))
+    return ids, fingerprints
+
+
+# {(table, fp_type): (delta log generation, ids, fingerprints)}
+_fingerprint_cache = {}
+
+
+def patch_fingerprints(model, fp_type, ids, fingerprints, upserted, deleted):
+    """ (ids, fingerprints) with `deleted` ids dropped and `upserted` ids refetched, still in id order """
+    changed = set(upserted) | set(deleted)
+    kept = [(molecule_id, fingerprint) for molecule_id, fingerprint in zip(ids, fingerprints)
+            if molecule_id not in changed]
+    if upserted:
+        kept.extend(zip(*fetch_fingerprints(model, fp_type, ids=upserted)))
+        kept.sort(key=lambda pair: pair[0])
+    return [molecule_id for molecule_id, _fingerprint in kept], [fingerprint for _id, fingerprint in kept]
+
+
+def get_cached_fingerprints(model, fp_type='rdkit'):
+    """ Fingerprints fetched once per process and kept current by applying the change log's deltas """
+    key = (model.__tablename__, fp_type)
+    generation = delta_log.generation
+    cached = _fingerprint_cache.get(key)
+    if cached is not None and cached[0] < generation:
+        delta = delta_log.since(cached[0], table=key[0])
+        if delta is None:
+            cached = None  # Fell behind the log's compacted history
+        else:
+            cached = (generation,) + tuple(patch_fingerprints(model, fp_type, cached[1], cached[2], *delta))
+            _fingerprint_cache[key] = cached
+            delta_log.compact(min(entry[0] for entry in _fingerprint_cache.values()))
+    if cached is None:
+        ids, fingerprints = fetch_fingerprints(model, fp_type)
+        cached = _fingerprint_cache[key] = (generation, ids, fingerprints)
+    return cached[1], cached[2]
+
+
+# Set in each worker by the pool initializer so fingerprints are pickled once per process, not per block
+_block_fingerprints = []
+
+
+def _init_block_worker(fingerprints):
+    _block_fingerprints[:] = [fingerprints]
+
+
+def _neighbour_block(args):
+    start, stop, cutoff = args
+    fingerprints = _block_fingerprints[0]
+    block = []
+    for i in range(start, stop):
+        # Upper triangle only; the caller mirrors each pair
+        similarities = DataStructs.BulkTanimotoSimilarity(fingerprints[i], fingerprints[i + 1:])
+        block.append([(i + 1 + offset, similarity) for offset, similarity in enumerate(similarities)
+                      if similarity >= cutoff])
+    return start, block
+
+
+def sparse_neighbours(fingerprints, cutoff, block_size=500, processes=None):
+    """ {neighbour: similarity} for every fingerprint, keeping only pairs at or above `cutoff`
+
+    Rows are compared in blocks, in parallel when `processes` is not 1, so memory grows with the
+    number of similar pairs rather than with the full similarity matrix.
+    """
+    blocks = [(start, min(start + block_size, len(fingerprints)), cutoff)
+              for start in range(0, len(fingerprints), block_size)]
+    if processes == 1:
+        _init_block_worker(fingerprints)
+        results = map(_neighbour_block, blocks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_block_worker, initargs=(fingerprints,))
+        results = pool.imap_unordered(_neighbour_block, blocks)
+    try:
+        neighbours = [{} for _ in fingerprints]
+        for start, block in results:
+            for i, pairs in enumerate(block, start=start):
+                for j, similarity in pairs:
+                    neighbours[i][j] = similarity
+                    neighbours[j][i] = similarity
+        return neighbours
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def butina_clusters(neighbours):
+    """ Taylor-Butina clustering: [(centroid, [(member, similarity to centroid), ...]), ...] """
+    order = sorted(range(len(neighbours)), key=lambda i: (-len(neighbours[i]), i))
+    assigned = [False] * len(neighbours)
+    clusters = []
+    for centroid in order:
+        if assigned[centroid]:
+            continue
+        members = [(centroid, 1.0)] + sorted((j, similarity) for j, similarity in neighbours[centroid].items()
+                                             if not assigned[j])
+        for member, _similarity in members:
+            assigned[member] = True
+        clusters.append((centroid, members))
+    return clusters
+
+
+def leader_clusters(fingerprints, cutoff):
+    """ Single pass leader clustering; needs no neighbour lists, so memory stays linear """
+    leaders = []
+    clusters = []
+    for i, fingerprint in enumerate(fingerprints):
+        if leaders:
+            similarities = DataStructs.BulkTanimotoSimilarity(fingerprint, leaders)
+            best = max(range(len(similarities)), key=similarities.__getitem__)
+            if similarities[best] >= cutoff:
+                clusters[best][1].append((i, similarities[best]))
+                continue
+        leaders.append(fingerprint)
+        clusters.append((i, [(i, 1.0)]))
+    return clusters
+
+
+def maxmin_pick(fingerprints, count, seed=42):
+    """ Indexes of `count` mutually dissimilar fingerprints (MaxMin, distances computed lazily) """
+    count = min(count, len(fingerprints))
+    if count <= 0:
+        return []
+    picker = rdSimDivPickers.MaxMinPicker()
+    return list(picker.LazyBitVectorPick(fingerprints, len(fingerprints), count, seed=seed))
@@ -0,0 +1,151 @@
+""" 3D conformers for PDB and 3D SDF downloads, embedded once and stored by InChIKey
+
+Embedding (ETKDG) and minimization (MMFF94, or UFF where MMFF has no parameters) take from
+milliseconds to seconds per structure, so they run in worker processes: in bulk from
+manage.py compute_conformers, and on demand for molecules the batch has not reached, where a
+request waits at most CONFORMER_ON_DEMAND_TIMEOUT seconds before the job finishes on its own.
+"""
+from __future__ import absolute_import
+
+import logging
+import multiprocessing
+import threading
+
+from rdkit import Chem as C
+from rdkit.Chem import AllChem
+from sqlalchemy.exc import IntegrityError
+
+from .core import app, db
+from .models import Conformer, func
+
+
+log = logging.getLogger(__name__)
+
+CONFORMER_SEED = 0xf00d  # Fixed so the same structure always gets the same geometry
+
+
+class ConformerPending(Exception):
+    """ The conformer is still being embedded; retry after `retry_after` seconds """
+    def __init__(self, inchikey, retry_after):
+        super(ConformerPending, self).__init__(inchikey)
+        self.inchikey = inchikey
+        self.retry_after = retry_after
+
+
+def embed_conformer(job, max_iterations=1000):
+    """ (inchikey, mol binary or None, energy, method) for an (inchikey, smiles) job; runs in worker processes """
+    inchikey, smiles = job
+    mol = C.MolFromSmiles(smiles)
+    if mol is None:
+        return inchikey, None, None, None
+    mol = C.AddHs(mol)
+    params = AllChem.ETKDG()
+    params.randomSeed = CONFORMER_SEED
+    if AllChem.EmbedMolecule(mol, params) != 0:
+        # Random starting coordinates succeed for many of the structures ETKDG gives up on
+        if AllChem.EmbedMolecule(mol, randomSeed=CONFORMER_SEED, useRandomCoords=True) != 0:
+            return inchikey, None, None, None
+    if AllChem.MMFFHasAllMoleculeParams(mol):
+        method = 'mmff94'
+        field = AllChem.MMFFGetMoleculeForceField(mol, AllChem.MMFFGetMoleculeProperties(mol))
+    else:
+        method = 'uff'
+        field = AllChem.UFFGetMoleculeForceField(mol)
+    if field is None:
+        return inchikey, mol.ToBinary(), None, 'etkdg'
+    field.Minimize(maxIts=max_iterations)
+    return inchikey, mol.ToBinary(), field.CalcEnergy(), method
+
+
+def store_conformers(results, bind=None, replace=False):
+    """ Save embed_conformer results; without `replace`, keys stored meanwhile by someone else are kept """
+    bind = bind or db.engine
+    table = Conformer.__table__
+    rows = [{'inchikey': inchikey, 'mol': binary, 'energy': energy, 'method': method}
+            for inchikey, binary, energy, method in results]
+    if not rows:
+        return
+    with bind.begin() as connection:
+        if replace:
+            connection.execute(table.delete().where(table.c.inchikey.in_([row['inchikey'] for row in rows])))
+        else:
+            stored = set(inchikey for inchikey, in connection.execute(
+                table.select().with_only_columns([table.c.inchikey])
+                     .where(table.c.inchikey.in_([row['inchikey'] for row in rows]))))
+            rows = [row for row in rows if row['inchikey'] not in stored]
+        if rows:
+            connection.execute(table.insert(), rows)
+
+
+def missing_conformers(model, overwrite=False):
+    """ Distinct (inchikey, smiles) jobs for `model` rows without a stored conformer """
+    inchikey = model.structure.inchikey
+    query = db.session.query(inchikey, func.mol_to_smiles(model.structure))\
+                      .filter(model.structure != None)
+    if not overwrite:
+        query = query.outerjoin(Conformer, Conformer.inchikey == inchikey).filter(Conformer.inchikey == None)
+    jobs = dict(query)  # Stereoisomers with distinct SMILES may share a key; one geometry per key is kept
+    return sorted(jobs.items())
+
+
+def embed_conformers(jobs, processes=None, chunksize=8):
+    """ Yield embed_conformer results for `jobs` as they complete, across `processes` workers """
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(embed_conformer, jobs, chunksize=chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# On demand embedding: a small per-process pool, created on first use, and the jobs in flight
+_pool = []
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def _get_pool(config=None):
+    config = config or app.config
+    if not _pool:
+        _pool.append(multiprocessing.Pool(config.get('CONFORMER_ON_DEMAND_WORKERS', 2)))
+    return _pool[0]
+
+
+def _finish_job(result):
+    # Runs on the pool's result thread, so it uses the engine rather than the request's session
+    try:
+        store_conformers([result], bind=db.get_engine(app))
+    except IntegrityError:
+        pass  # Stored by another worker process meanwhile
+    except Exception:
+        log.exception("Could not store the conformer for %s", result[0])
+    finally:
+        with _pending_lock:
+            _pending.pop(result[0], None)
+
+
+def get_conformer(inchikey, smiles, timeout=None, config=None):
+    """ Stored 3D molecule for `inchikey` (None if it cannot be embedded), embedding it within `timeout` if missing
+
+    Raises ConformerPending when the embedding takes longer; it carries on and is stored when done.
+    """
+    config = config or app.config
+    stored = Conformer.query.get(inchikey)
+    if stored is not None:
+        return stored.mol
+    timeout = config.get('CONFORMER_ON_DEMAND_TIMEOUT', 2.0) if timeout is None else timeout
+    with _pending_lock:
+        job = _pending.get(inchikey)
+        if job is None:
+            job = _pending[inchikey] = _get_pool(config).apply_async(embed_conformer, ((inchikey, smiles),),
+                                                                     callback=_finish_job)
+    try:
+        _inchikey, binary, _energy, _method = job.get(timeout)
+    except multiprocessing.TimeoutError:
+        raise ConformerPending(inchikey, retry_after=max(timeout, 1))
+    except Exception:
+        with _pending_lock:
+            _pending.pop(inchikey, None)  # Failed without reaching the callback; let a later request retry
+        raise
+    return C.Mol(binary) if binary is not None else None
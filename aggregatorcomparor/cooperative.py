@@ -0,0 +1,45 @@
+"""
+Cooperative serving mode for I/O bound endpoints.
+
+Requests run as gevent greenlets and psycopg2 is made green with psycogreen, so a
+request waiting on a cartridge query yields to the others instead of pinning a
+thread. CPU bound RDKit work is pushed to a bounded thread pool through `offload`.
+Requires the optional gevent and psycogreen packages; start with serve_async.py.
+"""
+from __future__ import absolute_import
+
+_rdkit_pool = None
+
+
+def offload(function, *args, **kwargs):
+    """ Run RDKit work on the bounded pool when serving cooperatively, otherwise inline """
+    pool = _rdkit_pool
+    if pool is None:
+        return function(*args, **kwargs)
+    else:
+        return pool.apply(function, args, kwargs)
+
+
+def configure_database_pool(app):
+    # The engine is created lazily, so this takes effect as long as no query has run yet
+    app.config['SQLALCHEMY_POOL_SIZE'] = app.config.get('ASYNC_DATABASE_POOL_SIZE', 20)
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = app.config.get('ASYNC_DATABASE_MAX_OVERFLOW', 10)
+    app.config['SQLALCHEMY_POOL_TIMEOUT'] = app.config.get('ASYNC_DATABASE_POOL_TIMEOUT', 10)
+
+
+def serve(app, host='0.0.0.0', port=None):
+    global _rdkit_pool
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    from gevent.threadpool import ThreadPool
+
+    configure_database_pool(app)
+    _rdkit_pool = ThreadPool(app.config.get('ASYNC_RDKIT_WORKERS', 4))
+    connections = Pool(app.config.get('ASYNC_MAX_CONNECTIONS', 1000))
+    port = port or app.config.get('PORT', 8080)
+    server = WSGIServer((host, port), app, spawn=connections)
+    try:
+        server.serve_forever()
+    finally:
+        _rdkit_pool.kill()
+        _rdkit_pool = None
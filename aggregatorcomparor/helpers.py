@@ -1,31 +1,58 @@
 from __future__ import absolute_import
 
 import contextlib
+import heapq
+import itertools
+import math
+import operator
+from collections import Counter
 from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 from rdkit import Chem as C
 from rdkit.Chem import inchi as Ci
-from rdkit.Chem import Draw as CD
+# rdkit.Chem.Draw (and PIL behind it) is imported inside the drawing functions so that
+# processes which never draw, like the loaders, do not pay for it at startup
+from sqlalchemy import cast, Integer, or_, text
+from sqlalchemy.orm import Session, aliased
 
-from rdalchemy.rdalchemy import tanimoto_threshold
 from flask import(
     abort,
     current_app,
     json,
+    make_response,
     render_template,
     request,
     send_file,
     url_for,
 )
-
-
+from flask.ext.sqlalchemy import Pagination
+
+
+from .changes import register_change_handler
+from .clustering import get_cached_fingerprints, maxmin_pick
+from .conformers import ConformerPending, get_conformer
+from .cooperative import offload
+from .core import db
+from .records import (
+    PageCache,
+    as_molecule_records,
+    rows_to_records,
+)
 from .models import (
+    FINGERPRINT_TYPES,
+    SIMILARITY_METRICS,
     MoleculeMixin,
     coerse_to_mol,
+    compute_scaffolds,
+    scaffold_hash,
     mol_from_agg_id,
     mol_from_lig_id,
     Aggregator,
+    AggregatorCluster,
+    AggregatorClusterMember,
     Ligand,
+    func,
 )
 
 
@@ -33,14 +60,23 @@ IMAGE_FORMAT_MIME_TYPES = {
     'jpg': 'image/jpeg',
     'png': 'image/png',
     'gif': 'image/gif',
+    'svg': 'image/svg+xml',
 }
 
 DOWNLOAD_FORMAT_MIMETYPES = {
     'smi': 'chemical/x-daylight-smiles',
     'sdf': 'chemical/x-mdl-sdfile',
+    'sdf3d': 'chemical/x-mdl-sdfile',
     'pdb': 'chemical/x-pdb',
 }
 
+# Downloads written from the stored 3D conformer rather than the 2D depiction
+CONFORMER_FORMATS = ('pdb', 'sdf3d')
+
+DOWNLOAD_FORMAT_EXTENSIONS = {
+    'sdf3d': 'sdf',
+}
+
 
 SEARCH_INPUT_FORMATS = [
     ('aggregator', mol_from_agg_id),
@@ -52,12 +88,23 @@ SEARCH_INPUT_FORMATS = [
     ('mol2', C.MolFromMol2Block),
     ('pdb', C.MolFromPDBBlock),
 ]
+# Formats naming a stored molecule rather than describing one
+MOLECULE_ID_INPUT_FORMATS = {'aggregator': Aggregator, 'ligand': Ligand}
+
+
+# Request argument name to indexed MoleculeMixin descriptor
+DESCRIPTOR_FILTERS = {
+    'logp': 'logp',
+    'mwt': 'mwt',
+    'heavy_atoms': 'num_heavy_atoms',
+}
 
 
 DOWNLOAD_FORMAT_WRITERS = {
     'smi': lambda mol: mol_to_smiles_line(mol),
     'inchi': Ci.MolToInchi,
     'sdf': C.MolToMolBlock,
+    'sdf3d': C.MolToMolBlock,
     'pdb': C.MolToPDBBlock,
 }
 
@@ -101,6 +148,32 @@ def represent_mol(mol, format):
         abort(404)
 
 
+def represent_molecule(molecule, format):
+    """ represent_mol for a stored molecule, taking 3D formats from its conformer """
+    format = format.lower()
+    if format not in CONFORMER_FORMATS:
+        return represent_mol(molecule.mol, format)
+    mol = molecule.mol
+    try:
+        conformer = get_conformer(molecule.inchikey, C.MolToSmiles(mol, isomericSmiles=True))
+    except ConformerPending as e:
+        return conformer_pending(e.retry_after)
+    if conformer is None:
+        conformer = mol  # Cannot be embedded; the flat depiction is all there is
+    elif mol.HasProp('_Name'):
+        conformer.SetProp('_Name', mol.GetProp('_Name'))
+    return download_mol(conformer, format)
+
+
+def conformer_pending(retry_after):
+    retry_after = int(math.ceil(retry_after))
+    response = make_response("The 3D structure is being generated. Please retry in {0:d} seconds.\n"
+                             .format(retry_after), 503)
+    response.headers['Retry-After'] = str(retry_after)
+    response.mimetype = 'text/plain'
+    return response
+
+
 def download_mol(mol, format):
     format = format.lower()
     try:
@@ -115,7 +188,7 @@ def download_mol(mol, format):
     options = {}
     if mol_name:
         options.update(as_attachment=True,
-                       attachment_filename="{0}.{1}".format(mol_name, format.lower()))
+                       attachment_filename="{0}.{1}".format(mol_name, DOWNLOAD_FORMAT_EXTENSIONS.get(format, format)))
     return send_file(buffer, mimetype,**options)
 
 
@@ -124,13 +197,84 @@ def draw_mol(mol, format='png'):
     if format not in IMAGE_FORMAT_MIME_TYPES:
         abort(404)
     image_size = current_app.config.get('MOLECULE_DISPLAY_IMAGE_SIZE', (200,200))
-    image = CD.MolToImage(mol, size=image_size)
-    image_data = image_to_buffer(image, format)
+    if format == 'svg':
+        image_data = StringIO(offload(mol_to_svg, mol, size=image_size))
+    else:
+        from rdkit.Chem import Draw as CD
+        image = offload(CD.MolToImage, mol, size=image_size)
+        image_data = image_to_buffer(image, format)
     mime_type = IMAGE_FORMAT_MIME_TYPES.get(format)
 
     return send_file(image_data, mime_type)
 
 
+def _finish_svg(drawer, inline=False):
+    drawer.FinishDrawing()
+    svg = drawer.GetDrawingText()
+    if inline and svg.startswith('<?xml'):
+        # Inline SVG elements may not carry an XML declaration
+        svg = svg.split('?>', 1)[1].lstrip()
+    return svg
+
+
+def mol_to_svg(mol, size=(200, 200), inline=False):
+    """ Draw a molecule as SVG text without going through PIL """
+    from rdkit.Chem.Draw import rdMolDraw2D
+    width, height = size
+    drawer = rdMolDraw2D.MolDraw2DSVG(width, height)
+    rdMolDraw2D.PrepareAndDrawMolecule(drawer, mol)
+    return _finish_svg(drawer, inline=inline)
+
+
+def mols_to_svg_sprite(mols, panel_size=(200, 200), columns=6, inline=False):
+    """ Draw many molecules into a single SVG grid using one drawing context
+
+    Returns the SVG text and the (x, y, width, height) of each molecule's panel.
+    """
+    from rdkit.Chem.Draw import rdMolDraw2D
+    mols = list(mols)
+    width, height = panel_size
+    columns = max(1, min(columns, len(mols)))
+    rows = max(1, (len(mols) + columns - 1) // columns)
+    drawer = rdMolDraw2D.MolDraw2DSVG(width * columns, height * rows, width, height)
+    if mols:
+        prepared = [rdMolDraw2D.PrepareMolForDrawing(mol) for mol in mols]
+        drawer.DrawMolecules(prepared)
+    coordinates = [((idx % columns) * width, (idx // columns) * height, width, height)
+                   for idx in range(len(mols))]
+    return _finish_svg(drawer, inline=inline), coordinates
+
+
+def depict_molecules(molecules, layout='inline', config=None):
+    """ Batch render a page of molecules keyed by id, either as individual SVGs or one sprite """
+    config = config or current_app.config
+    image_size = config.get('MOLECULE_DISPLAY_IMAGE_SIZE', (200,200))
+    molecules = list(molecules)
+    if layout == 'sprite':
+        columns = config.get('MOLECULES_SPRITE_COLUMNS', 6)
+        svg, coordinates = mols_to_svg_sprite((molecule.mol for molecule in molecules),
+                                              panel_size=image_size,
+                                              columns=columns)
+        return {
+            'sprite': svg,
+            'coordinates': dict((molecule.id, coords) for molecule, coords in zip(molecules, coordinates)),
+        }
+    elif layout == 'inline':
+        return dict((molecule.id, mol_to_svg(molecule.mol, size=image_size, inline=True))
+                    for molecule in molecules)
+    else:
+        abort(400)
+
+
+def get_page_depictions(molecules, config=None):
+    """ Inline SVGs for a list page, or an empty mapping if inline depictions are disabled """
+    config = config or current_app.config
+    if config.get('MOLECULES_INLINE_DEPICTIONS', True):
+        return depict_molecules(molecules, layout='inline', config=config)
+    else:
+        return {}
+
+
 def get_molecules_for_view(molecules, page_num, sorting=None, config=None):
     config = config or current_app.config
     per_page = config.get('MOLECULES_DISPLAY_PER_PAGE', 30)
@@ -142,6 +286,41 @@ def get_molecules_for_view(molecules, page_num, sorting=None, config=None):
     return paginated
 
 
+_page_cache = []
+
+
+def get_page_cache(config=None):
+    config = config or current_app.config
+    if not _page_cache:
+        _page_cache.append(PageCache(size=config.get('MOLECULE_PAGE_CACHE_SIZE', 128),
+                                     ttl=config.get('MOLECULE_PAGE_CACHE_TTL', 300)))
+    return _page_cache[0]
+
+
+@register_change_handler
+def invalidate_cached_pages(change):
+    if _page_cache:
+        _page_cache[0].invalidate(lambda key: key[0] == change['table'])
+
+
+def get_molecule_records_for_view(model, molecules, page_num, sorting=None, cache_key=None, config=None):
+    """ Page of lightweight MoleculeRecords plus their depictions, cached per page when given a key """
+    config = config or current_app.config
+
+    def build():
+        paginated = get_molecules_for_view(as_molecule_records(model, molecules), page_num,
+                                           sorting=sorting, config=config)
+        records = rows_to_records(model, paginated.items)
+        # Detach from the query/session so the page can be kept across requests
+        page = Pagination(None, paginated.page, paginated.per_page, paginated.total, records)
+        return page, get_page_depictions(records, config=config)
+
+    if cache_key is None:
+        return build()
+    else:
+        return get_page_cache(config).get_or_create((model.__tablename__,) + tuple(cache_key) + (page_num,), build)
+
+
 def image_to_buffer(image, format='PNG'):
     buf = StringIO()
     image.save(buf, format.upper())
@@ -154,7 +333,13 @@ def extract_query_mol(params, formats=SEARCH_INPUT_FORMATS, onerror_fail=True):
     for input_format, parser in formats:
         try:
             query = params[input_format]
-            mol = parser(str(query))
+            if input_format in MOLECULE_ID_INPUT_FORMATS:
+                # The lookup stays on the request (its session is removed at teardown, a worker's is not);
+                # only reading the stored molecule is RDKit work
+                molecule = MOLECULE_ID_INPUT_FORMATS[input_format].query.get_or_404(str(query))
+                mol = offload(getattr, molecule, 'mol')
+            else:
+                mol = offload(parser, str(query))
             if mol is None:
                 raise ValueError("Failed to parse {}".format(input_format))
         except KeyError:
@@ -179,6 +364,8 @@ def get_similarity_parameters(this_request, onerror_fail=True, **kwargs):
     search_cutoff = float(this_request.args.get('cutoff', default_search_cutoff))
     result_limit = this_request.args.get('count', default_result_limit)
     query_structure, query_input, error = extract_query_mol(this_request.args, SEARCH_INPUT_FORMATS)
+    # The format the query was read from, as extract_query_mol chose it (first one present)
+    input_format = next((fmt for fmt, _parser in SEARCH_INPUT_FORMATS if fmt in this_request.args), None)
 
     if result_limit is not None:
         result_limit = int(result_limit)
@@ -191,43 +378,148 @@ def get_similarity_parameters(this_request, onerror_fail=True, **kwargs):
     if 'override_limit' in kwargs:
         result_limit = kwargs['override_limit']
 
+    search_cutoff, result_limit = clamp_similarity_bounds(search_cutoff, result_limit)
+
+    fp_type = this_request.args.get('fp', current_app.config.get('MOLECULE_SEARCH_FINGERPRINT', 'rdkit'))
+    metric = this_request.args.get('metric', current_app.config.get('MOLECULE_SEARCH_METRIC', 'tanimoto'))
+    if fp_type not in FINGERPRINT_TYPES or metric not in SIMILARITY_METRICS:
+        error = "Unknown fingerprint or metric (expected fp in: {0}; metric in: {1})"\
+                    .format(', '.join(FINGERPRINT_TYPES), ', '.join(SIMILARITY_METRICS))
+
     if error is not None and onerror_fail:
         abort(400)
     else:
         return {
             'cutoff': search_cutoff,
             'limit': result_limit,
+            'fp': fp_type,
+            'metric': metric,
+            'descriptors': get_descriptor_filters(this_request.args),
             'query': query_molecule,
             'mol': query_structure,
             'raw': query_input,
+            'input_format': input_format,
             'error': error,
         }
 
 
 
+def clamp_similarity_bounds(cutoff, limit, config=None):
+    """ Enforce hard search bounds so no request can ask for an unbounded scan """
+    config = config or current_app.config
+    min_cutoff = config.get('MOLECULE_SEARCH_MIN_TANIMOTO_CUTOFF', None)
+    max_limit = config.get('MOLECULE_SEARCH_MAX_RESULT_LIMIT', None)
+    if min_cutoff is not None:
+        cutoff = max(cutoff, min_cutoff)
+    if max_limit is not None and (limit is None or limit > max_limit):
+        limit = max_limit
+    return cutoff, limit
+
+
+def get_descriptor_filters(args):
+    """ Read `min_<descriptor>`/`max_<descriptor>` request arguments into {descriptor: (low, high)} """
+    filters = {}
+    for descriptor in DESCRIPTOR_FILTERS:
+        low = args.get('min_{0}'.format(descriptor))
+        high = args.get('max_{0}'.format(descriptor))
+        if low is None and high is None:
+            continue
+        try:
+            filters[descriptor] = (None if low is None else float(low),
+                                   None if high is None else float(high))
+        except ValueError:
+            abort(400)
+    return filters
+
+
+def apply_descriptor_filters(query, result_type, filters):
+    for descriptor, (low, high) in (filters or {}).items():
+        expression = getattr(result_type, DESCRIPTOR_FILTERS[descriptor])
+        if low is not None:
+            query = query.filter(expression >= low)
+        if high is not None:
+            query = query.filter(expression <= high)
+    return query
+
+
 @contextlib.contextmanager
-def run_similar_molecules_query(result_type, params):
+def run_similar_molecules_query(result_type, params, session=None, partition=None):
     needle = params['query']
+    fp_type = params.get('fp', 'rdkit')
+    metric = SIMILARITY_METRICS[params.get('metric', 'tanimoto')]
 
-    needle_fp = needle.bind.rdkit_fp  # Force server-side fingerprint function
-    haystack = result_type.query  # Searchable Aggregator dataset
-    haystack_fps = result_type.structure.rdkit_fp  # Comparable fingerprint property
-
-    # Construct structural query sorted and limited by similarity with tanimoto scores annotated
-    similar = haystack.filter(haystack_fps.tanimoto_similar(needle_fp))  # Restrict to molecules with high Tc
-    similar = similar.order_by(haystack_fps.tanimoto_nearest_neighbors(needle_fp))  # Put highest Tc's first
-    similar = similar.add_columns(needle_fp.tanimoto(haystack_fps))  # Annotate results with Tc
+    needle_fp = FINGERPRINT_TYPES[fp_type](needle.bind)  # Force server-side fingerprint function
+    if session is None:
+        haystack = result_type.query  # Searchable Aggregator dataset
+    else:
+        haystack = session.query(result_type)
+    if partition is not None:
+        haystack = haystack.filter(result_type.partition_filter(*partition))
+    haystack_fps = result_type.fingerprint(fp_type)  # Same expression as the functional index for this type
+
+    # Cheap indexed predicates first: descriptor windows and the popcount bounds implied by the cutoff
+    haystack = apply_descriptor_filters(haystack, result_type, params.get('descriptors'))
+    if params.get('candidates') is not None:
+        haystack = haystack.filter(params['candidates'])
+    cutoff = params.get('cutoff')
+    if params.get('popcount_bounds', True) and cutoff and metric.popcount_bounds is not None:
+        needle_count = func.bfp_popcount(needle_fp)
+        low, high = metric.popcount_bounds(needle_count, cutoff)
+        haystack_count = result_type.fingerprint_popcount(fp_type)
+        # Integer bounds so the comparison stays on the popcount index's type
+        haystack = haystack.filter(haystack_count.between(cast(func.ceil(low), Integer),
+                                                          cast(func.floor(high), Integer)))
+    if params.get('popcounts') is not None:
+        # One chunk of a progressive search (see progressive.py)
+        haystack = haystack.filter(result_type.fingerprint_popcount(fp_type).in_(params['popcounts']))
+
+    # Construct structural query sorted and limited by similarity with scores annotated
+    similar = haystack.filter(metric.similar(haystack_fps, needle_fp))  # Restrict to molecules above threshold
+    similar = similar.order_by(metric.nearest_neighbors(haystack_fps, needle_fp))  # Put most similar first
+    similar = similar.add_columns(metric.similarity(needle_fp, haystack_fps))  # Annotate results with score
 
     if 'limit' in params:
         similar = similar.limit(params['limit'])
 
-    # Run query with specified tanimoto threshold
+    # Run query with specified similarity threshold
     if 'cutoff' in params:
-        similar = similar.with_transformation(tanimoto_threshold.set_in_session(params['cutoff']))
+        similar = similar.with_transformation(metric.set_threshold(params['cutoff']))
     yield similar
 
 
 
+_snapshot = []
+
+
+def get_snapshot(config=None):
+    """ The SNAPSHOT_PATH snapshot, opened once per process, or None when searching PostgreSQL """
+    config = config or current_app.config
+    if not _snapshot:
+        path = config.get('SNAPSHOT_PATH')
+        if path:
+            from .snapshot import Snapshot
+            _snapshot.append(Snapshot(path))
+        else:
+            _snapshot.append(None)
+    return _snapshot[0]
+
+
+def snapshot_similar_molecules(result_type, params, config=None):
+    """ [(molecule, score), ...] answered from the snapshot, or None if it cannot answer this search """
+    snapshot = get_snapshot(config)
+    if snapshot is None or not snapshot.has_table(result_type.__tablename__):
+        return None
+    if params.get('fp', snapshot.fp_type) != snapshot.fp_type:
+        return None
+    query_mol = offload(getattr, params['query'], 'as_mol')
+    descriptors = dict((DESCRIPTOR_FILTERS[name], window) for name, window in (params.get('descriptors') or {}).items())
+    return offload(snapshot.similar, result_type.__tablename__, query_mol,
+                   cutoff=params.get('cutoff', 0.5),
+                   limit=params.get('limit'),
+                   metric=params.get('metric', 'tanimoto'),
+                   descriptors=descriptors)
+
+
 def get_similar_molecules(result_type, query_structure=None, **params):
     params.setdefault('cutoff', current_app.config.get('MOLECULE_SEARCH_TANIMOTO_CUTOFF', 0.50))
     params.setdefault('limit', current_app.config.get('MOLECULE_SEARCH_RESULT_LIMIT', 10))
@@ -235,30 +527,329 @@ def get_similar_molecules(result_type, query_structure=None, **params):
         params.setdefault('mol', query_structure)
     if 'mol' in params:
         params.setdefault('query', coerse_to_mol(params['mol']))
+    results = snapshot_similar_molecules(result_type, params)
+    if results is not None:
+        return annotate_similarity(results, metric=params.get('metric', 'tanimoto'))
+    partitions = get_partition_count(result_type)
+    if partitions:
+        results, _total = fan_out_similar_molecules(result_type, params, partitions, limit=params['limit'])
+        return annotate_similarity(results, metric=params.get('metric', 'tanimoto'))
     with run_similar_molecules_query(result_type, params) as results:
-        annotated = annotate_tanimoto_similarity(results)
+        annotated = annotate_similarity(results, metric=params.get('metric', 'tanimoto'))
         return annotated
 
 
-def annotate_tanimoto_similarity(molecules_with_tc, attribute='tanimoto_similarity'):
-    for molecule, tc in molecules_with_tc:
-        setattr(molecule, attribute, tc)
-        setattr(molecule, attribute+'_percentage', int(100 * tc))
-        yield  molecule
+def paginate_similar_molecules(result_type, params, page_num, config=None):
+    """ Page of (molecule, score) rows from the snapshot, or fanning out across partition tables if there are any """
+    config = config or current_app.config
+    per_page = config.get('MOLECULES_DISPLAY_PER_PAGE', 30)
+    results = snapshot_similar_molecules(result_type, params, config=config)
+    if results is not None:
+        if page_num < 0:
+            abort(404)
+        # Page 0 is every result up to the search limit
+        items = results if page_num == 0 else results[(page_num - 1) * per_page:page_num * per_page]
+        if not items and page_num > 1:
+            abort(404)
+        return Pagination(None, page_num, per_page, len(results), items)
+    partitions = get_partition_count(result_type)
+    if not partitions:
+        with run_similar_molecules_query(result_type, params) as query:
+            return get_molecules_for_view(query, page_num, sorting=None, config=config)
+    if page_num < 1:
+        abort(404)
+    needed = page_num * per_page
+    if params.get('limit') is not None:
+        needed = min(needed, params['limit'])
+    rows, total = fan_out_similar_molecules(result_type, params, partitions, limit=needed, with_count=True)
+    if params.get('limit') is not None:
+        total = min(total, params['limit'])
+    items = rows[(page_num - 1) * per_page:page_num * per_page]
+    if not items and page_num != 1:
+        abort(404)
+    return Pagination(None, page_num, per_page, total, items)
+
+
+class StreamedPagination(Pagination):
+    """ Pagination whose items are produced while the page renders and whose total is only counted when needed """
+    streamed = True
+
+    def __init__(self, page, per_page, items, count):
+        self._count = count
+        self._total = None
+        super(StreamedPagination, self).__init__(None, page, per_page, None, items)
+
+    @property
+    def total(self):
+        if self._total is None:
+            self._total = self._count()
+        return self._total
 
+    @total.setter
+    def total(self, total):
+        self._total = total
+
+
+def stream_similar_molecules(result_type, params, page_num, config=None):
+    """ (pagination, depictions) for a similarity page, read through a server-side cursor
+
+    Rows are annotated and depicted a batch at a time as the template consumes them, filling in
+    `depictions` as they go, so the first results are sent while the cartridge is still searching.
+    Page 0 is every result up to the search limit. Snapshots and partitioned tables are paged whole.
+    """
+    config = config or current_app.config
+    metric = params.get('metric', 'tanimoto')
+    if get_snapshot(config) is not None or get_partition_count(result_type):
+        pagination = paginate_similar_molecules(result_type, params, page_num, config=config)
+        pagination.items = list(annotate_similarity(pagination.items, metric=metric))
+        return pagination, get_page_depictions(pagination.items, config=config)
+    if page_num < 0:
+        abort(404)
+
+    per_page = config.get('MOLECULES_DISPLAY_PER_PAGE', 30)
+    batch_size = config.get('MOLECULES_STREAM_BATCH_SIZE', per_page)
+    limit = params.get('limit')
+    with run_similar_molecules_query(result_type, params) as query:
+        if page_num > 0:
+            offset = (page_num - 1) * per_page
+            page_size = per_page if limit is None else max(min(per_page, limit - offset), 0)
+            query = query.limit(page_size).offset(offset)
+        rows = query.execution_options(stream_results=True).yield_per(batch_size)
+
+    def count():
+        with run_similar_molecules_query(result_type, params) as query:
+            return query.order_by(None).count()
+
+    depictions = {}
+
+    def stream():
+        batch = []
+        for molecule in itertools.chain(annotate_similarity(rows, metric=metric), [None]):
+            if molecule is not None:
+                batch.append(molecule)
+            if batch and (molecule is None or len(batch) >= batch_size):
+                depictions.update(get_page_depictions(batch, config=config))
+                for item in batch:
+                    yield item
+                batch = []
+
+    items = stream()
+    first = next(items, None)  # Runs the search, so an empty page can still be answered with a 404
+    if first is None and page_num > 1:
+        abort(404)
+    items = itertools.chain([first] if first is not None else [], items)
+    return StreamedPagination(page_num, per_page, items, count), depictions
+
+
+def stream_template(template_name, **context):
+    """ Render a template incrementally; wrap in stream_with_context to keep the request alive while it runs """
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(current_app.config.get('MOLECULES_STREAM_BUFFER', 5))
+    return stream
+
+
+# Partition counts are read from the catalog once per process (restart workers after repartitioning)
+_partition_counts = {}
+_partition_pool = []
+
+
+def get_partition_count(result_type):
+    tablename = result_type.__tablename__
+    if tablename not in _partition_counts:
+        count = db.session.execute(text("SELECT count(*) FROM pg_inherits "
+                                        "WHERE inhparent = CAST(:table AS regclass)"),
+                                   {'table': tablename}).scalar()
+        _partition_counts[tablename] = count or 0
+    return _partition_counts[tablename]
+
+
+def get_partition_pool(config=None):
+    config = config or current_app.config
+    if not _partition_pool:
+        _partition_pool.append(ThreadPool(config.get('PARTITION_SEARCH_WORKERS', 8)))
+    return _partition_pool[0]
+
+
+def fan_out_similar_molecules(result_type, params, partitions, limit=None, with_count=False):
+    """ Run a similarity search on every partition concurrently and merge the per-partition top lists
+
+    Each partition answers from its own fingerprint index with its own top `limit` rows, so the
+    merged top `limit` is exact. Returns the merged rows and, if requested, the total match count.
+    """
+    engine = db.engine
+
+    def search(partition):
+        session = Session(bind=engine)
+        try:
+            with run_similar_molecules_query(result_type, params, session=session,
+                                             partition=(partition, partitions)) as query:
+                rows = query.limit(limit).all()
+                count = query.limit(None).order_by(None).count() if with_count else 0
+            return rows, count
+        finally:
+            session.close()
+
+    results = get_partition_pool().map(search, range(partitions))
+    candidates = itertools.chain.from_iterable(rows for rows, _count in results)
+    score = operator.itemgetter(-1)
+    if limit is None:
+        merged = sorted(candidates, key=score, reverse=True)
+    else:
+        merged = heapq.nlargest(limit, candidates, key=score)
+    return merged, sum(count for _rows, count in results)
 
-def aggregator_report(structure):
+
+def annotate_similarity(molecules_with_score, metric='tanimoto'):
+    """ Annotate with both a generic `similarity` and a metric specific (e.g. `dice_similarity`) score """
+    for molecule, score in molecules_with_score:
+        for attribute in ('similarity', '{0}_similarity'.format(metric)):
+            setattr(molecule, attribute, score)
+            setattr(molecule, attribute+'_percentage', int(100 * score))
+        molecule.similarity_metric = metric
+        yield molecule
+
+
+# Fingerprint types with stored clusters, read once per process and again after cluster_aggregators
+_clustered_fp_types = []
+
+
+@register_change_handler
+def invalidate_clustered_fp_types(change):
+    if change['table'] == AggregatorCluster.__tablename__:
+        del _clustered_fp_types[:]
+
+
+def get_clustered_fp_types():
+    if not _clustered_fp_types:
+        exists = db.session.execute(text("SELECT to_regclass('aggregator_cluster') IS NOT NULL")).scalar()
+        fp_types = set(fp_type for fp_type, in db.session.query(AggregatorCluster.fp_type).distinct()) \
+            if exists else set()
+        _clustered_fp_types.append(fp_types)
+    return _clustered_fp_types[0]
+
+
+def cluster_candidates(query_mol, cutoff, fp_type='rdkit'):
+    """ Filter restricting a Tanimoto aggregator search to members of clusters that can hold a hit
+
+    1 - Tanimoto is a metric, so a member can only reach `cutoff` if its similarity to the centroid
+    is within 1 - `cutoff` of the query's. Aggregators added since clustering are always kept.
+    """
+    if fp_type not in get_clustered_fp_types():
+        return None
+    needle_fp = FINGERPRINT_TYPES[fp_type](query_mol.bind)
+    centroid = aliased(Aggregator)
+    clusters = db.session.query(AggregatorCluster.id.label('id'),
+                                SIMILARITY_METRICS['tanimoto'].similarity(centroid.fingerprint(fp_type),
+                                                                          needle_fp).label('similarity'))\
+                         .join(centroid, AggregatorCluster.centroid)\
+                         .filter(AggregatorCluster.fp_type == fp_type)\
+                         .subquery()
+    candidates = db.session.query(AggregatorClusterMember.aggregator_fk)\
+                           .join(clusters, clusters.c.id == AggregatorClusterMember.cluster_fk)\
+                           .filter(func.abs(AggregatorClusterMember.centroid_similarity - clusters.c.similarity)
+                                   <= 1 - cutoff)
+    clustered = db.session.query(AggregatorClusterMember.aggregator_fk)
+    return or_(Aggregator.id.in_(candidates.subquery()), ~Aggregator.id.in_(clustered.subquery()))
+
+
+def pick_diverse_molecules(model, count, fp_type='rdkit', seed=42):
+    """ `count` mutually dissimilar molecules (MaxMin), as records in pick order """
+    ids, fingerprints = get_cached_fingerprints(model, fp_type)
+    picked = [ids[index] for index in offload(maxmin_pick, fingerprints, count, seed)]
+    if not picked:
+        return []
+    records = rows_to_records(model, as_molecule_records(model, model.query.filter(model.id.in_(picked))))
+    by_id = dict((record.id, record) for record in records)
+    return [by_id[molecule_id] for molecule_id in picked if molecule_id in by_id]
+
+
+def get_query_scaffold(args, generic=False):
+    """ Canonical scaffold SMILES from a `scaffold` argument, or of the query molecule in the usual arguments """
+    if 'scaffold' in args:
+        mol = C.MolFromSmiles(args['scaffold'])
+        if mol is None:
+            abort(400)
+        return C.MolToSmiles(mol, isomericSmiles=False)
+    if not any(input_format in args for input_format, _parser in SEARCH_INPUT_FORMATS):
+        abort(400)
+    mol, _query, error = extract_query_mol(args, onerror_fail=False)
+    if error is not None:
+        abort(400)
+    scaffold, generic_scaffold = compute_scaffolds(mol)
+    return generic_scaffold if generic else scaffold
+
+
+def scaffold_facets(model, molecules, generic=False, limit=10):
+    """ Most common scaffolds among `molecules`, each with its count in the whole table from the hash index """
+    attribute = 'generic_scaffold' if generic else 'scaffold'
+    counts = Counter(getattr(molecule, attribute, None) for molecule in molecules)
+    for missing in (None, ''):  # Not computed yet, or acyclic
+        counts.pop(missing, None)
+    top = counts.most_common(limit)
+    if not top:
+        return []
+    hash_column = model.generic_scaffold_hash if generic else model.scaffold_hash
+    totals = dict(db.session.query(hash_column, func.count(model.id))
+                            .filter(hash_column.in_([scaffold_hash(scaffold) for scaffold, _count in top]))
+                            .group_by(hash_column))
+    return [{
+        'scaffold': scaffold,
+        'count': count,
+        'total': totals.get(scaffold_hash(scaffold), count),
+    } for scaffold, count in top]
+
+
+_aggregator_inchikeys = []
+
+
+@register_change_handler
+def invalidate_aggregator_inchikeys(change):
+    if change['table'] == Aggregator.__tablename__:
+        del _aggregator_inchikeys[:]
+
+
+def is_reported_aggregator(inchikey):
+    """ Whether `inchikey` is an aggregator's: looked up in the snapshot when serving one, otherwise in
+    the aggregator InChIKeys read once per process (and again after aggregators change)
+    """
+    snapshot = get_snapshot()
+    if snapshot is not None and snapshot.has_table(Aggregator.__tablename__):
+        return snapshot.has_inchikey(Aggregator.__tablename__, inchikey)
+    if not _aggregator_inchikeys:
+        _aggregator_inchikeys.append(frozenset(key for key, in db.session.query(Aggregator.structure.inchikey)
+                                                                        .filter(Aggregator.structure != None)))
+    return inchikey in _aggregator_inchikeys[0]
+
+
+def aggregator_report(structure, scored=None, known=None):
+    """ Report for a query structure; `scored` is its aggregation_score and `known` whether it is a reported
+    aggregator, when the caller already has them
+    """
     similarity_cutoff = current_app.config.get('AGGREGATOR_SIMILARITY_TANIMOTO_CUTOFF', 0.7)
     logp_cutoff = current_app.config.get('AGGREGATOR_LOGP_CUTOFF', 3)
 
     query_mol = coerse_to_mol(structure)
-    query_logp = query_mol.logp
-
-    similar_aggregators = get_similar_molecules(Aggregator,
-                                                mol=query_mol,
-                                                cutoff=similarity_cutoff,
-                                                limit=None)
-    similar_aggregators = list(similar_aggregators)
+    query_logp = offload(getattr, query_mol, 'logp')
+
+    score, triage = aggregation_score(query_mol) if scored is None else scored
+    if triage == 'negative' and known is None:
+        known = is_reported_aggregator(offload(C.MolToInchiKey, offload(getattr, query_mol, 'as_mol')))
+    if triage == 'negative' and known:
+        triage = None  # Reported aggregators are always searched, so they come out as known
+    scored_only = triage == 'negative' and current_app.config.get('AGGREGATOR_REPORT_SCORER_TRIAGE', True)
+    if scored_only:
+        similar_aggregators = []
+    else:
+        candidates = None
+        if current_app.config.get('AGGREGATOR_REPORT_CLUSTER_PREFILTER', False) and get_snapshot() is None:
+            candidates = cluster_candidates(query_mol, similarity_cutoff)
+        similar_aggregators = get_similar_molecules(Aggregator,
+                                                    mol=query_mol,
+                                                    cutoff=similarity_cutoff,
+                                                    candidates=candidates,
+                                                    limit=None)
+        similar_aggregators = list(similar_aggregators)
     aggregator_tcs = [round(agg.tanimoto_similarity, 2) for agg in similar_aggregators]
 
     max_tc = max(aggregator_tcs + [0])
@@ -266,20 +857,71 @@ def aggregator_report(structure):
     has_similar_aggregators = num_similar > 0
     high_logp = query_logp >= logp_cutoff
 
-    if max_tc == 1.0:
+    if scored_only:
+        status = SCORER_STATUSES[triage]
+    elif max_tc == 1.0:
         status = "known"
-    elif has_similar_aggregators and high_logp:
-        status = "likely"
-    elif has_similar_aggregators or high_logp:
-        status = "maybe"
     else:
-        status = "requires testing"
+        status = report_status(has_similar_aggregators, high_logp)
 
     return {
         'query': query_mol,
         'status': status,
         'similar': similar_aggregators,
+        # Snapshots hold no scaffolds, and the table totals would come from PostgreSQL
+        'scaffolds': scaffold_facets(Aggregator, similar_aggregators) if get_snapshot() is None else [],
         'num_similar': num_similar,
         'logp': query_logp,
         'max_tc': max_tc,
-    }
\ No newline at end of file
+        'aggregation_score': score,
+        'triage': triage,
+    }
+
+
+# Statuses decided by the aggregation scorer alone, without a similarity search behind them
+SCORER_STATUSES = {
+    'negative': "predicted non-aggregator",
+    'positive': "predicted aggregator",
+}
+
+
+def report_status(has_similar_aggregators, high_logp):
+    if has_similar_aggregators and high_logp:
+        return "likely"
+    elif has_similar_aggregators or high_logp:
+        return "maybe"
+    else:
+        return "requires testing"
+
+
+def aggregation_score(query_mol):
+    """ (probability, triage) from the AGGREGATION_SCORER_PATH model, or (None, None) without one """
+    from .scorer import get_scorer  # NumPy is only needed once a model is configured
+
+    scorer = get_scorer(current_app.config)
+    if scorer is None:
+        return None, None
+    score = offload(scorer.score, offload(getattr, query_mol, 'as_mol'))
+    return scorer.probability(score), scorer.triage(score)
+
+
+def serialize_aggregator_report(report):
+    """ JSON-friendly version of an aggregator_report result """
+    return {
+        'query': offload(getattr, report['query'], 'as_smiles'),
+        'status': report['status'],
+        'num_similar': report['num_similar'],
+        'logp': report['logp'],
+        'max_tc': report['max_tc'],
+        'aggregation_score': report.get('aggregation_score'),
+        'triage': report.get('triage'),
+        'similar': [{
+            'id': aggregator.id,
+            'name': aggregator.name,
+            'smiles': aggregator.smiles,
+            'tanimoto_similarity': aggregator.tanimoto_similarity,
+            'url': url_for('aggregator_detail', agg_id=aggregator.id),
+        } for aggregator in report['similar']],
+        'scaffolds': [dict(facet, url=url_for('aggregator_scaffold', scaffold=facet['scaffold']))
+                      for facet in report.get('scaffolds', ())],
+    }
@@ -0,0 +1,283 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import Queue
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib2
+from collections import OrderedDict
+from urlparse import urlsplit
+
+from flask import request
+from sqlalchemy import event
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+from .core import app, db
+from .models import Aggregator, Ligand, func
+
+
+DEFAULT_TRAFFIC_MIX = OrderedDict([
+    ('detail', 30),
+    ('status', 10),
+    ('similar', 15),
+    ('typeahead', 30),
+    ('image', 15),
+])
+
+
+class LocalPostgres(object):
+    """ Throwaway PostgreSQL cluster with the RDKit cartridge, listening only on a private socket directory """
+    def __init__(self, port=55432, user='aggcomp', database='aggcomp', bin_dir=None):
+        self.port = port
+        self.user = user
+        self.database = database
+        self.bin_dir = bin_dir
+        self.directory = None
+
+    def _command(self, name, *args):
+        executable = os.path.join(self.bin_dir, name) if self.bin_dir else name
+        subprocess.check_call([executable] + list(args), stdout=open(os.devnull, 'w'))
+
+    @property
+    def uri(self):
+        return 'postgresql+psycopg2://{0}@/{1}?host={2}&port={3:d}'.format(self.user, self.database,
+                                                                          self.directory, self.port)
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix='aggcomp-pg-')
+        data = os.path.join(self.directory, 'data')
+        self._command('initdb', '-D', data, '-U', self.user, '--auth=trust')
+        self._command('pg_ctl', '-D', data, '-w', '-l', os.path.join(self.directory, 'server.log'),
+                      '-o', "-p {0:d} -k {1} -c listen_addresses=''".format(self.port, self.directory), 'start')
+        self._command('createdb', '-h', self.directory, '-p', str(self.port), '-U', self.user, self.database)
+        self._command('psql', '-h', self.directory, '-p', str(self.port), '-U', self.user, '-d', self.database,
+                      '-c', 'CREATE EXTENSION IF NOT EXISTS rdkit')
+        return self
+
+    def stop(self):
+        if self.directory is not None:
+            self._command('pg_ctl', '-D', os.path.join(self.directory, 'data'), '-w', '-m', 'fast', 'stop')
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+def endpoint_for(path):
+    """ Name of the view handling `path`, so results are grouped by route rather than by URL """
+    try:
+        return app.url_map.bind('localhost').match(urlsplit(path).path)[0]
+    except (HTTPException, RequestRedirect):
+        return 'unknown'
+
+
+def synthesize_traffic(count, mix=None, seed=None, sample_size=500):
+    """ Request paths drawn from the database according to `mix` weights, in the order a user would send them """
+    rng = random.Random(seed)
+    mix = mix or app.config.get('LOADTEST_TRAFFIC_MIX', DEFAULT_TRAFFIC_MIX)
+    urls = app.url_map.bind('localhost')
+    aggregators = db.session.query(Aggregator.id, Aggregator.name, func.mol_to_smiles(Aggregator.structure))\
+                            .order_by(func.random()).limit(sample_size).all()
+    ligand_ids = [ligand_id for ligand_id, in db.session.query(Ligand.id).order_by(func.random()).limit(sample_size)]
+    if not aggregators:
+        raise ValueError("No aggregators to build traffic from; load data first")
+
+    def molecule(kind):
+        if ligand_ids and rng.random() < 0.5:
+            return urls.build('ligand_' + kind, {'lig_id': rng.choice(ligand_ids)})
+        return urls.build('aggregator_' + kind, {'agg_id': rng.choice(aggregators)[0]})
+
+    def similar():
+        endpoint = rng.choice(['aggregator_list_similar_to'] + (['ligand_list_similar_to'] if ligand_ids else []))
+        smiles = rng.choice(aggregators)[2]
+        return [urls.build(endpoint, {'page': page, 'smiles': smiles}) for page in range(1, rng.randint(1, 3) + 1)]
+
+    def typeahead():
+        name = rng.choice([name for _id, name, _smiles in aggregators if name] or ['a'])
+        return [urls.build('aggregator_list', {'name': name[:length], 'format': 'json'})
+                for length in range(1, min(len(name), 4) + 1)]
+
+    generators = {
+        'detail': lambda: [molecule('detail')],
+        'status': lambda: [urls.build('aggregator_status_json', {'smiles': rng.choice(aggregators)[2]})],
+        'similar': similar,
+        'typeahead': typeahead,
+        'image': lambda: [molecule('image')],
+    }
+    kinds = [kind for kind, weight in mix.items() for _ in range(int(weight))]
+    traffic = []
+    while len(traffic) < count:
+        traffic.extend(generators[rng.choice(kinds)]())
+    return traffic[:count]
+
+
+def read_traffic(path):
+    with open(path) as f:
+        return [json.loads(line)['path'] for line in f if line.strip()]
+
+
+def write_traffic(traffic, path):
+    with open(path, 'w') as f:
+        for item in traffic:
+            f.write(json.dumps({'path': item}) + '\n')
+
+
+def install_traffic_recorder(flask_app, path):
+    """ Append every request served by `flask_app` to a replayable traffic file """
+    lock = threading.Lock()
+
+    @flask_app.after_request
+    def record_traffic(response):
+        line = json.dumps({'path': request.full_path.rstrip('?'), 'status': response.status_code})
+        with lock:
+            with open(path, 'a') as f:
+                f.write(line + '\n')
+        return response
+
+    return record_traffic
+
+
+class QueryCounter(object):
+    """ Counts statements executed by the current thread on an engine """
+    def __init__(self, engine):
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+
+class RouteStats(object):
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.rejected = 0
+        self.queries = 0
+
+    def add(self, seconds, status, queries=0):
+        self.latencies.append(seconds)
+        if status == 429:
+            self.rejected += 1
+        elif status is None or status >= 400:
+            self.errors += 1
+        self.queries += queries
+
+    def percentile(self, fraction):
+        ordered = sorted(self.latencies)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+    def summary(self, elapsed, count_queries=True):
+        requests = len(self.latencies)
+        return OrderedDict([
+            ('requests', requests),
+            ('throughput', round(requests / elapsed, 2)),
+            ('error_rate', round(self.errors / requests, 4) if requests else 0.0),
+            ('rejected_rate', round(self.rejected / requests, 4) if requests else 0.0),
+            ('p50_ms', round(1000 * self.percentile(0.50), 1)),
+            ('p90_ms', round(1000 * self.percentile(0.90), 1)),
+            ('p99_ms', round(1000 * self.percentile(0.99), 1)),
+            ('max_ms', round(1000 * max(self.latencies or [0]), 1)),
+            ('queries_per_request', round(self.queries / requests, 2) if requests and count_queries else None),
+        ])
+
+
+def in_process_client(admission_control=True, remote_addr=None):
+    """ Fetch through the application in process, as the client at `remote_addr`
+
+    Without `admission_control` heavy_query lets every request in.
+    """
+    from .admission import EXEMPT_ENVIRON_KEY
+
+    client = app.test_client()
+    environ = {} if admission_control else {EXEMPT_ENVIRON_KEY: True}
+    if remote_addr is not None:
+        environ['REMOTE_ADDR'] = remote_addr
+
+    def fetch(path):
+        response = client.get(path, environ_base=environ)
+        response.get_data()  # Consume streamed bodies so their cost is measured too
+        return response.status_code
+    return fetch
+
+
+def remote_client(base_url):
+    def fetch(path):
+        try:
+            response = urllib2.urlopen(base_url.rstrip('/') + path)
+            response.read()
+            return response.getcode()
+        except urllib2.HTTPError as e:
+            return e.code
+    return fetch
+
+
+def replay_traffic(traffic, concurrency=8, base_url=None, admission_control=True):
+    """ Send `traffic` with `concurrency` closed-loop clients; {endpoint: stats} plus the total under 'all'
+
+    Without `base_url` requests go through the application in process, which also lets database
+    statements (those issued on the request thread) be counted per route. There each client has its
+    own address, so admission control limits it like a separate user (or, without
+    `admission_control`, not at all) instead of answering most heavy queries with 429.
+    """
+    counter = None if base_url else QueryCounter(db.get_engine(app))
+    pending = Queue.Queue()
+    for path in traffic:
+        pending.put(path)
+    stats = {}
+    lock = threading.Lock()
+
+    def worker(number):
+        if base_url:
+            fetch = remote_client(base_url)
+        else:
+            fetch = in_process_client(admission_control,
+                                      remote_addr='127.0.{0:d}.{1:d}'.format(number // 250, number % 250 + 1))
+        while True:
+            try:
+                path = pending.get_nowait()
+            except Queue.Empty:
+                return
+            if counter is not None:
+                counter.reset()
+            started = time.time()
+            try:
+                status = fetch(path)
+            except Exception:
+                status = None
+            seconds = time.time() - started
+            queries = counter.count if counter is not None else 0
+            with lock:
+                for route in (endpoint_for(path), 'all'):
+                    stats.setdefault(route, RouteStats()).add(seconds, status, queries)
+
+    started = time.time()
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = max(time.time() - started, 1e-9)
+    return OrderedDict((route, stats[route].summary(elapsed, count_queries=counter is not None))
+                       for route in sorted(stats, key=lambda route: (route == 'all', route)))
+
+
+def format_report(report):
+    lines = ["{0:32s} {1:>8s} {2:>8s} {3:>6s} {4:>6s} {5:>8s} {6:>8s} {7:>8s} {8:>8s} {9:>8s}".format(
+        'route', 'requests', 'req/s', 'err%', 'rej%', 'p50ms', 'p90ms', 'p99ms', 'maxms', 'queries')]
+    for route, row in report.items():
+        queries = '-' if row['queries_per_request'] is None else '{0:.1f}'.format(row['queries_per_request'])
+        lines.append("{0:32s} {1:8d} {2:8.1f} {3:6.1f} {4:6.1f} {5:8.1f} {6:8.1f} {7:8.1f} {8:8.1f} {9:>8s}".format(
+            route, row['requests'], row['throughput'], 100 * row['error_rate'], 100 * row['rejected_rate'],
+            row['p50_ms'], row['p90_ms'], row['p99_ms'], row['max_ms'], queries))
+    return '\n'.join(lines)
@@ -0,0 +1,65 @@
+""" Schema upgrades for databases created before tables and columns were added to the models
+
+Every Aggregator and Ligand query selects all mapped columns, so a column added to the models
+must exist before the first query of an upgraded application. Adding a nullable column without a
+default only touches the catalog in PostgreSQL (and reaches partition children through
+inheritance), so this runs on every start as well as from manage.py create_indexes; the values
+are backfilled separately (compute_depictions, compute_scaffolds). Tables added since are created
+empty, for manage.py cluster_aggregators and compute_conformers (or on demand embedding) to fill,
+and for partial progressive searches to keep their state in.
+"""
+from __future__ import absolute_import
+
+import logging
+
+from sqlalchemy import inspect
+
+from .core import db
+from .models import Aggregator, AggregatorCluster, AggregatorClusterMember, Conformer, Ligand, SearchContinuation
+
+
+log = logging.getLogger(__name__)
+
+ADDED_COLUMNS = ('depiction', 'scaffold', 'generic_scaffold', 'scaffold_hash', 'generic_scaffold_hash')
+ADDED_TABLES = (AggregatorCluster, AggregatorClusterMember, Conformer, SearchContinuation)  # In foreign key order
+
+
+def create_missing_tables(bind=None, models=ADDED_TABLES):
+    """ Create the tables of `models` that do not exist yet; [table] created """
+    bind = bind or db.engine
+    created = []
+    for model in models:
+        table = model.__table__
+        if not bind.has_table(table.name):
+            table.create(bind=bind)
+            created.append(table.name)
+    return created
+
+
+def add_missing_columns(bind=None, models=(Aggregator, Ligand), names=ADDED_COLUMNS):
+    """ Add mapped columns in `names` missing from existing tables; [(table, column)] added """
+    bind = bind or db.engine
+    inspector = inspect(bind)
+    added = []
+    for model in models:
+        table = model.__table__
+        if not bind.has_table(table.name):
+            continue  # create_all makes it with every column
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for name in names:
+            if name in existing:
+                continue
+            column = table.c[name]
+            bind.execute('ALTER TABLE {0} ADD COLUMN IF NOT EXISTS {1} {2}'.format(
+                table.name, column.name, column.type.compile(dialect=bind.dialect)))
+            added.append((table.name, column.name))
+    return added
+
+
+def upgrade_schema(bind=None):
+    """ Bring an existing database up to the models; [description] of each change made """
+    changes = ['created table {0}'.format(table) for table in create_missing_tables(bind)]
+    changes += ['added {0}.{1}'.format(table, column) for table, column in add_missing_columns(bind)]
+    for change in changes:
+        log.warning("Schema upgrade: %s", change)
+    return changes
@@ -1,21 +1,34 @@
 import datetime as dt
+import hashlib
+import struct
+from collections import OrderedDict
 from flask import current_app
+from rdkit import Chem as C
+from rdkit.Chem import rdDepictor
+from rdkit.Chem.Scaffolds import MurckoScaffold
 from sqlalchemy import (
+    and_,
+    BigInteger,
     cast,
     Column,
     Date,
     DateTime,
+    event,
     extract,
+    Float,
     ForeignKey,
     func,
     Index,
     Integer,
+    LargeBinary,
+    or_,
     String,
+    Text,
     text,
 )
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.ext.hybrid import Comparator, hybrid_property
 from rdalchemy import Mol
 from aggregatorcomparor import db
 
@@ -26,27 +39,176 @@ backref = db.backref
 relationship = db.relationship
 
 
+class FingerprintType(object):
+    """ A cartridge fingerprint function that gets its own functional GiST index on molecule tables """
+    def __init__(self, name, function, args=(), index_suffix=None):
+        self.name = name
+        self.function = function
+        self.args = tuple(args)
+        self.index_suffix = index_suffix or '{0}_fp_fn_idx'.format(name)
+
+    def __call__(self, structure):
+        return getattr(func, self.function)(structure, *self.args)
+
+    def popcount(self, structure):
+        return func.bfp_popcount(self(structure))
+
+    def index_name(self, tablename):
+        return '{0}_{1}'.format(tablename, self.index_suffix)
+
+    def popcount_index_name(self, tablename):
+        return '{0}_{1}'.format(tablename, self.index_suffix.replace('_fn_idx', '_popcount_idx'))
+
+
+class SimilarityMetric(object):
+    """ Cartridge operators for a bit vector similarity metric """
+    def __init__(self, name, operator, distance_operator, function, threshold_setting, popcount_bounds=None,
+                 popcount_similarity_bound=None):
+        self.name = name
+        self.operator = operator
+        self.distance_operator = distance_operator
+        self.function = function
+        self.threshold_setting = threshold_setting
+        self.popcount_bounds = popcount_bounds
+        self.popcount_similarity_bound = popcount_similarity_bound
+
+    def similar(self, haystack_fp, needle_fp):
+        return haystack_fp.op(self.operator)(needle_fp)
+
+    def nearest_neighbors(self, haystack_fp, needle_fp):
+        return haystack_fp.op(self.distance_operator)(needle_fp)
+
+    def similarity(self, fp1, fp2):
+        return getattr(func, self.function)(fp1, fp2)
+
+    def set_threshold(self, cutoff):
+        """ Query transformation setting the cartridge threshold for the current transaction """
+        def transform(query):
+            query.session.execute(func.set_config(self.threshold_setting, str(float(cutoff)), True).select())
+            return query
+        return transform
+
+
+FINGERPRINT_TYPES = OrderedDict()
+SIMILARITY_METRICS = OrderedDict()
+
+
+def register_fingerprint_type(name, function, args=(), index_suffix=None):
+    FINGERPRINT_TYPES[name] = FingerprintType(name, function, args=args, index_suffix=index_suffix)
+    return FINGERPRINT_TYPES[name]
+
+
+def register_similarity_metric(name, operator, distance_operator, function, threshold_setting,
+                               popcount_bounds=None, popcount_similarity_bound=None):
+    SIMILARITY_METRICS[name] = SimilarityMetric(name, operator, distance_operator, function, threshold_setting,
+                                                popcount_bounds=popcount_bounds,
+                                                popcount_similarity_bound=popcount_similarity_bound)
+    return SIMILARITY_METRICS[name]
+
+
+def tanimoto_popcount_bounds(count, cutoff):
+    # Tc(a, b) <= min(|a|, |b|) / max(|a|, |b|), so |b| must lie in [cutoff * |a|, |a| / cutoff]
+    return count * cutoff, count / cutoff
+
+
+def dice_popcount_bounds(count, cutoff):
+    # Dice(a, b) <= 2 * min(|a|, |b|) / (|a| + |b|)
+    return count * cutoff / (2 - cutoff), count * (2 - cutoff) / cutoff
+
+
+def tanimoto_similarity_bound(count, other_count):
+    """ Highest Tanimoto similarity possible between fingerprints with these bit counts """
+    return float(min(count, other_count)) / max(count, other_count) if max(count, other_count) else 1.0
+
+
+def dice_similarity_bound(count, other_count):
+    return 2.0 * min(count, other_count) / (count + other_count) if count + other_count else 1.0
+
+
+# Every registered type is indexed on each molecule table, so register before models are declared
+register_fingerprint_type('rdkit', 'rdkit_fp', index_suffix='fp_fn_idx')
+register_fingerprint_type('morgan', 'morganbv_fp', args=(2,))  # ECFP4
+register_fingerprint_type('featmorgan', 'featmorganbv_fp', args=(2,))  # FCFP4
+register_fingerprint_type('maccs', 'maccs_fp')
+
+register_similarity_metric('tanimoto', '%', '<%>', 'tanimoto_sml', 'rdkit.tanimoto_threshold',
+                           popcount_bounds=tanimoto_popcount_bounds,
+                           popcount_similarity_bound=tanimoto_similarity_bound)
+register_similarity_metric('dice', '#', '<#>', 'dice_sml', 'rdkit.dice_threshold',
+                           popcount_bounds=dice_popcount_bounds,
+                           popcount_similarity_bound=dice_similarity_bound)
+
+
 class MoleculeMixin(object):
     NAME_ATTRIBUTE = None
+    NAME_COLUMNS = ('name',)  # Columns format_name needs, for queries that skip full rows
+    INDEXED_COLUMNS = ()  # Extra (column, ...) B-tree indexes for lookups by plain columns
+    TABLE_OPTIONS = {}
     structure = Column('smiles', Mol, nullable=False)
+    # Pickled RDKit molecule carrying precomputed 2D coordinates, so rendering and
+    # MolBlock export never need to lay the molecule out again
+    depiction = Column('depiction', LargeBinary, nullable=True)
+    # Bemis-Murcko scaffold and its generic (all carbon, single bond) form as canonical SMILES, '' for
+    # acyclic molecules; lookups go through the 64 bit hashes, which keep the B-trees small
+    scaffold = Column('scaffold', String, nullable=True)
+    generic_scaffold = Column('generic_scaffold', String, nullable=True)
+    scaffold_hash = Column('scaffold_hash', BigInteger, nullable=True)
+    generic_scaffold_hash = Column('generic_scaffold_hash', BigInteger, nullable=True)
 
     @declared_attr
     def __table_args__(cls):
-        return (
-            # Create a GIST index for the RDKit chemical structure (sub/super structure)
-            Index('{}_structure_idx'.format(cls.__tablename__),
-                  cls.structure,
-                  postgresql_using='gist'),
-            # Create an index on the fingerprint function, instead of explicitly
-            # storing fingerprints
-            Index('{}_fp_fn_idx'.format(cls.__tablename__),
-                  cls.structure.rdkit_fp,
-                  postgresql_using='gist'),
-            # Store a functional index of the InChI key as a unique constraint for molecules since RDKit's mol object
-            # does not enforce uniqueness with stereochemistry
-            Index('{}_inchikey_fn_idx'.format(cls.__tablename__),
-                  cls.structure.inchikey),
-        )
+        # Create a GIST index for the RDKit chemical structure (sub/super structure)
+        indexes = [Index('{}_structure_idx'.format(cls.__tablename__),
+                         cls.structure,
+                         postgresql_using='gist')]
+        # Create an index on each fingerprint function, instead of explicitly
+        # storing fingerprints
+        for fp_type in FINGERPRINT_TYPES.values():
+            indexes.append(Index(fp_type.index_name(cls.__tablename__),
+                                 fp_type(cls.structure),
+                                 postgresql_using='gist'))
+            # B-tree on the bit count, used to prune candidates outside the popcount bounds of a cutoff
+            indexes.append(Index(fp_type.popcount_index_name(cls.__tablename__),
+                                 fp_type.popcount(cls.structure)))
+        # B-trees on descriptors used for range pre-filters
+        indexes.append(Index('{}_logp_fn_idx'.format(cls.__tablename__), cls.structure.logp))
+        indexes.append(Index('{}_mwt_fn_idx'.format(cls.__tablename__), cls.structure.mwt))
+        indexes.append(Index('{}_num_heavy_atoms_fn_idx'.format(cls.__tablename__), cls.structure.num_heavy_atoms))
+        # Store a functional index of the InChI key as a unique constraint for molecules since RDKit's mol object
+        # does not enforce uniqueness with stereochemistry
+        indexes.append(Index('{}_inchikey_fn_idx'.format(cls.__tablename__),
+                             cls.structure.inchikey))
+        indexes.append(Index('{}_scaffold_hash_idx'.format(cls.__tablename__), cls.scaffold_hash))
+        indexes.append(Index('{}_generic_scaffold_hash_idx'.format(cls.__tablename__), cls.generic_scaffold_hash))
+        for columns in cls.INDEXED_COLUMNS:
+            indexes.append(Index('{0}_{1}_idx'.format(cls.__tablename__, '_'.join(columns)),
+                                 *[getattr(cls, column) for column in columns]))
+        return tuple(indexes) + (dict(cls.TABLE_OPTIONS),)
+
+    @classmethod
+    def fingerprint(cls, fp_type='rdkit'):
+        """ Fingerprint expression matching the functional index for `fp_type` """
+        return FINGERPRINT_TYPES[fp_type](cls.structure)
+
+    @classmethod
+    def fingerprint_popcount(cls, fp_type='rdkit'):
+        return FINGERPRINT_TYPES[fp_type].popcount(cls.structure)
+
+    @classmethod
+    def scaffold_filter(cls, scaffold, generic=False):
+        """ Molecules sharing `scaffold` (canonical SMILES), probing the hash index and ruling out collisions """
+        if generic:
+            return and_(cls.generic_scaffold_hash == scaffold_hash(scaffold), cls.generic_scaffold == scaffold)
+        return and_(cls.scaffold_hash == scaffold_hash(scaffold), cls.scaffold == scaffold)
+
+    @classmethod
+    def partition_filter(cls, partition, partitions):
+        """ Matches the CHECK constraint on partition tables so the planner only scans one of them """
+        return cls.id.op('%')(partitions) == partition
+
+    @classmethod
+    def format_name(cls, name):
+        return name
 
     def _normalize_kwargs_structure(self, kwargs):
         raw_structure = kwargs.pop('smiles', kwargs.get('structure'))
@@ -103,7 +265,10 @@ class MoleculeMixin(object):
 
     @hybrid_property
     def mol(self):
-        mol = self.structure.as_mol
+        if self.depiction is not None:
+            mol = C.Mol(bytes(self.depiction))
+        else:
+            mol = self.structure.as_mol
         if self.NAME_ATTRIBUTE:
             name = str(getattr(self, self.NAME_ATTRIBUTE))
             mol.SetProp('_Name', name)
@@ -129,7 +294,9 @@ class MoleculeMixin(object):
 
         @inchikey.comparator
         def inchikey(cls):
-            return cls.structure.inchikey.collate('C')
+            # Must stay the exact expression (and collation) of the inchikey_fn_idx functional index,
+            # or lookups fall back to sequential scans; see queryplans
+            return cls.structure.inchikey
 
         return inchikey
 
@@ -155,11 +322,10 @@ class Aggregator(MoleculeMixin, Model):
     added = Column('added', DateTime, default=dt.datetime.now, server_default=text('NOW()'), nullable=False)
 
     NAME_ATTRIBUTE = 'name'
+    INDEXED_COLUMNS = (('name',),)
 
     def __init__(self, **kwargs):
-        raw_structure = kwargs.pop('smiles', kwargs.get('structure'))
-        if raw_structure is not None:
-            kwargs['structure'] = coerse_to_mol(raw_structure)
+        self._normalize_kwargs_structure(kwargs)
         super(Aggregator, self).__init__(**kwargs)
 
     def __repr__(self):
@@ -190,7 +356,7 @@ class Citation(Model):
                                lazy='dynamic',
                                backref=backref('citations',
                                                lazy='dynamic',
-                                               order_by=lambda: Citation.year))
+                                               order_by=lambda: Citation.published))
 
     @hybrid_property
     def year(self):
@@ -247,6 +413,74 @@ class AggregatorReport(Model):
                                    'citation_fk={0.citation_fk!r})>'.format(self)
 
 
+class AggregatorCluster(Model):
+    __tablename__ = 'aggregator_cluster'
+
+    id = Column('id', Integer, primary_key=True)
+    centroid_fk = Column('centroid_fk', ForeignKey(Aggregator.id, ondelete='CASCADE'), index=True, nullable=False)
+    method = Column('method', String, nullable=False)
+    fp_type = Column('fp_type', String, nullable=False)
+    cutoff = Column('cutoff', Float, nullable=False)
+    size = Column('size', Integer, nullable=False)
+
+    centroid = relationship(Aggregator, uselist=False)
+
+    def __repr__(self):
+        return "<AggregatorCluster(id={0.id!r}, centroid_fk={0.centroid_fk!r}, size={0.size!r})>".format(self)
+
+
+class AggregatorClusterMember(Model):
+    __tablename__ = 'aggregator_cluster_member'
+
+    aggregator_fk = Column('aggregator_fk', ForeignKey(Aggregator.id, ondelete='CASCADE'), primary_key=True)
+    cluster_fk = Column('cluster_fk', ForeignKey(AggregatorCluster.id, ondelete='CASCADE'), index=True,
+                        nullable=False)
+    centroid_similarity = Column('centroid_similarity', Float, nullable=False)
+
+    cluster = relationship(AggregatorCluster,
+                           uselist=False,
+                           backref=backref('members', lazy='dynamic', passive_deletes=True))
+    aggregator = relationship(Aggregator,
+                              uselist=False,
+                              backref=backref('cluster_membership', uselist=False, passive_deletes=True))
+
+    def __repr__(self):
+        return '<AggregatorClusterMember(aggregator_fk={0.aggregator_fk!r}, '\
+                                        'cluster_fk={0.cluster_fk!r})>'.format(self)
+
+
+class Conformer(Model):
+    """ Minimized 3D geometry (RDKit binary molecule with hydrogens) shared by every molecule with the InChIKey """
+    __tablename__ = 'conformer'
+
+    inchikey = Column('inchikey', String, primary_key=True)
+    mol_binary = Column('mol', LargeBinary, nullable=True)  # Null when the structure could not be embedded
+    energy = Column('energy', Float, nullable=True)
+    method = Column('method', String, nullable=True)  # Force field used to minimize
+    created = Column('created', DateTime, default=dt.datetime.now, server_default=text('NOW()'), nullable=False)
+
+    @property
+    def mol(self):
+        return C.Mol(bytes(self.mol_binary)) if self.mol_binary is not None else None
+
+    def __repr__(self):
+        return "<Conformer(inchikey={0.inchikey!r}, method={0.method!r}, energy={0.energy!r})>".format(self)
+
+
+class SearchContinuation(Model):
+    """ Scan position and running top-k of a partial progressive search, so its continuation token stays short """
+    __tablename__ = 'search_continuation'
+
+    key = Column('key', String, primary_key=True)
+    digest = Column('digest', String, nullable=False)  # progressive.search_digest of the search
+    state = Column('state', Text, nullable=False)  # JSON
+    created = Column('created', DateTime, default=dt.datetime.now, server_default=text('NOW()'), nullable=False,
+                     index=True)
+
+    def __repr__(self):
+        return "<SearchContinuation(key={0.key!r}, created={0.created!r})>".format(self)
+
+
 class Ligand(MoleculeMixin, Model):
 
     # TODO: Add lookup in ZINC API
@@ -259,17 +493,25 @@ class Ligand(MoleculeMixin, Model):
     structure = Column('smiles', Mol, nullable=True)  # Null can mean failure
 
     NAME_ATTRIBUTE = 'name'
+    NAME_COLUMNS = ('refcode', 'serial')
+    INDEXED_COLUMNS = (('refcode', 'serial'),)
+    # Rows may be routed to partition tables by an insert trigger that returns no row,
+    # so take ids from the sequence up front instead of relying on RETURNING
+    TABLE_OPTIONS = {'implicit_returning': False}
+
+    @classmethod
+    def parse_name(cls, name):
+        """ (refcode, serial) for a name as written by format_name; serial is None when omitted """
+        if '.' in name:
+            refcode, serial = name.split('.', 1)
+            return refcode, int(serial)
+        return name, None
 
     def _normalize_kwargs_name(self, kwargs):
         name = kwargs.pop('name', None)
         if not name:
             return kwargs
-        if '.' in name:
-            refcode, serial = name.split('.', 1)
-            serial = int(serial)
-        else:
-            refcode = name
-            serial = None
+        refcode, serial = self.parse_name(name)
         kwargs.setdefault('refcode', refcode)
         if serial is not None:
             kwargs.setdefault('serial', serial)
@@ -289,17 +531,21 @@ class Ligand(MoleculeMixin, Model):
         tpl = current_app.config.get("LIGAND_SOURCE_URL_TPL", '')
         return tpl.format(self)
 
+    @classmethod
+    def format_name(cls, refcode, serial):
+        if serial:
+            return u"{0}.{1:d}".format(refcode, serial)
+        else:
+            return u"{0}".format(refcode)
+
     @hybrid_property
     def name(self):
-        if self.serial:
-            return u"{0.refcode}.{0.serial:d}".format(self)
-        else:
-            return u"{0.refcode}".format(self)
+        return self.format_name(self.refcode, self.serial)
 
 
     @name.comparator
     def name(cls):
-        return func.concat(cls.refcode, '.', cls.serial)
+        return LigandNameComparator(cls)
 
     def __repr__(self):
         return "<Ligand(id={0.id!r}, refcode={0.refcode!r}, serial={0.serial!r}, smiles={0.smiles!r})>".format(
@@ -312,16 +558,83 @@ class Ligand(MoleculeMixin, Model):
         return str(unicode(self))
 
 
+class LigandNameComparator(Comparator):
+    """ Compares names against refcode and serial directly, so equality can use the (refcode, serial) index """
+    def __init__(self, cls):
+        super(LigandNameComparator, self).__init__(func.concat(cls.refcode, '.', cls.serial))
+        self.cls = cls
+
+    def __eq__(self, other):
+        if not isinstance(other, basestring):
+            return self.expression == other
+        try:
+            refcode, serial = self.cls.parse_name(other)
+        except ValueError:
+            return self.expression == other  # Not refcode.serial; matches nothing, as before
+        if serial:
+            return and_(self.cls.refcode == refcode, self.cls.serial == serial)
+        # format_name leaves out missing (and zero) serials
+        return and_(self.cls.refcode == refcode, or_(self.cls.serial == None, self.cls.serial == 0))
+
+    def in_(self, others):
+        return or_(*[self == other for other in others])
+
+
 def coerse_to_mol(data, template=MoleculeMixin.structure):
     """ Cast input to Mol element of same type as Aggregator.structure """
     return template.type.bind_expression(data)
 
 
-def smiles_line_to_molecule_extra(factory, line):
-    parts = line.split(None)
-    smiles, name, extra = parts[0], parts[1], parts[2:]
-    compound = factory(smiles=smiles, name=name)
-    return compound, extra
+def compute_depiction(structure):
+    """ Lay out a structure in 2D once and serialize it compactly with its coordinates """
+    if structure is None:
+        return None
+    try:
+        mol = coerse_to_mol(structure).as_mol
+    except Exception:
+        return None
+    if mol is None:
+        return None
+    depicted = C.Mol(mol)
+    rdDepictor.Compute2DCoords(depicted)
+    return depicted.ToBinary()
+
+
+def scaffold_hash(scaffold):
+    """ Signed 64 bit hash of a scaffold SMILES (fits BIGINT); None for the empty scaffold """
+    if not scaffold:
+        return None
+    return struct.unpack('>q', hashlib.sha1(scaffold.encode('utf-8')).digest()[:8])[0]
+
+
+def compute_scaffolds(mol):
+    """ (scaffold, generic scaffold) canonical SMILES for an RDKit molecule, ('', '') when it has no rings """
+    if mol is None:
+        return None, None
+    core = MurckoScaffold.GetScaffoldForMol(mol)
+    if core.GetNumAtoms() == 0:
+        return '', ''
+    generic = MurckoScaffold.MakeScaffoldGeneric(core)
+    return C.MolToSmiles(core, isomericSmiles=False), C.MolToSmiles(generic, isomericSmiles=False)
+
+
+def scaffold_columns(mol):
+    """ {column: value} for the scaffold columns of an RDKit molecule """
+    scaffold, generic = compute_scaffolds(mol)
+    return {
+        'scaffold': scaffold,
+        'generic_scaffold': generic,
+        'scaffold_hash': scaffold_hash(scaffold),
+        'generic_scaffold_hash': scaffold_hash(generic),
+    }
+
+
+def _update_derived_columns(target, value, oldvalue, initiator):
+    target.depiction = compute_depiction(value)
+    # Reuse the molecule the depiction was made from rather than parsing the structure again
+    mol = C.Mol(bytes(target.depiction)) if target.depiction is not None else None
+    for column, column_value in scaffold_columns(mol).items():
+        setattr(target, column, column_value)
 
 
 def ref_line_to_citation(line):
@@ -348,6 +661,11 @@ def ref_line_to_citation(line):
     return citation
 
 
+# Keep depictions and scaffolds in step with structures however they are assigned (loaders, admin forms)
+for _molecule_type in (Aggregator, Ligand):
+    event.listen(_molecule_type.structure, 'set', _update_derived_columns)
+
+
 def mol_from_agg_id(agg_id):
     return Aggregator.query.get_or_404(agg_id).mol
 
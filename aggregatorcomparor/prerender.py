@@ -0,0 +1,171 @@
+""" Static pre-rendering of pages that only change when the data does
+
+Every page is keyed by a digest of the rows it is rendered from; the manifest written next to the
+pages records those digests, so a later run renders only pages whose inputs changed and removes
+pages that no longer exist. Paths map to files the way a static host serves them: `/sources` is
+written to `sources/index.html` and `/aggregators/7.png` to `aggregators/7.png`.
+"""
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+
+from sqlalchemy import text
+
+from .core import app, db
+from .models import Aggregator, AggregatorReport, Citation, Ligand, func
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _digest(*parts):
+    return hashlib.md5(json.dumps(parts, sort_keys=True, default=str)).hexdigest()
+
+
+def ligand_generation():
+    """ [count, max id, checksum] of the ligands; any ligand change may alter an aggregator's similar ligands
+
+    Taken from the rows themselves (names and structures, across partitions) rather than statistics
+    counters, which are per server, reset with it and count rolled back writes. Reads every ligand
+    once, which is small next to rendering the pages.
+    """
+    row = db.session.execute(text(
+        "SELECT COUNT(*), COALESCE(MAX(id), 0), "
+        "COALESCE(SUM(hashtext(refcode || '.' || COALESCE(serial::text, '') || ' ' "
+        "|| COALESCE(mol_to_smiles(smiles)::text, ''))::bigint), 0) "
+        "FROM {0}".format(Ligand.__tablename__))).first()
+    return [int(value) for value in row]
+
+
+def page_digests(config=None):
+    """ {path: digest} for every pre-rendered page and image """
+    config = config or app.config
+    molecules_per_page = config.get('MOLECULES_DISPLAY_PER_PAGE', 30)
+    citations_per_page = config.get('CITATIONS_DISPLAY_PER_PAGE', 10)
+    ligands = ligand_generation()
+
+    aggregators = {}
+    scaffolds = {}
+    for molecule_id, name, smiles, depiction_md5, scaffold, generic_scaffold in db.session.query(
+            Aggregator.id, Aggregator.name, func.mol_to_smiles(Aggregator.structure), func.md5(Aggregator.depiction),
+            Aggregator.scaffold, Aggregator.generic_scaffold):
+        aggregators[molecule_id] = (name, smiles, depiction_md5)
+        scaffolds[molecule_id] = (scaffold, generic_scaffold)  # Detail pages link to both
+    reports = {}
+    citation_members = {}
+    for aggregator_fk, citation_fk in db.session.query(AggregatorReport.aggregator_fk, AggregatorReport.citation_fk):
+        reports.setdefault(aggregator_fk, []).append(citation_fk)
+        citation_members.setdefault(citation_fk, []).append(aggregator_fk)
+    citations = dict((citation.id, (citation.doi, citation.original_reference, citation.authors, citation.published))
+                     for citation in Citation.query)
+
+    digests = {}
+    urls = app.url_map.bind('localhost')
+    for molecule_id, row in aggregators.items():
+        cited = sorted(reports.get(molecule_id, ()))
+        digests[urls.build('aggregator_detail', {'agg_id': molecule_id})] = \
+            _digest(row, scaffolds[molecule_id], [citations.get(citation_id) for citation_id in cited], ligands)
+        digests[urls.build('aggregator_image', {'agg_id': molecule_id})] = _digest(row)
+
+    for citation_id, citation in citations.items():
+        members = sorted(citation_members.get(citation_id, ()))
+        pages = max(int(math.ceil(len(members) / molecules_per_page)), 1)
+        for page in range(1, pages + 1):
+            shown = members[(page - 1) * molecules_per_page:page * molecules_per_page]
+            digests[urls.build('browse_citation_aggregators', {'cite_id': citation_id, 'page': page})] = \
+                _digest(citation, [(member, aggregators.get(member)) for member in shown], len(members))
+
+    listing = _digest(sorted((citation_id, citation, len(citation_members.get(citation_id, ())))
+                             for citation_id, citation in citations.items()))
+    pages = max(int(math.ceil(len(citations) / citations_per_page)), 1)
+    for page in range(1, pages + 1):
+        digests[urls.build('browse_citations', {'page': page})] = listing
+    return digests
+
+
+def path_to_file(path):
+    path = path.lstrip('/')
+    if not path or path.endswith('/'):
+        return path + 'index.html'
+    if os.path.splitext(path)[1] in ('.png', '.svg', '.json'):
+        return path
+    return path + '/index.html'
+
+
+def read_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'generation': None, 'pages': {}}
+
+
+# Per worker process state, set by the pool initializer
+_worker = {}
+
+
+def _init_worker(output):
+    _worker['output'] = output
+    _worker['client'] = app.test_client()
+
+
+def _render(path):
+    response = _worker['client'].get(path)
+    if response.status_code != 200:
+        return path, response.status_code
+    target = os.path.join(_worker['output'], path_to_file(path))
+    if not os.path.isdir(os.path.dirname(target)):
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            pass  # Created by another worker meanwhile
+    with open(target + '.tmp', 'wb') as f:
+        f.write(response.get_data())
+    os.rename(target + '.tmp', target)
+    return path, response.status_code
+
+
+def prerender(output, processes=None, force=False):
+    """ Render changed pages into `output` across processes; returns (rendered, removed, failures) """
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    manifest = read_manifest(output)
+    digests = page_digests()
+    previous = manifest.get('pages', {})
+    stale = sorted(path for path, digest in digests.items()
+                   if force or previous.get(path, {}).get('digest') != digest)
+    removed = sorted(path for path in previous if path not in digests)
+
+    # Connections must not be shared with forked workers
+    db.session.remove()
+    db.get_engine(app).dispose()
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(output,))
+    failures = {}
+    try:
+        for path, status in pool.imap_unordered(_render, stale, chunksize=16):
+            if status != 200:
+                failures[path] = status
+    finally:
+        pool.close()
+        pool.join()
+
+    for path in removed:
+        try:
+            os.remove(os.path.join(output, path_to_file(path)))
+        except OSError:
+            pass
+
+    pages = dict((path, {'digest': digest, 'file': path_to_file(path)})
+                 for path, digest in digests.items() if path not in failures)
+    manifest = {
+        'generation': _digest(sorted(digests.items())),
+        'pages': pages,
+    }
+    with open(os.path.join(output, MANIFEST_NAME + '.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(os.path.join(output, MANIFEST_NAME + '.tmp'), os.path.join(output, MANIFEST_NAME))
+    return len(stale) - len(failures), len(removed), failures
@@ -0,0 +1,108 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import sys
+import time
+
+
+class LoadProgress(object):
+    """ Rate-limited progress and metrics reporting for the data loaders
+
+    Status lines (rows/sec, rejects, ETA) are written at most once per `interval` seconds,
+    rejected input goes to an optional tab-separated reject file (line, reason, input) and
+    `summary()` gives a machine-readable account of the whole load.
+    """
+    def __init__(self, label, total_bytes=None, interval=2.0, stream=sys.stderr, rejects=None, clock=time.time):
+        self.label = label
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.stream = stream
+        self.clock = clock
+        self.started = self.last_report = clock()
+        self.rows = 0
+        self.added = 0
+        self.rejected = 0
+        self.bytes_read = 0
+        self.reasons = {}
+        self._rejects = open(rejects, 'a') if rejects else None
+        self.rejects_path = rejects
+
+    @classmethod
+    def for_file(cls, label, path, **kwargs):
+        try:
+            total_bytes = os.path.getsize(path)
+        except (OSError, TypeError):
+            total_bytes = None
+        return cls(label, total_bytes=total_bytes, **kwargs)
+
+    def add(self, nbytes=0):
+        self.rows += 1
+        self.added += 1
+        self.bytes_read += nbytes
+        self.tick()
+
+    def reject(self, line_number, reason, line=None, nbytes=0):
+        self.rows += 1
+        self.rejected += 1
+        self.bytes_read += nbytes
+        reason = str(reason)
+        kind = reason.split(':', 1)[0]
+        self.reasons[kind] = self.reasons.get(kind, 0) + 1
+        if self._rejects is not None:
+            raw = (line or '').rstrip('\r\n').replace('\t', ' ')
+            self._rejects.write("{0}\t{1}\t{2}\n".format(line_number, reason.replace('\t', ' '), raw))
+        self.tick()
+
+    def tick(self):
+        now = self.clock()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    @property
+    def elapsed(self):
+        return max(self.clock() - self.started, 1e-9)
+
+    @property
+    def rate(self):
+        return self.rows / self.elapsed
+
+    @property
+    def eta(self):
+        if not self.total_bytes or not self.bytes_read:
+            return None
+        remaining = max(self.total_bytes - self.bytes_read, 0)
+        return remaining * self.elapsed / self.bytes_read
+
+    def report(self, final=False):
+        eta = self.eta
+        status = "\r{0}: {1:d} rows ({2:d} added, {3:d} rejected) {4:.0f} rows/s".format(
+            self.label, self.rows, self.added, self.rejected, self.rate)
+        if eta is not None and not final:
+            status += " ETA {0:.0f}s".format(eta)
+        print(status, end='\n' if final else '', file=self.stream)
+        self.stream.flush()
+
+    def summary(self):
+        return {
+            'label': self.label,
+            'rows': self.rows,
+            'added': self.added,
+            'rejected': self.rejected,
+            'reject_reasons': self.reasons,
+            'rejects_file': self.rejects_path,
+            'seconds': round(self.elapsed, 3),
+            'rows_per_second': round(self.rate, 1),
+        }
+
+    def finish(self, summary_path=None):
+        self.report(final=True)
+        if self._rejects is not None:
+            self._rejects.close()
+            self._rejects = None
+        summary = self.summary()
+        if summary_path:
+            with open(summary_path, 'a') as f:
+                f.write(json.dumps(summary, sort_keys=True) + '\n')
+        return summary
@@ -0,0 +1,229 @@
+""" Time-budgeted similarity search that returns the best results found so far
+
+The popcount window implied by the cutoff is scanned in chunks of PROGRESSIVE_SEARCH_BAND_WIDTH
+bit counts, most promising first: a molecule whose fingerprint has |b| bits can score at most
+bound(|a|, |b|) against a query with |a| bits, so chunks are ordered by that bound and the scan
+stops, with an exact answer, as soon as the running top-k can no longer be beaten. When the budget
+runs out first the top-k found so far is returned as partial, with a signed continuation token;
+the scan position and the running top-k (up to MOLECULE_SEARCH_MAX_RESULT_LIMIT rows) stay in the
+search_continuation table under the token's short key, so the token fits in a URL. Sent back with
+the same search arguments it resumes the scan where it stopped.
+
+A chunk cut off by the budget is not retried whole: its popcounts are halved, and a single
+popcount is split into id windows that halve in turn, so every continuation either advances the
+position or leaves less work to the next one, down to windows small enough for any budget.
+"""
+from __future__ import absolute_import, division
+
+import binascii
+import datetime as dt
+import hashlib
+import heapq
+import json
+import math
+import os
+import time
+from collections import namedtuple
+
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import and_, text
+from sqlalchemy.exc import DBAPIError
+
+from .core import app, db
+from .models import FINGERPRINT_TYPES, SIMILARITY_METRICS, SearchContinuation, func
+
+
+QUERY_CANCELED = '57014'  # SQLSTATE of a statement cut off by statement_timeout
+
+Band = namedtuple('Band', 'popcounts bound')
+# The band, its popcounts already scanned, popcounts per chunk (None: the rest of the band) and, for a
+# single popcount split by id, [next id, ids per window, last id]
+ScanPosition = namedtuple('ScanPosition', 'band offset width ids')
+ProgressiveResult = namedtuple('ProgressiveResult', 'results partial continuation bands_scanned bands_total elapsed')
+
+
+class InvalidContinuation(ValueError):
+    pass
+
+
+def popcount_bands(count, low, high, width, bound):
+    """ [Band, ...] covering popcounts low..high, each `width` counts wide, in decreasing order of best score """
+    popcounts = sorted(range(low, high + 1), key=lambda other: (-bound(count, other), abs(other - count), other))
+    return [Band(popcounts[start:start + width], bound(count, popcounts[start]))
+            for start in range(0, len(popcounts), width)]
+
+
+def search_bands(result_type, params, config=None):
+    """ Bands for the search in `params`; [Band(None, 1.0)] (one unrestricted chunk) for metrics without bounds """
+    config = config or app.config
+    metric = SIMILARITY_METRICS[params.get('metric', 'tanimoto')]
+    cutoff = params.get('cutoff')
+    if not cutoff or metric.popcount_bounds is None or metric.popcount_similarity_bound is None:
+        return [Band(None, 1.0)]
+    needle_fp = FINGERPRINT_TYPES[params.get('fp', 'rdkit')](params['query'].bind)
+    count = db.session.query(func.bfp_popcount(needle_fp)).scalar() or 0
+    low, high = metric.popcount_bounds(count, cutoff)
+    return popcount_bands(count, int(math.ceil(low)), int(math.floor(high)),
+                          config.get('PROGRESSIVE_SEARCH_BAND_WIDTH', 32), metric.popcount_similarity_bound)
+
+
+def search_digest(result_type, params, config=None):
+    """ Identifies a search, so a continuation token is only accepted for the search it was issued for """
+    config = config or app.config
+    search = [result_type.__tablename__, params.get('input_format'), params.get('raw'), params.get('cutoff'),
+              params.get('limit'), params.get('fp'), params.get('metric'),
+              sorted((params.get('descriptors') or {}).items()), config.get('PROGRESSIVE_SEARCH_BAND_WIDTH', 32)]
+    return hashlib.md5(json.dumps(search, default=str)).hexdigest()
+
+
+def _serializer(config):
+    return URLSafeSerializer(config['SECRET_KEY'], salt='progressive-search')
+
+
+START = ScanPosition(0, 0, None, None)
+
+
+def _store_state(key, digest, state, config):
+    table = SearchContinuation.__table__
+    expired = dt.datetime.now() - dt.timedelta(seconds=config.get('PROGRESSIVE_SEARCH_CONTINUATION_TTL', 3600))
+    # Its own transaction: the request's session only ever reads
+    with db.get_engine(app).begin() as connection:
+        connection.execute(table.delete().where(table.c.created < expired))
+        connection.execute(table.insert(), key=key, digest=digest, state=json.dumps(state))
+
+
+def _fetch_state(key, digest, config):
+    """ The stored state for `key`, or None once it has expired """
+    ttl = config.get('PROGRESSIVE_SEARCH_CONTINUATION_TTL', 3600)
+    stored = db.session.query(SearchContinuation.state)\
+                       .filter(SearchContinuation.key == key,
+                               SearchContinuation.digest == digest,
+                               SearchContinuation.created >= dt.datetime.now() - dt.timedelta(seconds=ttl))\
+                       .scalar()
+    return json.loads(stored) if stored is not None else None
+
+
+def dump_continuation(digest, position, top, config=None):
+    """ Token for resuming at `position` with the running `top`, which are kept server side """
+    config = config or app.config
+    key = binascii.hexlify(os.urandom(12)).decode('ascii')
+    _store_state(key, digest, {'at': list(position), 'top': top}, config)
+    return _serializer(config).dumps({'q': digest, 'k': key})
+
+
+def load_continuation(token, digest, config=None):
+    """ (ScanPosition, [(score, id), ...]) from a token; raises InvalidContinuation if forged, for another search
+    or expired
+    """
+    config = config or app.config
+    try:
+        claims = _serializer(config).loads(token)
+    except BadSignature:
+        raise InvalidContinuation("Continuation token is invalid")
+    if claims.get('q') != digest:
+        raise InvalidContinuation("Continuation token belongs to a different search")
+    state = _fetch_state(claims['k'], digest, config)
+    if state is None:
+        raise InvalidContinuation("Continuation token has expired; start the search again")
+    return ScanPosition(*state['at']), [tuple(entry) for entry in state['top']]
+
+
+def _chunk(band, position):
+    """ Popcounts (None: any) the next scan at `position` covers """
+    if band.popcounts is None:
+        return None
+    rest = band.popcounts[position.offset:]
+    return rest[:position.width] if position.width else rest
+
+
+def _advance(bands, position, chunk):
+    """ Position after scanning `chunk` at `position` completed """
+    if position.ids is not None:
+        first, span, last = position.ids
+        if first + span <= last:
+            return position._replace(ids=[first + span, span * 2, last])  # The window fit the budget; try a wider one
+    offset = position.offset + (len(chunk) if chunk is not None else 0)
+    band = bands[position.band]
+    if band.popcounts is None or offset >= len(band.popcounts):
+        return ScanPosition(position.band + 1, 0, None, None)
+    return position._replace(offset=offset, ids=None)
+
+
+def _narrow(result_type, position, chunk):
+    """ Position whose next scan is half of the `chunk` that ran out of time at `position` """
+    if chunk is not None and len(chunk) > 1:
+        return position._replace(width=int(math.ceil(len(chunk) / 2)))
+    if position.ids is None:
+        first, last = db.session.query(func.min(result_type.id), func.max(result_type.id)).one()
+        first, last = first or 0, last or 0
+        return position._replace(width=1, ids=[first, max((last - first + 1) // 2, 1), last])
+    first, span, last = position.ids
+    return position._replace(ids=[first, max(span // 2, 1), last])
+
+
+def _scan_band(result_type, params, popcounts, ids, limit, timeout):
+    """ [(score, id), ...] of the best `limit` matches with `popcounts` (None: any) and ids in the window of an
+    `ids` [next id, span, last id] (None: any), cancelled by the server after `timeout` seconds
+    """
+    from .helpers import run_similar_molecules_query  # helpers imports the drawing code's dependencies
+
+    chunk = dict(params, popcounts=popcounts, limit=limit)
+    if popcounts is not None:
+        chunk['popcount_bounds'] = False  # Already within the bounds; the list is the only popcount filter needed
+    if ids is not None:
+        first, span, _last = ids
+        chunk['candidates'] = and_(result_type.id >= first, result_type.id < first + span)
+    with run_similar_molecules_query(result_type, chunk) as query:
+        db.session.execute(text("SELECT set_config('statement_timeout', :timeout, true)"),
+                           {'timeout': str(max(int(timeout * 1000), 1))})
+        return [(score, molecule.id) for molecule, score in query]
+
+
+def progressive_similar_molecules(result_type, params, budget, continuation=None, config=None):
+    """ ProgressiveResult of (molecule, score) rows, best first, found within `budget` seconds
+
+    `continuation` is a token from an earlier partial result for the same search; the search
+    resumes from the position where that one stopped.
+    """
+    config = config or app.config
+    started = time.time()
+    deadline = started + budget
+    limit = params.get('limit') or config.get('MOLECULE_SEARCH_MAX_RESULT_LIMIT', 1000)
+    digest = search_digest(result_type, params, config=config)
+    position, top = START, []
+    if continuation:
+        position, top = load_continuation(continuation, digest, config=config)
+
+    bands = search_bands(result_type, params, config=config)
+    partial = False
+    while position.band < len(bands):
+        band = bands[position.band]
+        if len(top) >= limit and top[-1][0] >= band.bound:
+            position = START._replace(band=len(bands))  # No later band can place a molecule in the top `limit`
+            break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            partial = True
+            break
+        chunk = _chunk(band, position)
+        try:
+            found = _scan_band(result_type, params, chunk, position.ids, limit, remaining)
+        except DBAPIError as e:
+            if getattr(e.orig, 'pgcode', None) != QUERY_CANCELED:
+                raise
+            db.session.rollback()
+            position = _narrow(result_type, position, chunk)  # The work done is lost, so do less next time
+            partial = True
+            break
+        top = heapq.nlargest(limit, set(top) | set(found), key=lambda entry: (entry[0], -entry[1]))
+        position = _advance(bands, position, chunk)
+    db.session.rollback()  # Ends the transaction holding the threshold and timeout settings
+
+    molecules = {}
+    if top:
+        ids = [molecule_id for _score, molecule_id in top]
+        molecules = dict((molecule.id, molecule) for molecule in result_type.query.filter(result_type.id.in_(ids)))
+    # Rows deleted meanwhile drop out
+    results = [(molecules[molecule_id], score) for score, molecule_id in top if molecule_id in molecules]
+    token = dump_continuation(digest, position, [list(entry) for entry in top], config=config) if partial else None
+    return ProgressiveResult(results, partial, token, position.band, len(bands), time.time() - started)
@@ -0,0 +1,247 @@
+""" Query plan guard for the hot query shapes
+
+Each check builds one of the queries the application runs on every request (similarity searches,
+InChIKey and name lookups) with sample parameters and asks PostgreSQL for its plan. A shape passes
+when, with sequential scans disabled, the planner can answer it from an index on its table: an
+expression that no longer matches its functional index (a different collation, a wrapping function)
+still plans as a sequential scan then. The plan as chosen under normal settings is captured next to
+it, with EXPLAIN (ANALYZE, BUFFERS) where asked for, for the admin page and manage.py check_query_plans.
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import logging
+import re
+from collections import namedtuple
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from .core import app, db
+from .models import Aggregator, Ligand, coerse_to_mol
+
+
+log = logging.getLogger(__name__)
+
+SAMPLE_SMILES = 'O=C(O)c1ccccc1O'  # Used when the tables are empty
+SAMPLE_LIGAND_NAME = 'ABACAA.1'
+
+INDEX_NODES = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+
+PlanSample = namedtuple('PlanSample', 'mol inchikey aggregator_name ligand_name')
+PlanCheck = namedtuple('PlanCheck', 'name description table build')
+
+
+class QueryPlanError(RuntimeError):
+    pass
+
+
+class Explain(Executable, ClauseElement):
+    def __init__(self, statement, analyze=False):
+        self.statement = statement
+        self.analyze = analyze
+
+
+@compiles(Explain, 'postgresql')
+def _compile_explain(element, compiler, **kwargs):
+    options = 'ANALYZE, BUFFERS, FORMAT JSON' if element.analyze else 'FORMAT JSON'
+    return 'EXPLAIN ({0}) {1}'.format(options, compiler.process(element.statement, **kwargs))
+
+
+def explain(query, analyze=False):
+    """ Root node of the JSON plan for an ORM query, run in the query's own session and transaction """
+    plan = query.session.execute(Explain(query.statement, analyze=analyze)).scalar()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', ()):
+        for descendant in plan_nodes(child):
+            yield descendant
+
+
+def _on_table(node, table):
+    # Partition children of csdcompound are named csdcompound_p<N>
+    relation = node.get('Relation Name')
+    return relation is not None and (relation == table or relation.startswith(table + '_p'))
+
+
+def _is_table_index(name, table):
+    # Bitmap index scans carry no relation, so go by name: one of the indexes declared on the table
+    # (or its primary key), possibly copied to a partition as csdcompound_p<N>_..., and not the
+    # index of another table sharing the prefix (aggregator_cluster_...)
+    declared = db.metadata.tables.get(table)
+    if declared is None:
+        return False
+    suffixes = set(index.name[len(table):] for index in declared.indexes if index.name.startswith(table + '_'))
+    suffixes.add('_pkey')
+    match = re.match(r'{0}(_p\d+)?(_.+)$'.format(re.escape(table)), name)
+    return match is not None and match.group(2) in suffixes
+
+
+def index_names(plan, table):
+    """ Indexes on `table` (or its partitions) read by `plan` """
+    names = set()
+    for node in plan_nodes(plan['Plan']):
+        if node['Node Type'] not in INDEX_NODES:
+            continue
+        if _on_table(node, table) or _is_table_index(node['Index Name'], table):
+            names.add(node['Index Name'])
+    return sorted(names)
+
+
+def sequential_scans(plan, table):
+    return [node['Relation Name'] for node in plan_nodes(plan['Plan'])
+            if node['Node Type'] == 'Seq Scan' and _on_table(node, table)]
+
+
+def format_plan(node, depth=0):
+    """ Indented one line per node summary, like EXPLAIN's text format """
+    parts = [node['Node Type']]
+    if node.get('Index Name'):
+        parts.append('using {0}'.format(node['Index Name']))
+    if node.get('Relation Name'):
+        parts.append('on {0}'.format(node['Relation Name']))
+    parts.append('(cost={0:.2f}..{1:.2f} rows={2:d})'.format(node['Startup Cost'], node['Total Cost'],
+                                                             node['Plan Rows']))
+    if 'Actual Total Time' in node:
+        parts.append('(actual time={0:.3f}..{1:.3f} rows={2:d} loops={3:d})'.format(
+            node['Actual Startup Time'], node['Actual Total Time'], node['Actual Rows'], node['Actual Loops']))
+    if 'Shared Hit Blocks' in node:
+        parts.append('buffers: hit={0:d} read={1:d}'.format(node['Shared Hit Blocks'], node['Shared Read Blocks']))
+    lines = ['{0}{1}{2}'.format('  ' * depth, '-> ' if depth else '', ' '.join(parts))]
+    for condition in ('Index Cond', 'Recheck Cond', 'Filter'):
+        if condition in node:
+            lines.append('{0}      {1}: {2}'.format('  ' * depth, condition, node[condition]))
+    for child in node.get('Plans', ()):
+        lines.extend(format_plan(child, depth + 1))
+    return lines
+
+
+def sample_parameters():
+    """ Real values where the tables have them, so the plans see realistic selectivity """
+    aggregator = db.session.query(Aggregator.structure, Aggregator.structure.inchikey, Aggregator.name)\
+                           .filter(Aggregator.structure != None).first()
+    ligand = db.session.query(Ligand.refcode, Ligand.serial).first()
+    db.session.rollback()
+    if aggregator is None:
+        mol = coerse_to_mol(SAMPLE_SMILES)
+        aggregator = (SAMPLE_SMILES, mol.inchikey, 'Sample')
+    return PlanSample(mol=coerse_to_mol(aggregator[0]),
+                      inchikey=aggregator[1],
+                      aggregator_name=aggregator[2],
+                      ligand_name=Ligand.format_name(*ligand) if ligand is not None else SAMPLE_LIGAND_NAME)
+
+
+def _similarity_check(model, descriptors=None, popcounts=None):
+    def build(sample):
+        from .helpers import run_similar_molecules_query  # helpers imports the drawing code's dependencies
+        params = {
+            'query': sample.mol,
+            'cutoff': app.config.get('AGGREGATOR_SIMILARITY_TANIMOTO_CUTOFF', 0.7),
+            'limit': 50,
+            'fp': app.config.get('MOLECULE_SEARCH_FINGERPRINT', 'rdkit'),
+            'metric': app.config.get('MOLECULE_SEARCH_METRIC', 'tanimoto'),
+            'descriptors': descriptors,
+        }
+        if popcounts is not None:
+            params.update(popcounts=popcounts, popcount_bounds=False)
+        with run_similar_molecules_query(model, params) as similar:
+            return similar
+    return build
+
+
+PLAN_CHECKS = (
+    PlanCheck('aggregator_similarity', "run_similar_molecules_query on aggregators", 'aggregator',
+              _similarity_check(Aggregator)),
+    PlanCheck('aggregator_similarity_descriptors', "Aggregator similarity with a logP window", 'aggregator',
+              _similarity_check(Aggregator, descriptors={'logp': (None, 5.0)})),
+    PlanCheck('ligand_similarity', "run_similar_molecules_query on ligands", 'csdcompound',
+              _similarity_check(Ligand)),
+    PlanCheck('ligand_similarity_band', "One popcount band of a progressive ligand search", 'csdcompound',
+              _similarity_check(Ligand, popcounts=list(range(100, 132)))),
+    PlanCheck('aggregator_inchikey', "Aggregator.inchikey == key", 'aggregator',
+              lambda sample: Aggregator.query.filter(Aggregator.inchikey == sample.inchikey)),
+    PlanCheck('ligand_inchikey', "Ligand.inchikey == key", 'csdcompound',
+              lambda sample: Ligand.query.filter(Ligand.inchikey == sample.inchikey)),
+    PlanCheck('ligand_name', "Ligand.name == refcode.serial", 'csdcompound',
+              lambda sample: Ligand.query.filter(Ligand.name == sample.ligand_name)),
+    PlanCheck('aggregator_name', "Aggregator.name == name", 'aggregator',
+              lambda sample: Aggregator.query.filter(Aggregator.name == sample.aggregator_name)),
+    PlanCheck('aggregator_scaffold', "Aggregator.scaffold_filter(scaffold)", 'aggregator',
+              lambda sample: Aggregator.query.filter(Aggregator.scaffold_filter('c1ccccc1'))),
+)
+
+
+class PlanReport(object):
+    def __init__(self, check, indexes=(), sequential=(), plan=None, error=None):
+        self.name = check.name
+        self.description = check.description
+        self.table = check.table
+        self.indexes = list(indexes)
+        self.sequential = list(sequential)
+        self.plan = plan
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None and bool(self.indexes) and not self.sequential
+
+    @property
+    def problem(self):
+        if self.error is not None:
+            return "could not be planned: {0}".format(self.error)
+        if self.sequential:
+            return "sequential scan on {0} even with sequential scans disabled".format(', '.join(self.sequential))
+        if not self.indexes:
+            return "no index on {0} is used".format(self.table)
+        return None
+
+    @property
+    def plan_text(self):
+        return '\n'.join(format_plan(self.plan['Plan'])) if self.plan is not None else ''
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'description': self.description,
+            'ok': self.ok,
+            'problem': self.problem,
+            'indexes': self.indexes,
+            'plan': self.plan,
+        }
+
+
+def check_query_plans(analyze=True, checks=PLAN_CHECKS):
+    """ [PlanReport, ...] for `checks`; every check runs in a transaction of its own that is rolled back """
+    sample = sample_parameters()
+    reports = []
+    for check in checks:
+        try:
+            query = check.build(sample)
+            db.session.execute("SET LOCAL enable_seqscan = off")
+            forced = explain(query)
+            db.session.execute("SET LOCAL enable_seqscan = on")
+            reports.append(PlanReport(check,
+                                      indexes=index_names(forced, check.table),
+                                      sequential=sequential_scans(forced, check.table),
+                                      plan=explain(query, analyze=analyze)))
+        except Exception as e:
+            reports.append(PlanReport(check, error=e))
+        finally:
+            db.session.rollback()
+    return reports
+
+
+def guard_query_plans(strict=False):
+    """ Log every hot query shape that cannot use its index; with `strict`, raise QueryPlanError instead """
+    failing = [report for report in check_query_plans(analyze=False) if not report.ok]
+    for report in failing:
+        log.warning("Query plan check %s (%s): %s", report.name, report.description, report.problem)
+    if failing and strict:
+        raise QueryPlanError("{0:d} query shape(s) cannot use their indexes: {1}".format(
+            len(failing), ', '.join(report.name for report in failing)))
+    return failing
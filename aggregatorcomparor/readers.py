@@ -0,0 +1,212 @@
+from __future__ import absolute_import
+
+import bz2
+import itertools
+import os
+import Queue
+import threading
+import zlib
+from collections import namedtuple
+
+from rdkit import Chem as C
+
+
+COMPRESSION_MAGIC = (
+    ('\x1f\x8b', 'gzip'),
+    ('BZh', 'bz2'),
+    ('\xfd7zXZ\x00', 'xz'),
+)
+COMPRESSION_EXTENSIONS = ('.gz', '.bz2', '.xz')
+SDF_EXTENSIONS = ('.sdf', '.sd', '.mol')
+
+InputRecord = namedtuple('InputRecord', 'number smiles name extra text position error')
+
+
+def _xz_decompressor():
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ValueError("Reading xz input requires the backports.lzma package")
+    return lzma.LZMADecompressor()
+
+
+DECOMPRESSORS = {
+    'gzip': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'bz2': bz2.BZ2Decompressor,
+    'xz': _xz_decompressor,
+}
+
+
+class DecompressingReader(object):
+    """ Forward-only file-like view of a compressed file, decompressed a chunk at a time
+
+    Concatenated streams (as written by pigz, pbzip2 or `cat a.gz b.gz`) are read through.
+    `position` is the offset in the compressed file, which is what progress should be measured in.
+    """
+    def __init__(self, raw, compression, chunk_size=1 << 20):
+        self.raw = raw
+        self.factory = DECOMPRESSORS[compression]
+        self.chunk_size = chunk_size
+        self._decompressor = self.factory()
+        self._buffer = ''
+        self._eof = False
+
+    @property
+    def position(self):
+        return self.raw.tell()
+
+    def _fill(self):
+        chunk = self.raw.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return
+        pieces = []
+        while chunk:
+            pieces.append(self._decompressor.decompress(chunk))
+            chunk = self._decompressor.unused_data
+            if chunk:  # Another stream follows the one that just ended
+                self._decompressor = self.factory()
+        self._buffer += ''.join(pieces)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self):
+        while not self._eof and '\n' not in self._buffer:
+            self._fill()
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def detect_compression(path):
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def detect_format(path):
+    base = path
+    while os.path.splitext(base)[1].lower() in COMPRESSION_EXTENSIONS:
+        base = os.path.splitext(base)[0]
+    return 'sdf' if os.path.splitext(base)[1].lower() in SDF_EXTENSIONS else 'smiles'
+
+
+def open_input(path):
+    """ Open plain, gzip, bz2 or xz input (detected from its content) for streaming reads """
+    compression = detect_compression(path)
+    raw = open(path, 'rb')
+    if compression is None:
+        return raw
+    return DecompressingReader(raw, compression)
+
+
+def smiles_records(stream, position):
+    """ Whitespace separated SMILES lines: structure, then an optional name and extra fields """
+    for number, line in enumerate(stream, start=1):
+        parts = line.split(None)
+        if not parts:
+            yield InputRecord(number, None, None, [], line, position(line), "parse error: empty line")
+            continue
+        name = parts[1] if len(parts) > 1 else None
+        yield InputRecord(number, parts[0], name, parts[2:], line, position(line), None)
+
+
+def sdf_records(stream, position, name_property='_Name', extra_properties=()):
+    """ Forward-only SDF reading; names and extra fields are taken from the given properties """
+    supplier = C.ForwardSDMolSupplier(stream)
+    for number, mol in enumerate(supplier, start=1):
+        if mol is None:
+            yield InputRecord(number, None, None, [], "record {0:d}".format(number), position(None),
+                              "invalid structure")
+            continue
+        name = mol.GetProp(name_property) if mol.HasProp(name_property) else None
+        extra = [mol.GetProp(prop) if mol.HasProp(prop) else None for prop in extra_properties]
+        smiles = C.MolToSmiles(mol, isomericSmiles=True)
+        yield InputRecord(number, smiles, name or None, extra, name or "record {0:d}".format(number),
+                          position(None), None)
+
+
+def read_molecules(path, format=None, name_property=None, extra_properties=()):
+    """ Stream InputRecords from a SMILES or SDF file, compressed or not, without reading it all into memory """
+    format = format or detect_format(path)
+    stream = open_input(path)
+    if isinstance(stream, DecompressingReader):
+        position = lambda line: stream.position
+    elif format == 'sdf':
+        position = lambda line: stream.tell()
+    else:
+        consumed = [0]
+
+        def position(line):
+            consumed[0] += len(line)
+            return consumed[0]
+    try:
+        if format == 'sdf':
+            records = sdf_records(stream, position, name_property=name_property or '_Name',
+                                  extra_properties=extra_properties)
+        elif format == 'smiles':
+            records = smiles_records(stream, position)
+        else:
+            raise ValueError("Unknown input format {0!r} (expected smiles or sdf)".format(format))
+        for record in records:
+            yield record
+    finally:
+        stream.close()
+
+
+def prefetch(iterable, batch_size=1000, depth=4):
+    """ Consume `iterable` on a background thread, handing over batches through a bounded queue
+
+    Used to overlap reading, decompression and parsing with database writes; at most `depth`
+    batches are buffered so memory stays bounded however large the input is.
+    """
+    batches = Queue.Queue(maxsize=depth)
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            while True:
+                batch = list(itertools.islice(iterator, batch_size))
+                if not batch:
+                    break
+                batches.put(('batch', batch))
+        except Exception as e:
+            batches.put(('error', e))
+        else:
+            batches.put(('done', None))
+
+    producer = threading.Thread(target=produce, name='loader-prefetch')
+    producer.daemon = True  # Do not hold the process open if the consumer gives up
+    producer.start()
+    while True:
+        kind, value = batches.get()
+        if kind == 'batch':
+            yield value
+        elif kind == 'error':
+            raise value
+        else:
+            return
@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import OrderedDict
+
+from rdkit import Chem as C
+
+from .models import func
+
+
+class MoleculeRecord(object):
+    """ Detached, slotted row with just what list pages show: no ORM state, no bound RDKit values """
+    __slots__ = ('id', 'name', 'smiles', 'depiction')
+
+    def __init__(self, id, name, smiles, depiction=None):
+        self.id = id
+        self.name = name
+        self.smiles = smiles
+        self.depiction = depiction
+
+    @property
+    def mol(self):
+        if self.depiction is not None:
+            mol = C.Mol(bytes(self.depiction))
+        else:
+            mol = C.MolFromSmiles(self.smiles)
+        if mol is not None and self.name:
+            mol.SetProp('_Name', str(self.name))
+        return mol
+
+    def __repr__(self):
+        return "<MoleculeRecord(id={0.id!r}, name={0.name!r}, smiles={0.smiles!r})>".format(self)
+
+
+def record_columns(model):
+    name_columns = [getattr(model, column) for column in model.NAME_COLUMNS]
+    # SMILES are written by the cartridge so no Mol value is ever materialized in Python
+    return [model.id, func.mol_to_smiles(model.structure), model.depiction] + name_columns
+
+
+def as_molecule_records(model, query):
+    """ Restrict a molecule query to record columns; iterating the result yields MoleculeRecords """
+    return query.with_entities(*record_columns(model))
+
+
+def rows_to_records(model, rows):
+    return [MoleculeRecord(row[0], model.format_name(*row[3:]), row[1], row[2]) for row in rows]
+
+
+class PageCache(object):
+    """ Small thread-safe LRU cache with a time-to-live for rendered page data """
+    def __init__(self, size=128, ttl=300, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, create):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries[key] = entry
+                return entry[1]
+        value = create()
+        with self._lock:
+            self._entries[key] = (now, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, predicate):
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,121 @@
+""" Bulk resolution of identifiers (InChIKeys, CSD refcodes, aggregator names) to molecules
+
+Identifiers are grouped by kind and each group is looked up with one `= ANY(array)` query per
+batch, on the InChIKey functional indexes, the csdcompound (refcode, serial) index and the
+aggregator name index, so resolving thousands of identifiers costs a handful of queries.
+"""
+from __future__ import absolute_import
+
+import re
+from collections import OrderedDict
+
+from sqlalchemy import bindparam, String
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from .core import db
+from .models import Aggregator, Ligand, func
+
+
+INCHIKEY_PATTERN = re.compile(r'^[A-Z]{14}-[A-Z]{10}-[A-Z]$')
+# Six letter CSD refcodes, optionally with a two digit redetermination suffix and a .serial
+REFCODE_PATTERN = re.compile(r'^[A-Z]{6}(\d{2})?(\.\d+)?$')
+
+
+def identifier_kind(identifier):
+    if INCHIKEY_PATTERN.match(identifier):
+        return 'inchikey'
+    if REFCODE_PATTERN.match(identifier):
+        return 'refcode'
+    return 'name'
+
+
+def _any(values):
+    return func.any(bindparam(None, list(values), type_=ARRAY(String)))
+
+
+def _batches(values, size):
+    values = sorted(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _molecule_columns(model):
+    return (model.id, func.mol_to_smiles(model.structure), model.structure.inchikey) + \
+        tuple(getattr(model, column) for column in model.NAME_COLUMNS)
+
+
+def _match(model, row):
+    return OrderedDict([
+        ('type', 'aggregator' if model is Aggregator else 'ligand'),
+        ('id', row[0]),
+        ('name', model.format_name(*row[3:])),
+        ('smiles', row[1]),
+        ('inchikey', row[2]),
+    ])
+
+
+def lookup_inchikeys(model, inchikeys, batch_size=5000):
+    """ {inchikey: [match, ...]} for the `model` rows with these InChIKeys """
+    matches = {}
+    for batch in _batches(inchikeys, batch_size):
+        for row in db.session.query(*_molecule_columns(model)).filter(model.inchikey == _any(batch)):
+            matches.setdefault(row[2], []).append(_match(model, row))
+    return matches
+
+
+def _lookup_refcodes(names, batch_size):
+    """ {name: [match, ...]}; a refcode without a serial matches every molecule of that CSD entry """
+    wanted = dict((name, Ligand.parse_name(name)) for name in names)
+    by_refcode = {}
+    for batch in _batches(set(refcode for refcode, _serial in wanted.values()), batch_size):
+        # Leading column of the (refcode, serial) index; serials are few per refcode and matched here
+        for row in db.session.query(*_molecule_columns(Ligand)).filter(Ligand.refcode == _any(batch)):
+            by_refcode.setdefault(row[3], []).append(row)
+    matches = {}
+    for name, (refcode, serial) in wanted.items():
+        matches[name] = [_match(Ligand, row) for row in sorted(by_refcode.get(refcode, ()), key=lambda row: row[0])
+                         if serial is None or row[4] == serial]
+    return matches
+
+
+def _lookup_names(names, batch_size):
+    matches = {}
+    for batch in _batches(names, batch_size):
+        for row in db.session.query(*_molecule_columns(Aggregator)).filter(Aggregator.name == _any(batch)):
+            matches.setdefault(row[3], []).append(_match(Aggregator, row))
+    return matches
+
+
+def resolve_identifiers(identifiers, batch_size=5000):
+    """ [{query, kind, matches: [{type, id, name, smiles, inchikey, status, aggregator_id}]}] in input order
+
+    `status` is 'known' for reported aggregators and for ligands sharing an aggregator's InChIKey.
+    """
+    identifiers = [identifier.strip() for identifier in identifiers if identifier and identifier.strip()]
+    kinds = OrderedDict((identifier, identifier_kind(identifier)) for identifier in identifiers)
+    of_kind = lambda kind: set(identifier for identifier, found in kinds.items() if found == kind)
+
+    inchikeys = of_kind('inchikey')
+    found = {}
+    aggregators_by_inchikey = lookup_inchikeys(Aggregator, inchikeys, batch_size)
+    ligands_by_inchikey = lookup_inchikeys(Ligand, inchikeys, batch_size)
+    for inchikey in inchikeys:
+        found[inchikey] = aggregators_by_inchikey.get(inchikey, []) + ligands_by_inchikey.get(inchikey, [])
+    found.update(_lookup_refcodes(of_kind('refcode'), batch_size))
+    names = _lookup_names(of_kind('name') | of_kind('refcode'), batch_size)
+    for name, matches in names.items():
+        found[name] = found.get(name, []) + matches
+
+    # One more lookup tells which of the ligands found are themselves reported aggregators
+    ligand_keys = set(match['inchikey'] for matches in found.values() for match in matches
+                      if match['type'] == 'ligand' and match['inchikey'])
+    known = dict(aggregators_by_inchikey)
+    known.update(lookup_inchikeys(Aggregator, ligand_keys - set(known), batch_size))
+    for matches in found.values():
+        for match in matches:
+            aggregator = match if match['type'] == 'aggregator' else (known.get(match['inchikey']) or [None])[0]
+            match['status'] = 'known' if aggregator is not None else 'unreported'
+            match['aggregator_id'] = aggregator['id'] if aggregator is not None else None
+
+    return [OrderedDict([('query', identifier), ('kind', kind), ('matches', found.get(identifier, []))])
+            for identifier, kind in kinds.items()]
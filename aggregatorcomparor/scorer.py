@@ -0,0 +1,146 @@
+""" Naive Bayes aggregation-likelihood scorer, a cheap pre-stage for reports and bulk screens
+
+Trained offline (manage.py train_scorer) on fingerprints of the aggregators against a random
+background of CSD ligands, the model is one log-odds weight per fingerprint bit plus a bias, so
+scoring a molecule is a single dot product with its fingerprint. Two thresholds are fixed at
+training time: below `low` all but a small share of the aggregators are left out, at or above
+`high` all but a small share of the background is, and only the borderline scores in between
+need the full similarity search.
+"""
+from __future__ import absolute_import, division
+
+import logging
+import math
+import multiprocessing
+import os
+
+import numpy as np
+from rdkit import Chem as C
+from rdkit import DataStructs
+
+from .core import app, db
+from .models import Aggregator, Ligand, func
+from .snapshot import SNAPSHOT_FINGERPRINTS
+
+
+log = logging.getLogger(__name__)
+
+TRIAGE_NEGATIVE = 'negative'
+TRIAGE_BORDERLINE = 'borderline'
+TRIAGE_POSITIVE = 'positive'
+
+
+class AggregationScorer(object):
+    def __init__(self, weights, bias, fp_type, low, high):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+        self.fp_type = fp_type
+        self.low = float(low)
+        self.high = float(high)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as stored:
+            return cls(stored['weights'], stored['bias'], str(stored['fp_type']), stored['low'], stored['high'])
+
+    def save(self, path):
+        # np.savez appends .npz to names without it; write under the exact name so config paths match
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, weights=self.weights, bias=self.bias, fp_type=self.fp_type, low=self.low, high=self.high)
+        os.rename(path + '.tmp', path)
+
+    def score(self, mol):
+        """ Log-odds that `mol` (an RDKit molecule) aggregates """
+        fingerprint = SNAPSHOT_FINGERPRINTS[self.fp_type](mol)
+        return self.bias + self.weights[list(fingerprint.GetOnBits())].sum()
+
+    def score_matrix(self, fingerprints):
+        """ Log-odds for each row of a (molecules x bits) 0/1 matrix """
+        return fingerprints.dot(self.weights) + self.bias
+
+    def triage(self, score):
+        if score < self.low:
+            return TRIAGE_NEGATIVE
+        if score >= self.high:
+            return TRIAGE_POSITIVE
+        return TRIAGE_BORDERLINE
+
+    @staticmethod
+    def probability(score):
+        return 1 / (1 + math.exp(-score))
+
+
+def fingerprint_row(args):
+    """ Fingerprint bits of a SMILES as a uint8 array, or None if it does not parse; runs in worker processes """
+    smiles, fp_type = args
+    mol = C.MolFromSmiles(smiles) if smiles else None
+    if mol is None:
+        return None
+    row = np.zeros((0,), dtype=np.uint8)
+    DataStructs.ConvertToNumpyArray(SNAPSHOT_FINGERPRINTS[fp_type](mol), row)
+    return row
+
+
+def fingerprint_matrix(smiles, fp_type, processes=None):
+    """ (molecules x bits) uint8 matrix for the SMILES that parse, in input order """
+    pool = multiprocessing.Pool(processes)
+    try:
+        rows = [row for row in pool.imap(fingerprint_row, ((value, fp_type) for value in smiles), chunksize=256)
+                if row is not None]
+    finally:
+        pool.terminate()
+        pool.join()
+    return np.vstack(rows) if rows else np.zeros((0, 0), dtype=np.uint8)
+
+
+def fit_scorer(positives, negatives, fp_type, alpha=1.0, recall=0.99, specificity=0.99):
+    """ AggregationScorer from Bernoulli naive Bayes on two fingerprint matrices, with Laplace smoothing `alpha`
+
+    `low` keeps `recall` of the positives at or above it; `high` leaves `specificity` of the negatives below it.
+    """
+    p = (positives.sum(axis=0) + alpha) / (len(positives) + 2 * alpha)
+    q = (negatives.sum(axis=0) + alpha) / (len(negatives) + 2 * alpha)
+    absent = np.log((1 - p) / (1 - q))
+    weights = np.log(p / q) - absent
+    bias = absent.sum() + math.log(len(positives) / len(negatives))
+    scorer = AggregationScorer(weights, bias, fp_type, 0, 0)
+    low = np.percentile(scorer.score_matrix(positives), 100 * (1 - recall))
+    high = np.percentile(scorer.score_matrix(negatives), 100 * specificity)
+    scorer.low, scorer.high = float(low), float(max(low, high))
+    return scorer
+
+
+def training_smiles(background=50000):
+    """ (aggregator SMILES, SMILES of a random sample of `background` ligands) """
+    aggregators = [smiles for smiles, in db.session.query(func.mol_to_smiles(Aggregator.structure))
+                                                   .filter(Aggregator.structure != None)]
+    ligands = [smiles for smiles, in db.session.query(func.mol_to_smiles(Ligand.structure))
+                                               .filter(Ligand.structure != None)
+                                               .order_by(func.random())
+                                               .limit(background)]
+    return aggregators, ligands
+
+
+_scorer = []  # [(path, mtime, scorer)] of the last successful load
+
+
+def get_scorer(config=None):
+    """ The AGGREGATION_SCORER_PATH model, or None without one
+
+    Loaded once per model file: a retrained model (new mtime) is picked up, and a load that
+    failed (the file not written yet) is retried on the next call rather than remembered.
+    """
+    config = config or app.config
+    path = config.get('AGGREGATION_SCORER_PATH')
+    if not path:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime
+        if _scorer and _scorer[0][:2] == (path, mtime):
+            return _scorer[0][2]
+        scorer = AggregationScorer.load(path)
+    except (IOError, OSError, KeyError, ValueError) as e:
+        log.warning("Aggregation scorer %s could not be loaded (%s); reports run the full search", path, e)
+        return _scorer[0][2] if _scorer and _scorer[0][0] == path else None
+    _scorer[:] = [(path, mtime, scorer)]
+    return scorer
@@ -0,0 +1,239 @@
+""" Read-only SQLite snapshots of the molecule tables, searchable without PostgreSQL
+
+A snapshot is a SQLite file holding aggregators, citations, reports and optionally ligands with
+canonical SMILES, InChIKeys, descriptors and stored depictions, next to a packed fingerprint file
+(`<snapshot>.fp`) with one fixed width fingerprint per molecule. Fingerprints are computed with
+RDKit itself at build time, exactly as query fingerprints are at search time.
+
+Served with SNAPSHOT_PATH, similarity searches, similar-list pages and aggregator reports (including
+their known-InChIKey check) run without PostgreSQL. Everything else is PostgreSQL-assisted and fails
+while it is unreachable: molecule detail and browse pages, citations, typeahead, identifier
+resolution, searches by aggregator or ligand id, and the admin pages.
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from rdkit import Chem as C
+from rdkit import DataStructs
+from rdkit.Chem import AllChem, MACCSkeys
+
+from .core import db
+from .models import Aggregator, AggregatorReport, Citation, Ligand, func
+
+
+# Parameters mirror the cartridge defaults so snapshot scores track the database searches
+SNAPSHOT_FINGERPRINTS = {
+    'rdkit': lambda mol: C.RDKFingerprint(mol, minPath=1, maxPath=6, fpSize=1024, nBitsPerHash=2),
+    'morgan': lambda mol: AllChem.GetMorganFingerprintAsBitVect(mol, 2, nBits=512),
+    'featmorgan': lambda mol: AllChem.GetMorganFingerprintAsBitVect(mol, 2, nBits=512, useFeatures=True),
+    'maccs': MACCSkeys.GenMACCSKeys,
+}
+
+SNAPSHOT_METRICS = {
+    'tanimoto': DataStructs.BulkTanimotoSimilarity,
+    'dice': DataStructs.BulkDiceSimilarity,
+}
+
+MOLECULE_COLUMNS = 'id INTEGER PRIMARY KEY, name TEXT, smiles TEXT NOT NULL, inchikey TEXT, ' \
+                   'logp REAL, mwt REAL, num_heavy_atoms INTEGER, depiction BLOB, fp_row INTEGER NOT NULL'
+
+SCHEMA = (
+    "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE aggregator (" + MOLECULE_COLUMNS + ")",
+    "CREATE TABLE csdcompound (refcode TEXT, serial INTEGER, " + MOLECULE_COLUMNS + ")",
+    "CREATE TABLE citation (id INTEGER PRIMARY KEY, doi TEXT, original_reference TEXT, authors TEXT, "
+    "journal TEXT, volume INTEGER, pages TEXT, published TEXT)",
+    "CREATE TABLE reported_aggregator (id INTEGER PRIMARY KEY, aggregator_fk INTEGER, citation_fk INTEGER, "
+    "concentration TEXT)",
+    "CREATE INDEX aggregator_name_idx ON aggregator (name)",
+    "CREATE INDEX aggregator_inchikey_idx ON aggregator (inchikey)",
+    "CREATE INDEX csdcompound_refcode_idx ON csdcompound (refcode, serial)",
+    "CREATE INDEX csdcompound_inchikey_idx ON csdcompound (inchikey)",
+    "CREATE INDEX reported_aggregator_aggregator_fk_idx ON reported_aggregator (aggregator_fk)",
+    "CREATE INDEX reported_aggregator_citation_fk_idx ON reported_aggregator (citation_fk)",
+)
+
+
+def fingerprint_path(path):
+    return path + '.fp'
+
+
+def _export_molecules(model, connection, fp_file, fp_type, batch_size=5000):
+    """ Copy one molecule table into the snapshot, appending its fingerprints to `fp_file` """
+    fingerprint = SNAPSHOT_FINGERPRINTS[fp_type]
+    name_columns = [getattr(model, column) for column in model.NAME_COLUMNS]
+    query = db.session.query(model.id, func.mol_to_smiles(model.structure), model.structure.inchikey,
+                             model.structure.logp, model.structure.mwt, model.structure.num_heavy_atoms,
+                             model.depiction, *name_columns)\
+                      .filter(model.structure != None)\
+                      .order_by(model.id)\
+                      .execution_options(stream_results=True)\
+                      .yield_per(batch_size)
+    extra_columns = ', refcode, serial' if model is Ligand else ''
+    insert = "INSERT INTO {0} (id, name, smiles, inchikey, logp, mwt, num_heavy_atoms, depiction, fp_row{1}) " \
+             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?{2})".format(model.__tablename__, extra_columns,
+                                                           ', ?, ?' if model is Ligand else '')
+    offset = fp_file.tell()
+    fp_bytes, row, skipped, batch = None, 0, 0, []
+    for molecule_id, smiles, inchikey, logp, mwt, heavy_atoms, depiction, names in \
+            ((r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7:]) for r in query):
+        mol = C.Mol(bytes(depiction)) if depiction is not None else C.MolFromSmiles(smiles)
+        if mol is None:
+            skipped += 1
+            continue
+        packed = DataStructs.BitVectToBinaryText(fingerprint(mol))
+        if fp_bytes is None:
+            fp_bytes = len(packed)
+        fp_file.write(packed)
+        values = [molecule_id, model.format_name(*names), smiles, inchikey, logp, mwt, heavy_atoms,
+                  None if depiction is None else sqlite3.Binary(bytes(depiction)), row]
+        batch.append(values + list(names) if model is Ligand else values)
+        row += 1
+        if len(batch) >= batch_size:
+            connection.executemany(insert, batch)
+            batch = []
+    if batch:
+        connection.executemany(insert, batch)
+    meta = {
+        '{0}_fp_offset'.format(model.__tablename__): offset,
+        '{0}_fp_count'.format(model.__tablename__): row,
+    }
+    if fp_bytes is not None:
+        meta['fp_bytes'] = fp_bytes
+    print("{0}: {1:d} molecules ({2:d} skipped)".format(model.__tablename__, row, skipped), file=sys.stderr)
+    return meta
+
+
+def build_snapshot(path, ligands=False, fp_type='rdkit'):
+    """ Write the snapshot and its fingerprint file next to each other, replacing both atomically """
+    if fp_type not in SNAPSHOT_FINGERPRINTS:
+        raise ValueError("Unknown fingerprint type {0!r} (expected one of: {1})".format(
+            fp_type, ', '.join(sorted(SNAPSHOT_FINGERPRINTS))))
+    building = path + '.building'
+    for stale in (building, fingerprint_path(building)):
+        if os.path.exists(stale):
+            os.remove(stale)
+    connection = sqlite3.connect(building)
+    try:
+        for statement in SCHEMA:
+            connection.execute(statement)
+        meta = {'fp_type': fp_type, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'fp_bytes': 0}
+        with open(fingerprint_path(building), 'wb') as fp_file:
+            for model in (Aggregator, Ligand) if ligands else (Aggregator,):
+                meta.update(_export_molecules(model, connection, fp_file, fp_type))
+
+        connection.executemany(
+            "INSERT INTO citation VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((c.id, c.doi, c.original_reference, json.dumps(list(c.authors or ())), c.journal, c.volume, c.pages,
+              c.published.isoformat() if c.published else None) for c in Citation.query.order_by(Citation.id)))
+        connection.executemany(
+            "INSERT INTO reported_aggregator VALUES (?, ?, ?, ?)",
+            db.session.query(AggregatorReport.id, AggregatorReport.aggregator_fk, AggregatorReport.citation_fk,
+                             AggregatorReport.concentration).order_by(AggregatorReport.id))
+        connection.executemany("INSERT INTO meta VALUES (?, ?)",
+                               ((key, json.dumps(value)) for key, value in sorted(meta.items())))
+        connection.commit()
+    finally:
+        connection.close()
+    os.rename(fingerprint_path(building), fingerprint_path(path))
+    os.rename(building, path)
+
+
+class SnapshotMolecule(object):
+    """ Molecule row read from a snapshot, shaped like the models for templates and serializers """
+    def __init__(self, id, name, smiles, inchikey=None, logp=None, mwt=None, num_heavy_atoms=None,
+                 depiction=None):
+        self.id = id
+        self.name = name
+        self.smiles = smiles
+        self.inchikey = inchikey
+        self.logp = logp
+        self.mwt = mwt
+        self.num_heavy_atoms = num_heavy_atoms
+        self.depiction = depiction
+
+    @property
+    def mol(self):
+        mol = C.Mol(bytes(self.depiction)) if self.depiction is not None else C.MolFromSmiles(self.smiles)
+        if mol is not None and self.name:
+            mol.SetProp('_Name', str(self.name))
+        return mol
+
+    def __repr__(self):
+        return "<SnapshotMolecule(id={0.id!r}, name={0.name!r}, smiles={0.smiles!r})>".format(self)
+
+
+class Snapshot(object):
+    """ Similarity search over a snapshot: fingerprints held in memory, rows read from SQLite on demand """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.meta = dict((key, json.loads(value)) for key, value in self.connection.execute("SELECT * FROM meta"))
+        self.fp_type = self.meta['fp_type']
+        self._fingerprints = {}
+        self._ids = {}
+        with open(fingerprint_path(path), 'rb') as fp_file:
+            packed = fp_file.read()
+        width = self.meta['fp_bytes']
+        for table in ('aggregator', 'csdcompound'):
+            count = self.meta.get('{0}_fp_count'.format(table))
+            if count is None:
+                continue
+            offset = self.meta['{0}_fp_offset'.format(table)]
+            self._fingerprints[table] = [DataStructs.CreateFromBinaryText(packed[start:start + width])
+                                         for start in range(offset, offset + count * width, width)]
+            self._ids[table] = [molecule_id for molecule_id, in self.connection.execute(
+                "SELECT id FROM {0} ORDER BY fp_row".format(table))]
+
+    @property
+    def connection(self):
+        # sqlite3 connections may not be shared between threads
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = sqlite3.connect('file:{0}?mode=ro'.format(self.path), uri=True) \
+                if sys.version_info >= (3, 4) else sqlite3.connect(self.path)
+        return self._local.connection
+
+    def has_table(self, table):
+        return table in self._fingerprints
+
+    def has_inchikey(self, table, inchikey):
+        return self.connection.execute("SELECT 1 FROM {0} WHERE inchikey = ? LIMIT 1".format(table),
+                                       (inchikey,)).fetchone() is not None
+
+    def similar(self, table, mol, cutoff=0.5, limit=None, fp_type=None, metric='tanimoto', descriptors=None):
+        """ [(SnapshotMolecule, score), ...] at or above `cutoff`, most similar first """
+        if fp_type not in (None, self.fp_type):
+            raise ValueError("Snapshot only holds {0} fingerprints".format(self.fp_type))
+        scores = SNAPSHOT_METRICS[metric](SNAPSHOT_FINGERPRINTS[self.fp_type](mol), self._fingerprints[table])
+        ids = self._ids[table]
+        hits = sorted(((score, ids[row]) for row, score in enumerate(scores) if score >= cutoff), reverse=True)
+        if limit is not None and not descriptors:
+            hits = hits[:limit]  # Nothing is filtered out, so only the rows shown need reading
+        molecules = self.molecules(table, [molecule_id for _score, molecule_id in hits], descriptors=descriptors)
+        results = [(molecules[molecule_id], score) for score, molecule_id in hits if molecule_id in molecules]
+        return results[:limit] if limit is not None else results
+
+    def molecules(self, table, ids, descriptors=None):
+        """ {id: SnapshotMolecule} for `ids`, dropping those outside the descriptor windows """
+        molecules = {}
+        for start in range(0, len(ids), 500):  # Stay under SQLite's bound parameter limit
+            chunk = ids[start:start + 500]
+            rows = self.connection.execute(
+                "SELECT id, name, smiles, inchikey, logp, mwt, num_heavy_atoms, depiction FROM {0} "
+                "WHERE id IN ({1})".format(table, ', '.join('?' * len(chunk))), chunk)
+            for row in rows:
+                molecule = SnapshotMolecule(*row)
+                if all(_within(getattr(molecule, column), window) for column, window in (descriptors or {}).items()):
+                    molecules[molecule.id] = molecule
+        return molecules
+
+
+def _within(value, window):
+    low, high = window
+    return value is not None and (low is None or value >= low) and (high is None or value <= high)
@@ -0,0 +1,174 @@
+from __future__ import absolute_import
+
+import atexit
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy import Column, Integer, MetaData, Table, event, text
+
+from .core import app, db
+from .models import Aggregator, AggregatorReport, Citation
+
+
+log = logging.getLogger(__name__)
+
+# Materialized views get their own metadata so create_all never builds them as plain tables
+metadata = MetaData()
+
+citation_summary = Table('citation_summary', metadata,
+                         Column('citation_fk', Integer, primary_key=True),
+                         Column('year', Integer),
+                         Column('aggregator_count', Integer))
+
+aggregator_summary = Table('aggregator_summary', metadata,
+                           Column('aggregator_fk', Integer, primary_key=True),
+                           Column('citation_count', Integer),
+                           Column('first_reported', Integer),
+                           Column('last_reported', Integer))
+
+# name: (query, indexes); the unique index is what allows REFRESH ... CONCURRENTLY
+SUMMARY_VIEWS = OrderedDict([
+    ('citation_summary', (
+        "SELECT citation.id AS citation_fk, "
+        "CAST(EXTRACT(YEAR FROM citation.published) AS integer) AS year, "
+        "COUNT(DISTINCT reported_aggregator.aggregator_fk) AS aggregator_count "
+        "FROM citation LEFT JOIN reported_aggregator ON reported_aggregator.citation_fk = citation.id "
+        "GROUP BY citation.id",
+        ("CREATE UNIQUE INDEX citation_summary_citation_fk_idx ON citation_summary (citation_fk)",
+         "CREATE INDEX citation_summary_year_idx ON citation_summary (year, citation_fk)"),
+    )),
+    ('aggregator_summary', (
+        "SELECT aggregator.id AS aggregator_fk, "
+        "COUNT(DISTINCT reported_aggregator.citation_fk) AS citation_count, "
+        "CAST(MIN(EXTRACT(YEAR FROM citation.published)) AS integer) AS first_reported, "
+        "CAST(MAX(EXTRACT(YEAR FROM citation.published)) AS integer) AS last_reported "
+        "FROM aggregator "
+        "LEFT JOIN reported_aggregator ON reported_aggregator.aggregator_fk = aggregator.id "
+        "LEFT JOIN citation ON citation.id = reported_aggregator.citation_fk "
+        "GROUP BY aggregator.id",
+        ("CREATE UNIQUE INDEX aggregator_summary_aggregator_fk_idx ON aggregator_summary (aggregator_fk)",
+         "CREATE INDEX aggregator_summary_citation_count_idx "
+         "ON aggregator_summary (citation_count DESC, aggregator_fk)"),
+    )),
+])
+
+
+def create_summary_views(bind=None):
+    """ Create any missing summary views (populated immediately) with their indexes """
+    bind = bind or db.engine
+    created = []
+    with bind.begin() as connection:
+        for name, (query, indexes) in SUMMARY_VIEWS.items():
+            if connection.execute(text("SELECT to_regclass(:name)"), name=name).scalar() is not None:
+                continue
+            connection.execute('CREATE MATERIALIZED VIEW {0} AS {1}'.format(name, query))
+            for index in indexes:
+                connection.execute(index)
+            created.append(name)
+    return created
+
+
+def refresh_summary_views(bind=None, concurrently=True):
+    """ Recompute every summary view; concurrently keeps them readable while refreshing """
+    bind = bind or db.engine
+    with bind.begin() as connection:
+        for name in SUMMARY_VIEWS:
+            connection.execute('REFRESH MATERIALIZED VIEW {0}{1}'.format('CONCURRENTLY ' if concurrently else '',
+                                                                         name))
+
+
+def _summaries_affected(session):
+    changed = itertools.chain(session.new, session.dirty, session.deleted)
+    # Only new or deleted aggregators change counts; edits to their structure or name do not
+    added_or_removed = itertools.chain(session.new, session.deleted)
+    return any(isinstance(obj, (AggregatorReport, Citation)) for obj in changed) or \
+        any(isinstance(obj, Aggregator) for obj in added_or_removed)
+
+
+def mark_stale_summaries(session, flush_context):
+    if _summaries_affected(session):
+        session.info['summaries_stale'] = True
+
+
+def _refresh_after_commit():
+    try:
+        refresh_summary_views()
+    except Exception:
+        # The data change itself is committed; stale counts must not turn it into an error
+        log.exception("Could not refresh summary views (run manage.py refresh_summaries)")
+
+
+def _refresh_in_background():
+    with _refresh_lock:
+        _refresh_timer[:] = []
+    _refresh_after_commit()
+
+
+# The pending debounced refresh, and the stale flags of refresh_once blocks (innermost last)
+_refresh_timer = []
+_refresh_lock = threading.Lock()
+_held = []
+
+
+def schedule_refresh(delay=None):
+    """ Refresh the summary views in the background once no commit has changed them for `delay` seconds
+
+    A refresh recomputes every view, so bursts of edits (an admin session, a batched load) get one
+    refresh at the end instead of one per commit, and the committing request does not wait for it.
+    """
+    delay = app.config.get('SUMMARY_REFRESH_DELAY', 5.0) if delay is None else delay
+    with _refresh_lock:
+        if _refresh_timer:
+            _refresh_timer[0].cancel()
+        timer = threading.Timer(delay, _refresh_in_background)
+        timer.daemon = True
+        _refresh_timer[:] = [timer]
+        timer.start()
+
+
+@atexit.register
+def _refresh_before_exit():
+    # Timers are daemon threads, so a process exiting meanwhile (manage.py shell) would skip the refresh
+    with _refresh_lock:
+        pending = _refresh_timer and _refresh_timer[0].is_alive()
+        if pending:
+            _refresh_timer[0].cancel()
+    if pending:
+        _refresh_after_commit()
+
+
+@contextmanager
+def refresh_once():
+    """ Hold back refreshes for commits in the block, refreshing once at its end if any changed the summaries
+
+    For command line loads, whose process may exit before a background refresh would run.
+    """
+    _held.append(False)
+    try:
+        yield
+    finally:
+        stale = _held.pop()
+        if stale and _held:
+            _held[-1] = True
+        elif stale:
+            _refresh_after_commit()
+
+
+def refresh_stale_summaries(session):
+    if session.info.pop('summaries_stale', False):
+        if _held:
+            _held[-1] = True
+        else:
+            schedule_refresh()
+
+
+def forget_stale_summaries(session):
+    session.info.pop('summaries_stale', None)
+
+
+event.listen(db.session, 'after_flush', mark_stale_summaries)
+event.listen(db.session, 'after_commit', refresh_stale_summaries)
+event.listen(db.session, 'after_rollback', forget_stale_summaries)
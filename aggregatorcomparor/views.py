@@ -5,31 +5,92 @@ from flask import(
     json,
     render_template,
     request,
+    stream_with_context,
+    url_for,
+    Response,
 )
 from .core import (
     app,
     db,
 )
 from .models import (
+    FINGERPRINT_TYPES,
     Aggregator,
     Citation,
     Ligand,
     func,
     coerse_to_mol,
 )
+from .admission import heavy_query
+from .migrations import upgrade_schema
+from .changes import start_change_listener
+from .progressive import InvalidContinuation, progressive_similar_molecules
+from .queryplans import QueryPlanError, guard_query_plans
+from .resolver import resolve_identifiers
+from .warmup import is_ready, start_background_warmup
+from .summaries import aggregator_summary, citation_summary
 from .helpers import (
     aggregator_report,
-    annotate_tanimoto_similarity,
+    depict_molecules,
     draw_mol,
-    represent_mol,
+    represent_molecule,
     extract_query_mol,
-    get_molecules_for_view,
+    get_molecule_records_for_view,
+    get_query_scaffold,
     get_similarity_parameters,
     get_similar_molecules,
-    run_similar_molecules_query,
+    pick_diverse_molecules,
+    snapshot_similar_molecules,
+    serialize_aggregator_report,
+    stream_similar_molecules,
+    stream_template,
 )
 
 
+# With SNAPSHOT_PATH set the searches and reports do not touch PostgreSQL, so neither may the first
+# request: Flask re-runs failing hooks on every request, turning an unreachable database into 500s everywhere
+
+
+@app.before_first_request
+def upgrade_database_schema():
+    # Registered first: every molecule query selects the columns it adds
+    if app.config.get('SCHEMA_UPGRADE_ON_START', True) and not app.config.get('SNAPSHOT_PATH'):
+        upgrade_schema(db.get_engine(app))
+
+
+@app.before_first_request
+def start_listening_for_changes():
+    if not app.config.get('SNAPSHOT_PATH'):
+        start_change_listener(app)
+
+
+@app.before_first_request
+def check_query_plans():
+    mode = app.config.get('QUERY_PLAN_GUARD', 'warn')
+    if not mode or app.config.get('SNAPSHOT_PATH'):
+        return
+    try:
+        guard_query_plans(strict=mode == 'fail')
+    except QueryPlanError:
+        raise
+    except Exception:
+        app.logger.exception("Could not check query plans")
+
+
+@app.before_first_request
+def warm_up():
+    if app.config.get('WARMUP_ON_START', False):
+        start_background_warmup()
+
+
+@app.route('/ready')
+def ready():
+    """ For load balancers: 503 until this worker has warmed up (when WARMUP_ON_START is set) """
+    if is_ready(app.config):
+        return Response("ready\n", mimetype='text/plain')
+    return Response("warming up\n", status=503, mimetype='text/plain')
+
+
 @app.route('/')
 @app.route('/index')
 def index():
@@ -37,17 +98,19 @@ def index():
 
 
 @app.route('/aggregator-status')
-def aggregator_report():
+@heavy_query
+def aggregator_status():
     query_structure, query_input, error = extract_query_mol(request.args)
     report = aggregator_report(query_structure)
     return render_template('aggregators/report.html', **report)
 
 
 @app.route('/aggregator-status.json')
-def aggregator_report_json():
+@heavy_query
+def aggregator_status_json():
     query_structure, query_input, error = extract_query_mol(request.args)
     report = aggregator_report(query_structure)
-    return json.jsonify(**report)
+    return json.jsonify(**serialize_aggregator_report(report))
 
 
 @app.route('/draw')
@@ -58,6 +121,33 @@ def draw():
     else:
         return draw_mol(structure, format='png')
 
+
+@app.route('/resolve.json', methods=['GET', 'POST'])
+@heavy_query
+def resolve_json():
+    """ Resolve InChIKeys, CSD refcodes and aggregator names in bulk
+
+    Identifiers come from `ids` (comma separated), a JSON body {"identifiers": [...]} or a text body
+    with one identifier per line.
+    """
+    if request.method == 'GET':
+        identifiers = request.args.get('ids', '').split(',')
+    elif request.mimetype == 'application/json':
+        identifiers = (request.get_json(silent=True) or {}).get('identifiers')
+    else:
+        identifiers = request.get_data(as_text=True).splitlines()
+    if not isinstance(identifiers, list) or len(identifiers) > app.config.get('IDENTIFIER_RESOLVE_MAX', 10000):
+        abort(400)
+    results = resolve_identifiers(identifier for identifier in identifiers if isinstance(identifier, basestring))
+    for result in results:
+        for match in result['matches']:
+            endpoint, key = ('aggregator_detail', 'agg_id') if match['type'] == 'aggregator' \
+                else ('ligand_detail', 'lig_id')
+            match['url'] = url_for(endpoint, **{key: match['id']})
+    return json.jsonify(results=results,
+                        resolved=sum(1 for result in results if result['matches']),
+                        unresolved=[result['query'] for result in results if not result['matches']])
+
 ######################################################################################################################
 
 
@@ -78,7 +168,39 @@ def aggregator_image(agg_id):
 @app.route('/aggregators/<int:agg_id>.<format>')
 def aggregator_represent(agg_id, format):
     aggregator = Aggregator.query.get_or_404(agg_id)
-    return represent_mol(aggregator.mol, format=format)
+    return represent_molecule(aggregator, format=format)
+
+
+@app.route('/aggregators/depictions.json')
+def aggregator_depictions():
+    return molecule_depictions(Aggregator)
+
+
+@app.route('/aggregators/scaffold', defaults={'page': 1})
+@app.route('/aggregators/scaffold/page:<int:page>')
+def aggregator_scaffold(page=1):
+    return molecules_with_scaffold(Aggregator, page, 'aggregators/list.html', 'aggregator_detail')
+
+
+@app.route('/aggregators/diverse.json')
+@heavy_query
+def aggregator_diverse_json():
+    try:
+        count = int(request.args.get('count', 10))
+        seed = int(request.args.get('seed', 42))
+    except ValueError:
+        abort(400)
+    fp_type = request.args.get('fp', app.config.get('MOLECULE_SEARCH_FINGERPRINT', 'rdkit'))
+    if fp_type not in FINGERPRINT_TYPES or count < 1:
+        abort(400)
+    count = min(count, app.config.get('MOLECULE_DIVERSITY_MAX_PICKS', 500))
+    picked = pick_diverse_molecules(Aggregator, count, fp_type=fp_type, seed=seed)
+    return json.jsonify(fp=fp_type, aggregators=[{
+        'id': aggregator.id,
+        'name': aggregator.name,
+        'smiles': aggregator.smiles,
+        'url': url_for('aggregator_detail', agg_id=aggregator.id),
+    } for aggregator in picked])
 
 
 @app.route('/aggregators/', defaults={'page': 1})
@@ -93,22 +215,48 @@ def aggregator_list(page=1):
         suggestions = [agg.name for agg in query.limit(20)]
         return json.dumps(suggestions), 'application/javascript'
     else:
-        aggregators = get_molecules_for_view(query, page, sorting=sorting, config=app.config)
-        return render_template('aggregators/list.html', molecules=aggregators)
+        aggregators, depictions = get_molecule_records_for_view(Aggregator, query, page,
+                                                                sorting=sorting,
+                                                                cache_key=('list', request.args.get('name')),
+                                                                config=app.config)
+        return render_template('aggregators/list.html',
+                               molecules=aggregators,
+                               depictions=depictions)
+
+
+@app.route('/aggregators/most-reported', defaults={'page': 1})
+@app.route('/aggregators/most-reported/page:<int:page>')
+def aggregator_list_most_reported(page=1):
+    query = Aggregator.query.join(aggregator_summary, aggregator_summary.c.aggregator_fk == Aggregator.id)\
+                            .filter(aggregator_summary.c.citation_count > 0)\
+                            .order_by(aggregator_summary.c.citation_count.desc(), Aggregator.id)
+    aggregators, depictions = get_molecule_records_for_view(Aggregator, query, page,
+                                                            cache_key=('most-reported',),
+                                                            config=app.config)
+    return render_template('aggregators/list.html',
+                           molecules=aggregators,
+                           depictions=depictions)
 
 
 @app.route('/aggregators/similar', defaults={'page': 1})
 @app.route('/aggregators/similar/page:<int:page>')
+@heavy_query
 def aggregator_list_similar_to(page=1):
-    params = get_similarity_parameters(this_request=request)
     if page == 0:
-        del params['limit']
-    with run_similar_molecules_query(Aggregator, params) as query:
-        pagination = get_molecules_for_view(query, page, sorting=None, config=app.config)
-        pagination.items = annotate_tanimoto_similarity(pagination.items)
-        return render_template('aggregators/similar-list.html',
-                               molecules=pagination,
-                               page_query_args=request.args)
+        params = get_similarity_parameters(this_request=request, override_limit=None)
+    else:
+        params = get_similarity_parameters(this_request=request)
+    pagination, depictions = stream_similar_molecules(Aggregator, params, page, config=app.config)
+    return Response(stream_with_context(stream_template('aggregators/similar-list.html',
+                                                        molecules=pagination,
+                                                        depictions=depictions,
+                                                        page_query_args=request.args)))
+
+
+@app.route('/aggregators/similar.json')
+@heavy_query
+def aggregator_similar_json():
+    return progressive_similar_json(Aggregator, 'aggregator_detail')
 
 
 #######################################################################################################################
@@ -126,7 +274,7 @@ def ligand_detail(lig_id):
 @app.route('/ligands/<int:lig_id>.<format>')
 def ligand_represent(lig_id, format):
     ligand = Ligand.query.get_or_404(lig_id)
-    return represent_mol(ligand.mol, format=format)
+    return represent_molecule(ligand, format=format)
 
 
 @app.route('/ligands/<int:lig_id>.png')
@@ -134,6 +282,17 @@ def ligand_image(lig_id):
     return ligand_represent(lig_id, format='png')
 
 
+@app.route('/ligands/depictions.json')
+def ligand_depictions():
+    return molecule_depictions(Ligand)
+
+
+@app.route('/ligands/scaffold', defaults={'page': 1})
+@app.route('/ligands/scaffold/page:<int:page>')
+def ligand_scaffold(page=1):
+    return molecules_with_scaffold(Ligand, page, 'ligands/list.html', 'ligand_detail')
+
+
 @app.route('/ligands/', defaults={'page': 1})
 @app.route('/ligands/page:<int:page>')
 def ligand_list(page=1):
@@ -145,47 +304,135 @@ def ligand_list(page=1):
     if request.args.get('format') == 'json':
         suggestions = [lig.refcode for lig in query.limit(20)]
         return json.dumps(suggestions), 'application/javascript'
-    ligands = get_molecules_for_view(query, page, sorting=sorting, config=app.config)
-    return render_template('ligands/list.html', molecules=ligands)
+    ligands, depictions = get_molecule_records_for_view(Ligand, query, page,
+                                                        sorting=sorting,
+                                                        cache_key=('list', request.args.get('name')),
+                                                        config=app.config)
+    return render_template('ligands/list.html',
+                           molecules=ligands,
+                           depictions=depictions)
 
 
 @app.route('/ligands/similar', defaults={'page': 1})
 @app.route('/ligands/similar/page:<int:page>')
+@heavy_query
 def ligand_list_similar_to(page=1):
-    params = get_similarity_parameters(this_request=request)
     if page == 0:
-        del params['limit']
-    with run_similar_molecules_query(Ligand, params) as query:
-        pagination = get_molecules_for_view(query, page, sorting=None, config=app.config)
-        pagination.items = annotate_tanimoto_similarity(pagination.items)
-        return render_template('ligands/similar-list.html',
-                               molecules=pagination,
-                               page_query_args=request.args)
+        params = get_similarity_parameters(this_request=request, override_limit=None)
+    else:
+        params = get_similarity_parameters(this_request=request)
+    pagination, depictions = stream_similar_molecules(Ligand, params, page, config=app.config)
+    return Response(stream_with_context(stream_template('ligands/similar-list.html',
+                                                        molecules=pagination,
+                                                        depictions=depictions,
+                                                        page_query_args=request.args)))
+
+
+@app.route('/ligands/similar.json')
+@heavy_query
+def ligand_similar_json():
+    return progressive_similar_json(Ligand, 'ligand_detail')
 
 
 #######################################################################################################################
 
 
-@app.route('/sources', defaults={'page_num': 1})
-@app.route('/sources/page:<int:page_num>')
-def browse_citations(page_num=1):
+@app.route('/sources', defaults={'page': 1})
+@app.route('/sources/page:<int:page>')
+def browse_citations(page=1):
     per_page = app.config.get('CITATIONS_DISPLAY_PER_PAGE', 10)
-    ordering = Citation.published
-    paginated = Citation.query.order_by(ordering).paginate(page_num, per_page)
-    return render_template('browse_citations.html', 
+    # Counts come from the citation_summary view, so a page is one indexed query rather than one per citation
+    query = db.session.query(Citation, citation_summary.c.aggregator_count)\
+                      .join(citation_summary, citation_summary.c.citation_fk == Citation.id)\
+                      .order_by(citation_summary.c.year, Citation.id)
+    paginated = query.paginate(page, per_page)
+    return render_template('citations/list.html',
                            request=request,
                            citations=paginated)
 
 
-@app.route('/reference/<int:cite_id>', defaults={'page_num': 1})
-@app.route('/reference/<int:cite_id>/page:<int:page_num>')
-def browse_citation_aggregators(cite_id, page_num=1):
+@app.route('/reference/<int:cite_id>', defaults={'page': 1})
+@app.route('/reference/<int:cite_id>/page:<int:page>')
+def browse_citation_aggregators(cite_id, page=1):
     citation = Citation.query.get_or_404(cite_id)
-    aggregators = get_molecules_for_view(citation.aggregators, page_num, config=app.config)
-    return render_template('browse_citation_aggregators.html',
+    aggregators, depictions = get_molecule_records_for_view(Aggregator, citation.aggregators, page,
+                                                            sorting=Aggregator.id,
+                                                            cache_key=('citation', cite_id),
+                                                            config=app.config)
+    return render_template('citations/aggregators.html',
                            request=request,
                            citation=citation,
-                           aggregators=aggregators)
+                           molecules=aggregators,
+                           depictions=depictions,
+                           page_query_args={'cite_id': cite_id})
+
 
+# Helper functions below
 
-# Helper functions belo
\ No newline at end of file
+
+def molecules_with_scaffold(model, page, template, endpoint):
+    """ Molecules sharing the Murcko (or with generic=1, generic) scaffold of the query, found by hash """
+    generic = request.args.get('generic') in ('1', 'true')
+    scaffold = get_query_scaffold(request.args, generic=generic)
+    if not scaffold:
+        abort(404)  # Acyclic molecules have no scaffold to share
+    query = model.query.filter(model.scaffold_filter(scaffold, generic=generic))
+    if request.args.get('format') == 'json':
+        limit = app.config.get('MOLECULE_SEARCH_MAX_RESULT_LIMIT', 1000)
+        return json.jsonify(scaffold=scaffold, generic=generic, molecules=[{
+            'id': molecule.id,
+            'name': molecule.name,
+            'smiles': molecule.smiles,
+            'url': url_for(endpoint, **{'agg_id' if model is Aggregator else 'lig_id': molecule.id}),
+        } for molecule in query.order_by(model.id).limit(limit)])
+    molecules, depictions = get_molecule_records_for_view(model, query, page,
+                                                          sorting=model.id,
+                                                          cache_key=('scaffold', scaffold, generic),
+                                                          config=app.config)
+    return render_template(template, molecules=molecules, depictions=depictions)
+
+
+def progressive_similar_json(model, endpoint):
+    """ Similarity search answered within `budget` seconds, partial with a `continuation` token if cut short
+
+    Resume by repeating the request with the same search arguments and `continue=<token>`.
+    """
+    params = get_similarity_parameters(this_request=request)
+    try:
+        budget = float(request.args.get('budget', app.config.get('PROGRESSIVE_SEARCH_BUDGET', 1.0)))
+    except ValueError:
+        abort(400)
+    if budget <= 0:
+        abort(400)
+    budget = min(budget, app.config.get('PROGRESSIVE_SEARCH_MAX_BUDGET', 10.0))
+    results = snapshot_similar_molecules(model, params)
+    if results is not None:
+        partial, continuation, scanned, total, elapsed = False, None, 1, 1, None
+    else:
+        try:
+            search = progressive_similar_molecules(model, params, budget, continuation=request.args.get('continue'))
+        except InvalidContinuation:
+            abort(400)
+        results, partial, continuation, scanned, total, elapsed = search
+    key = 'agg_id' if model is Aggregator else 'lig_id'
+    return json.jsonify(partial=partial, continuation=continuation, bands_scanned=scanned, bands_total=total,
+                        elapsed=elapsed, molecules=[{
+                            'id': molecule.id,
+                            'name': molecule.name,
+                            'smiles': molecule.smiles,
+                            'similarity': score,
+                            'url': url_for(endpoint, **{key: molecule.id}),
+                        } for molecule, score in results])
+
+
+def molecule_depictions(model):
+    try:
+        ids = [int(item) for item in request.args.get('ids', '').split(',') if item]
+    except ValueError:
+        abort(400)
+    max_ids = app.config.get('MOLECULES_DEPICTION_BATCH_LIMIT', 100)
+    if not ids or len(ids) > max_ids:
+        abort(400)
+    molecules = model.query.filter(model.id.in_(ids)).all()
+    layout = request.args.get('layout', 'inline')
+    return json.jsonify(depict_molecules(molecules, layout=layout))
@@ -0,0 +1,202 @@
+""" Warm-up after a restart or data reload, before traffic is let through
+
+Loads the molecule tables and their indexes (fingerprint GiST indexes first) into PostgreSQL's
+shared buffers, fills the per-process caches (snapshot, cluster fingerprints), and replays the
+most frequent recent requests and images from the traffic log (TRAFFIC_RECORD_PATH). With
+WARMUP_ON_START a serving process warms up in the background while it already accepts
+connections, and /ready answers 503 until it has finished, so load balancers hold traffic back
+meanwhile. A preloading server can instead warm its master before forking (warmup_before_fork).
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from sqlalchemy import text
+
+from .core import app, db
+from .models import FINGERPRINT_TYPES, Aggregator, Ligand
+
+
+log = logging.getLogger(__name__)
+
+IMAGE_ENDPOINTS = ('aggregator_image', 'ligand_image')
+
+_ready = []
+_warming = []
+
+
+def is_ready(config=None):
+    config = config or app.config
+    return bool(_ready) or not config.get('WARMUP_ON_START', False)
+
+
+def mark_ready():
+    if not _ready:
+        _ready.append(time.time())
+
+
+def _relation_order(name):
+    fp_suffixes = tuple(fp_type.index_suffix for fp_type in FINGERPRINT_TYPES.values())
+    if name.endswith(fp_suffixes):
+        return 0
+    if name.endswith('_idx'):
+        return 1
+    return 2
+
+
+def warm_relations(bind=None, models=(Aggregator, Ligand)):
+    """ [(relation, blocks)] read into shared buffers; without pg_prewarm only the tables can be read """
+    bind = bind or db.engine
+    loaded = []
+    with bind.connect() as connection:
+        try:
+            connection.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm")
+            prewarm = True
+        except Exception:
+            log.warning("pg_prewarm is not available; indexes are not prewarmed")
+            prewarm = False
+        relations = []
+        for model in models:
+            table = model.__tablename__
+            # Partition children (csdcompound_p<N>) are where partitioned rows and indexes live
+            pattern = table.replace('_', r'\_') + r'\_p%'
+            relations.extend(name for name, in connection.execute(text(
+                "SELECT indexname FROM pg_indexes WHERE tablename = :table OR tablename LIKE :pattern"),
+                table=table, pattern=pattern))
+            relations.extend(name for name, in connection.execute(text(
+                "SELECT relname FROM pg_class WHERE relkind = 'r' AND (relname = :table OR relname LIKE :pattern)"),
+                table=table, pattern=pattern))
+        for relation in sorted(set(relations), key=lambda name: (_relation_order(name), name)):
+            if prewarm:
+                blocks = connection.execute(text("SELECT pg_prewarm(CAST(:relation AS regclass))"),
+                                            relation=relation).scalar()
+            elif _relation_order(relation) == 2:
+                connection.execute('SELECT COUNT(*) FROM "{0}"'.format(relation))
+                blocks = connection.execute(text("SELECT pg_relation_size(CAST(:relation AS regclass)) / "
+                                                 "current_setting('block_size')::int"), relation=relation).scalar()
+            else:
+                continue
+            loaded.append((relation, int(blocks)))
+    return loaded
+
+
+def warm_caches():
+    """ Fill the per-process caches searches read from: the snapshot and clustered fingerprints """
+    from .clustering import get_cached_fingerprints
+    from .helpers import get_clustered_fp_types, get_snapshot
+
+    warmed = []
+    with app.app_context():
+        if get_snapshot(app.config) is not None:
+            warmed.append('snapshot')
+        for fp_type in sorted(get_clustered_fp_types()):
+            get_cached_fingerprints(Aggregator, fp_type)
+            warmed.append('{0} fingerprints'.format(fp_type))
+        db.session.remove()
+    return warmed
+
+
+def top_requests(path, queries=100, images=200):
+    """ Most frequent successful (query paths, image paths) recorded in a traffic log """
+    from .loadtest import endpoint_for
+
+    counts = Counter()
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry.get('status', 200) == 200:
+                counts[entry['path']] += 1
+    top_queries, top_images = [], []
+    for request_path, _hits in counts.most_common():
+        if endpoint_for(request_path) in IMAGE_ENDPOINTS:
+            if len(top_images) < images:
+                top_images.append(request_path)
+        elif len(top_queries) < queries:
+            top_queries.append(request_path)
+    return top_queries, top_images
+
+
+def replay(paths, url=None):
+    """ Request `paths` once each (through the application in process without `url`); {status: count}
+
+    In process replays are exempt from admission control, which would otherwise reject most of
+    them as a burst from a single client.
+    """
+    from .loadtest import in_process_client, remote_client
+
+    fetch = remote_client(url) if url else in_process_client(admission_control=False)
+    statuses = Counter()
+    for path in paths:
+        try:
+            statuses[fetch(path)] += 1
+        except Exception:
+            statuses[None] += 1
+    return dict(statuses)
+
+
+def warmup(traffic=None, url=None, relations=True, caches=True, requests=True, config=None):
+    """ Run every warm-up step, marking this process ready afterwards; OrderedDict of step: (result, seconds)
+
+    Caches only help the process that fills them, so a separate warm-up process (manage.py warmup)
+    skips them.
+    """
+    config = config or app.config
+    traffic = traffic or config.get('TRAFFIC_RECORD_PATH')
+    report = OrderedDict()
+
+    def step(name, function, *args, **kwargs):
+        started = time.time()
+        try:
+            report[name] = (function(*args, **kwargs), time.time() - started)
+        except Exception as e:
+            log.exception("Warm-up step %s failed", name)
+            report[name] = ('failed: {0}'.format(e), time.time() - started)
+
+    if relations:
+        step('relations', warm_relations, db.get_engine(app))
+    if caches and url is None:
+        step('caches', warm_caches)
+    if requests and traffic:
+        queries, images = top_requests(traffic, queries=config.get('WARMUP_TOP_QUERIES', 100),
+                                       images=config.get('WARMUP_TOP_IMAGES', 200))
+        step('queries', replay, queries, url=url)
+        step('images', replay, images, url=url)
+    mark_ready()
+    return report
+
+
+def _warm_in_background():
+    try:
+        warmup()
+    finally:
+        db.session.remove()
+        mark_ready()  # Serve cold rather than never
+
+
+def start_background_warmup():
+    """ Warm this process up on a daemon thread (a greenlet under gevent) while it serves; once per process """
+    if _ready or _warming:
+        return None
+    thread = threading.Thread(target=_warm_in_background, name='warmup')
+    thread.daemon = True
+    _warming.append(thread)
+    thread.start()
+    return thread
+
+
+def warmup_before_fork(*args):
+    """ Warm shared buffers and process caches in a preloading master (e.g. as gunicorn's when_ready hook)
+
+    Requests are not replayed: that would run the first-request hooks (change listener thread and
+    query plan guard) in the master instead of in each worker.
+    """
+    report = warmup(requests=False)
+    db.session.remove()
+    db.get_engine(app).dispose()  # Workers must open their own connections
+    return report
@@ -3,7 +3,32 @@
 
 from __future__ import print_function
 
+import os
 import sys
+
+# Commands that only touch the database do not need the views, admin pages or drawing code
+DATA_COMMANDS = (
+    'init_db',
+    'create_indexes',
+    'wipe_all_data',
+    'init_aggregator_data',
+    'load_ligands',
+    'partition_ligands',
+    'compute_depictions',
+    'cluster_aggregators',
+    'refresh_summaries',
+    'build_snapshot',
+    'check_query_plans',
+    'resolve_identifiers',
+    'compute_conformers',
+    'compute_scaffolds',
+    'train_scorer',
+    'screen',
+)
+if len(sys.argv) > 1 and sys.argv[1] in DATA_COMMANDS:
+    os.environ.setdefault('AGGREGATORCOMPAROR_SKIP_WEB', '1')
+
+from flask.ext.assets import ManageAssets
 from flask.ext.script import (
     Manager,
     Shell,
@@ -16,6 +41,7 @@ from aggregatorcomparor import (
     db,
     models,
 )
+from aggregatorcomparor.core import assets
 
 
 manager = Manager(app)
@@ -51,6 +77,16 @@ def init_db(*args, **kwargs):
     actions.init_db(*args, **kwargs)
 
 
+@manager.command
+def create_indexes():
+    actions.create_indexes()
+
+
+@manager.command
+def refresh_summaries():
+    actions.refresh_summaries()
+
+
 @manager.option('-y', '--yes-really', help="'yes' for I'm sure I want to clear the database")
 def wipe_all_data(*args, **kwargs):
     actions.wipe_all_data(*args, **kwargs)
@@ -58,17 +94,134 @@ def wipe_all_data(*args, **kwargs):
 
 @manager.option('-a', '--aggregators', help='Aggregators with source id (aggpage.txt)')
 @manager.option('-s', '--sources', help='Source publications with ids (aggref.txt)')
+@manager.option('-r', '--rejects', help='File to append rejected input lines and reasons to')
+@manager.option('--summary', help='File to append a JSON load summary to')
+@manager.option('-f', '--format', help="smiles or sdf (default: from the file extension)")
+@manager.option('--name-property', help="SDF property holding the aggregator name (default: title line)")
+@manager.option('--citation-property', default='citation', help="SDF property holding the citation id")
 def init_aggregator_data(*args, **kwargs):
     actions.init_aggregator_data(*args, **kwargs)
 
 
-@manager.option('smiles', help="SMILES file from CSD")
+@manager.option('smiles', help="SMILES or SDF file from CSD, optionally .gz, .bz2 or .xz compressed")
+@manager.option('-r', '--rejects', help='File to append rejected input lines and reasons to')
+@manager.option('--summary', help='File to append a JSON load summary to')
+@manager.option('-f', '--format', help="smiles or sdf (default: from the file extension)")
+@manager.option('--name-property', help="SDF property holding the ligand name (default: title line)")
 def load_ligands(*args, **kwargs):
     actions.load_ligands(*args, **kwargs)
 
 
+@manager.option('partitions', type=int, help="Number of ligand partitions (0 to merge back into one table)")
+def partition_ligands(*args, **kwargs):
+    actions.partition_ligands(*args, **kwargs)
+
+
+@manager.option('-o', '--overwrite', action='store_true', help="Recompute depictions that are already stored")
+def compute_depictions(*args, **kwargs):
+    actions.compute_depictions(*args, **kwargs)
+
+
+@manager.option('-m', '--method', default='butina', help="butina (sparse neighbour lists) or leader (single pass)")
+@manager.option('-c', '--cutoff', type=float, default=0.7, help="Tanimoto similarity joining a cluster")
+@manager.option('-f', '--fp-type', default='rdkit', help="Fingerprint type to cluster on")
+@manager.option('--block-size', type=int, default=500, help="Fingerprints compared per parallel block")
+@manager.option('-p', '--processes', type=int, help="Worker processes (default: one per CPU)")
+def cluster_aggregators(*args, **kwargs):
+    actions.cluster_aggregators(*args, **kwargs)
+
+
+@manager.option('-n', '--requests', type=int, default=1000, help="Requests to send")
+@manager.option('-c', '--concurrency', type=int, default=8, help="Concurrent clients")
+@manager.option('-u', '--url', help="Base URL of a running server (default: call the application in process)")
+@manager.option('-t', '--traffic', help="Replay this traffic file instead of synthesizing a mix")
+@manager.option('--save', help="Write the traffic that is sent to this file")
+@manager.option('--local-postgres', action='store_true',
+                help="Run against a throwaway PostgreSQL loaded with the bundled aggregator data")
+@manager.option('--ligands', help="SMILES file of ligands to load into the local PostgreSQL")
+@manager.option('--seed', type=int, help="Seed for synthesized traffic")
+@manager.option('--report', help="Write per-route results as JSON")
+@manager.option('--no-admission-control', dest='admission_control', action='store_false',
+                help="Let every in process request past admission control (each client has its own address anyway)")
+def loadtest(*args, **kwargs):
+    actions.loadtest(*args, **kwargs)
+
+
+@manager.option('path', help="SQLite file to write (fingerprints go to <path>.fp)")
+@manager.option('-l', '--ligands', action='store_true', help="Include ligands as well as aggregators")
+@manager.option('-f', '--fp-type', help="Fingerprint type to pack (default: MOLECULE_SEARCH_FINGERPRINT)")
+def build_snapshot(*args, **kwargs):
+    actions.build_snapshot(*args, **kwargs)
+
+
+@manager.option('--overwrite', action='store_true', help="Recompute scaffolds that are already stored")
+@manager.option('-p', '--processes', type=int, help="Worker processes (default: one per CPU)")
+def compute_scaffolds(*args, **kwargs):
+    actions.compute_scaffolds(*args, **kwargs)
+
+
+@manager.option('-l', '--ligands', action='store_true', help="Embed ligands as well (otherwise on demand only)")
+@manager.option('--overwrite', action='store_true', help="Recompute conformers that are already stored")
+@manager.option('-p', '--processes', type=int, help="Embedding processes (default: one per CPU)")
+def compute_conformers(*args, **kwargs):
+    actions.compute_conformers(*args, **kwargs)
+
+
+@manager.option('path', help="File to write the model to (point AGGREGATION_SCORER_PATH at it)")
+@manager.option('-b', '--background', type=int, default=50000, help="Random ligands sampled as the background")
+@manager.option('-f', '--fp-type', help="Fingerprint type to score (default: MOLECULE_SEARCH_FINGERPRINT)")
+@manager.option('--recall', type=float, default=0.99, help="Share of aggregators scored above the lower threshold")
+@manager.option('--specificity', type=float, default=0.99,
+                help="Share of background ligands scored below the upper threshold")
+@manager.option('-p', '--processes', type=int, help="Fingerprinting processes (default: one per CPU)")
+def train_scorer(*args, **kwargs):
+    actions.train_scorer(*args, **kwargs)
+
+
+@manager.option('path', help="SMILES or SDF file to screen, optionally compressed")
+@manager.option('-o', '--output', help="Write results here instead of stdout")
+@manager.option('-f', '--format', help="smiles or sdf (default: from the file extension)")
+def screen(*args, **kwargs):
+    actions.screen(*args, **kwargs)
+
+
+@manager.option('output', help="Directory to write static pages and manifest.json into")
+@manager.option('-p', '--processes', type=int, help="Rendering processes (default: one per CPU)")
+@manager.option('--force', action='store_true', help="Render every page, not only those whose data changed")
+def prerender(*args, **kwargs):
+    actions.prerender(*args, **kwargs)
+
+
+@manager.option('path', nargs='?', default='-', help="File with one identifier per line (default: stdin)")
+@manager.option('-o', '--output', help="Write results here instead of stdout")
+@manager.option('--json', dest='as_json', action='store_true', help="Write JSON instead of tab separated rows")
+def resolve_identifiers(*args, **kwargs):
+    actions.resolve_identifiers(*args, **kwargs)
+
+
+@manager.option('-t', '--traffic', help="Traffic log to take the most frequent requests from (default: TRAFFIC_RECORD_PATH)")
+@manager.option('-u', '--url', help="Warm a running server at this base URL instead of this process")
+@manager.option('--skip-relations', action='store_true', help="Do not prewarm tables and indexes")
+@manager.option('--ready-file', help="Write this file once warm-up has finished, for deploy scripts to wait on")
+def warmup(*args, **kwargs):
+    actions.warmup(*args, **kwargs)
+
+
+@manager.option('--no-analyze', dest='analyze', action='store_false',
+                help="Only plan the queries instead of running them under EXPLAIN ANALYZE")
+@manager.option('--json', dest='as_json', action='store_true', help="Print the plans as JSON")
+def check_query_plans(*args, **kwargs):
+    actions.check_query_plans(*args, **kwargs)
+
+
+@manager.option('-b', '--budget', type=float, help="Seconds allowed for importing the application")
+def profile_startup(*args, **kwargs):
+    actions.profile_startup(*args, **kwargs)
+
+
 manager.add_command('server', Server(port=app.config.get('PORT', 8090), host='0.0.0.0'))
 manager.add_command('shell', Shell(make_context=_make_context))
+manager.add_command('assets', ManageAssets(assets))  # `assets build` prebuilds bundles into static/public
 
 if __name__ == '__main__':
     manager.run()
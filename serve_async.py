@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Serve the application with gevent (see aggregatorcomparor.cooperative) """
+
+from __future__ import print_function
+
+# Patching has to happen before the application (and psycopg2) is imported
+from gevent import monkey
+monkey.patch_all()
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import sys
+from aggregatorcomparor import app
+from aggregatorcomparor.cooperative import serve
+from aggregatorcomparor.warmup import start_background_warmup
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    if app.config.get('WARMUP_ON_START', False):
+        print("Warming up in the background; /ready answers 503 until done", file=sys.stderr)
+        start_background_warmup()  # A greenlet once gevent has patched threading; runs when serving starts
+    print("Serving cooperatively on port {0}".format(port or app.config.get('PORT', 8080)), file=sys.stderr)
+    serve(app, port=port)
@@ -0,0 +1,26 @@
+import pytest
+
+from aggregatorcomparor import app as application
+
+
+@pytest.fixture
+def app():
+    config = dict(application.config)
+    application.config.update(
+        TESTING=True,
+        QUERY_PLAN_GUARD=None,
+        SCHEMA_UPGRADE_ON_START=False,
+        MOLECULE_CHANGE_LISTENER=False,
+        SEARCH_ADMISSION_CONTROL=False,
+        SNAPSHOT_PATH=None,
+    )
+    try:
+        yield application
+    finally:
+        application.config.clear()
+        application.config.update(config)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,11 @@
+from aggregatorcomparor.actions import _index_body
+
+
+def test_index_body_ignores_index_and_table_names():
+    parent = _index_body('CREATE INDEX csdcompound_refcode_serial_idx ON public.csdcompound '
+                         'USING btree (refcode, serial)')
+    child = _index_body('CREATE INDEX csdcompound_p0_refcode_serial_idx ON public.csdcompound_p0 '
+                        'USING btree (refcode, serial)')
+    assert parent == child == ('CREATE INDEX', 'USING btree (refcode, serial)')
+    assert _index_body('CREATE UNIQUE INDEX csdcompound_pkey ON csdcompound USING btree (id)')[0] == \
+        'CREATE UNIQUE INDEX'
@@ -0,0 +1,57 @@
+from aggregatorcomparor import clustering
+from aggregatorcomparor.changes import DeltaLog, change_payloads
+
+
+def test_delta_log_reports_changes_since_a_generation():
+    log = DeltaLog(segment_size=2)
+    first = log.apply({'table': 'aggregator', 'upserted': [1, 2, 3]})
+    log.apply({'table': 'aggregator', 'deleted': [2]})
+    log.apply({'table': 'csdcompound', 'upserted': [7]})
+    assert log.since(0, table='aggregator') == ({1, 3}, {2})
+    assert log.since(first, table='aggregator') == (set(), {2})
+    assert log.since(first) == ({7}, {2})
+
+
+def test_delta_log_compaction_forces_a_rebuild_for_consumers_behind_it():
+    log = DeltaLog(segment_size=1)
+    log.apply({'table': 'aggregator', 'upserted': [1, 2]})
+    log.compact(1)
+    assert log.since(0) is None
+    assert log.since(1) == ({2}, set())
+
+
+def test_change_payloads_are_chunked():
+    payloads = list(change_payloads({'aggregator': {'upserted': set(range(1200))}}))
+    assert len(payloads) == 3
+
+
+def test_fingerprint_cache_is_patched_from_the_delta_log(monkeypatch):
+    log = DeltaLog()
+    fetched = []
+
+    def fetch(model, fp_type='rdkit', session=None, ids=None):
+        fetched.append(ids)
+        rows = [1, 2, 3] if ids is None else sorted(ids)
+        return rows, ['fp{0}'.format(molecule_id) for molecule_id in rows]
+
+    class Model(object):
+        __tablename__ = 'aggregator'
+
+    monkeypatch.setattr(clustering, 'delta_log', log)
+    monkeypatch.setattr(clustering, 'fetch_fingerprints', fetch)
+    monkeypatch.setattr(clustering, '_fingerprint_cache', {})
+    assert clustering.get_cached_fingerprints(Model) == ([1, 2, 3], ['fp1', 'fp2', 'fp3'])
+    log.apply({'table': 'aggregator', 'deleted': [2]})
+    log.apply({'table': 'aggregator', 'upserted': [4]})
+    assert clustering.get_cached_fingerprints(Model) == ([1, 3, 4], ['fp1', 'fp3', 'fp4'])
+    assert fetched == [None, {4}]
+
+
+def test_rebuilt_clusters_invalidate_the_clustered_fingerprint_types(monkeypatch):
+    from aggregatorcomparor import helpers
+
+    monkeypatch.setattr(helpers, '_clustered_fp_types', [{'rdkit'}])
+    helpers.invalidate_clustered_fp_types({'table': 'aggregator', 'upserted': [1]})
+    assert helpers._clustered_fp_types == [{'rdkit'}]
+    helpers.invalidate_clustered_fp_types({'table': 'aggregator_cluster'})
+    assert helpers._clustered_fp_types == []
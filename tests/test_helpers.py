@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from aggregatorcomparor import helpers
+
+
+class FakeMolecule(object):
+    mol = 'stored mol'
+
+
+class FakeQuery(object):
+    def __init__(self, looked_up):
+        self.looked_up = looked_up
+
+    def get_or_404(self, molecule_id):
+        self.looked_up.append((molecule_id, threading.current_thread()))
+        return FakeMolecule()
+
+
+def test_id_queries_are_looked_up_on_the_request_thread(monkeypatch):
+    looked_up, offloaded = [], []
+
+    class FakeModel(object):
+        query = FakeQuery(looked_up)
+
+    def offload(function, *args, **kwargs):
+        offloaded.append(function)
+        return function(*args, **kwargs)
+
+    monkeypatch.setattr(helpers, 'offload', offload)
+    monkeypatch.setitem(helpers.MOLECULE_ID_INPUT_FORMATS, 'aggregator', FakeModel)
+    mol, query, error = helpers.extract_query_mol({'aggregator': 7})
+    assert (mol, query, error) == ('stored mol', 7, None)
+    assert looked_up == [('7', threading.current_thread())]
+    assert offloaded == [getattr]
+
+
+def test_unparseable_smiles_is_reported():
+    mol, query, error = helpers.extract_query_mol({'smiles': 'C1CC'})
+    assert mol is None and query == 'C1CC' and error.startswith("Invalid query term")
+
+
+def test_missing_query_is_a_bad_request(app):
+    with pytest.raises(BadRequest):
+        helpers.extract_query_mol({})
+
+
+def test_reported_inchikeys_are_read_once_until_aggregators_change(monkeypatch):
+    reads = []
+
+    class FakeSession(object):
+        def query(self, column):
+            reads.append(column)
+            return self
+
+        def filter(self, criterion):
+            return [('BSYNRYMUTXBXSQ-UHFFFAOYSA-N',)]
+
+    monkeypatch.setattr(helpers, '_aggregator_inchikeys', [])
+    monkeypatch.setattr(helpers, 'get_snapshot', lambda: None)
+    monkeypatch.setattr(helpers.db, 'session', FakeSession())
+    assert helpers.is_reported_aggregator('BSYNRYMUTXBXSQ-UHFFFAOYSA-N')
+    assert not helpers.is_reported_aggregator('XXXXXXXXXXXXXX-UHFFFAOYSA-N')
+    assert len(reads) == 1
+
+    helpers.invalidate_aggregator_inchikeys({'table': 'ligand', 'upserted': [1], 'deleted': []})
+    helpers.is_reported_aggregator('BSYNRYMUTXBXSQ-UHFFFAOYSA-N')
+    assert len(reads) == 1
+    helpers.invalidate_aggregator_inchikeys({'table': 'aggregator', 'upserted': [1], 'deleted': []})
+    helpers.is_reported_aggregator('BSYNRYMUTXBXSQ-UHFFFAOYSA-N')
+    assert len(reads) == 2
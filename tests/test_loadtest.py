@@ -0,0 +1,26 @@
+from aggregatorcomparor import loadtest
+
+
+class FakeCounter(object):
+    count = 0
+
+    def __init__(self, engine):
+        pass
+
+    def reset(self):
+        pass
+
+
+def test_in_process_clients_have_their_own_addresses(monkeypatch):
+    clients = []
+
+    def client(admission_control=True, remote_addr=None):
+        clients.append((admission_control, remote_addr))
+        return lambda path: 200
+
+    monkeypatch.setattr(loadtest, 'QueryCounter', FakeCounter)
+    monkeypatch.setattr(loadtest.db, 'get_engine', lambda app: None)
+    monkeypatch.setattr(loadtest, 'in_process_client', client)
+    report = loadtest.replay_traffic(['/sources'] * 6, concurrency=3, admission_control=False)
+    assert sorted(clients) == [(False, '127.0.0.1'), (False, '127.0.0.2'), (False, '127.0.0.3')]
+    assert report['all']['requests'] == 6
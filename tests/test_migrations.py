@@ -0,0 +1,17 @@
+from aggregatorcomparor import migrations
+from aggregatorcomparor.models import Conformer
+
+
+class FakeBind(object):
+    def __init__(self, tables):
+        self.tables = set(tables)
+
+    def has_table(self, name):
+        return name in self.tables
+
+
+def test_only_missing_tables_are_created(monkeypatch):
+    bind = FakeBind(['aggregator_cluster', 'aggregator_cluster_member', 'search_continuation'])
+    monkeypatch.setattr(Conformer.__table__, 'create', lambda bind: bind.tables.add('conformer'))
+    assert migrations.create_missing_tables(bind) == ['conformer']
+    assert migrations.create_missing_tables(bind) == []
@@ -0,0 +1,201 @@
+from collections import namedtuple
+
+import pytest
+
+from aggregatorcomparor import progressive, views
+from aggregatorcomparor.models import dice_similarity_bound, tanimoto_similarity_bound
+from aggregatorcomparor.progressive import START, Band, InvalidContinuation, ScanPosition
+
+
+Molecule = namedtuple('Molecule', 'id name smiles')
+
+
+class FakeColumn(object):
+    def in_(self, ids):
+        return list(ids)
+
+
+class FakeQuery(object):
+    def __init__(self, molecules):
+        self.molecules = molecules
+
+    def filter(self, ids):
+        return [molecule for molecule in self.molecules if molecule.id in ids]
+
+
+class FakeModel(object):
+    __tablename__ = 'fake'
+    id = FakeColumn()
+    query = FakeQuery([Molecule(molecule_id, 'M{0}'.format(molecule_id), 'C') for molecule_id in range(1, 10)])
+
+
+class FakeSession(object):
+    def rollback(self):
+        pass
+
+    def query(self, *columns):
+        return FakeIdRange()
+
+
+class FakeIdRange(object):
+    def one(self):
+        return 1, 8
+
+
+class FakeDb(object):
+    session = FakeSession()
+
+
+@pytest.fixture(autouse=True)
+def stored_states(monkeypatch):
+    """ Keeps continuation states in a dict instead of the search_continuation table """
+    states = {}
+
+    def store(key, digest, state, config):
+        states[key] = (digest, progressive.json.loads(progressive.json.dumps(state)))
+
+    def fetch(key, digest, config):
+        stored_digest, state = states.get(key, (None, None))
+        return state if stored_digest == digest else None
+
+    monkeypatch.setattr(progressive, '_store_state', store)
+    monkeypatch.setattr(progressive, '_fetch_state', fetch)
+    return states
+
+
+@pytest.fixture
+def scan(app, monkeypatch):
+    """ Replaces the database side of a progressive search with fixed bands and per band hits """
+    bands = [Band([10, 11], 1.0), Band([9, 12], 0.9), Band([8], 0.8)]
+    hits = {0: [(0.95, 1), (0.92, 2)], 1: [(0.89, 3)], 2: [(0.8, 4)]}
+    scanned = []
+
+    def scan_band(result_type, params, popcounts, ids, limit, timeout):
+        index = [band.popcounts for band in bands].index(popcounts)
+        scanned.append(index)
+        return hits[index]
+
+    monkeypatch.setattr(progressive, 'db', FakeDb())
+    monkeypatch.setattr(progressive, 'search_bands', lambda result_type, params, config=None: bands)
+    monkeypatch.setattr(progressive, '_scan_band', scan_band)
+    return hits, scanned
+
+
+def test_similarity_bounds_are_fractions():
+    assert tanimoto_similarity_bound(10, 10) == 1.0
+    assert tanimoto_similarity_bound(10, 8) == pytest.approx(0.8)
+    assert tanimoto_similarity_bound(8, 10) == pytest.approx(0.8)
+    assert dice_similarity_bound(10, 8) == pytest.approx(16 / 18.0)
+    assert tanimoto_similarity_bound(0, 0) == 1.0
+
+
+def test_popcount_bands_are_ordered_by_best_possible_score():
+    bands = progressive.popcount_bands(10, 8, 12, 2, tanimoto_similarity_bound)
+    assert [band.popcounts for band in bands] == [[10, 11], [9, 12], [8]]
+    assert [band.bound for band in bands] == pytest.approx([1.0, 0.9, 0.8])
+    assert sorted(sum((band.popcounts for band in bands), [])) == list(range(8, 13))
+
+
+def test_scan_stops_early_once_top_k_cannot_be_beaten(scan):
+    _hits, scanned = scan
+    result = progressive.progressive_similar_molecules(FakeModel, {'limit': 2}, budget=10)
+    assert scanned == [0]
+    assert not result.partial and result.continuation is None
+    assert [(molecule.id, score) for molecule, score in result.results] == [(1, 0.95), (2, 0.92)]
+
+
+def test_scan_continues_while_a_later_band_could_do_better(scan):
+    hits, scanned = scan
+    hits[0] = [(0.95, 1), (0.85, 2)]
+    result = progressive.progressive_similar_molecules(FakeModel, {'limit': 2}, budget=10)
+    assert scanned == [0, 1]
+    assert not result.partial
+    assert [molecule.id for molecule, _score in result.results] == [1, 3]
+
+
+def test_exhausted_budget_returns_partial_results_that_resume(scan):
+    _hits, scanned = scan
+    params = {'limit': 3, 'raw': '5', 'input_format': 'aggregator'}
+    first = progressive.progressive_similar_molecules(FakeModel, params, budget=0)
+    assert first.partial and first.continuation and first.bands_scanned == 0
+    resumed = progressive.progressive_similar_molecules(FakeModel, params, budget=10,
+                                                        continuation=first.continuation)
+    assert scanned == [0, 1]  # The last band cannot beat the third best
+    assert not resumed.partial
+    assert [molecule.id for molecule, _score in resumed.results] == [1, 2, 3]
+
+
+def test_continuation_is_bound_to_its_search(app):
+    params = {'limit': 3, 'raw': '5', 'input_format': 'aggregator'}
+    digest = progressive.search_digest(FakeModel, params)
+    token = progressive.dump_continuation(digest, START._replace(band=1), [[0.9, 1]])
+    assert progressive.load_continuation(token, digest) == (START._replace(band=1), [(0.9, 1)])
+    other = progressive.search_digest(FakeModel, dict(params, input_format='ligand'))
+    with pytest.raises(InvalidContinuation):
+        progressive.load_continuation(token, other)
+    with pytest.raises(InvalidContinuation):
+        progressive.load_continuation(token[:-2] + 'xx', digest)
+
+
+def test_continuation_tokens_stay_short_and_expire(app, stored_states):
+    digest = progressive.search_digest(FakeModel, {'limit': 1000, 'raw': 'CCO', 'input_format': 'smiles'})
+    top = [[0.5 + molecule_id / 1e5, molecule_id] for molecule_id in range(1000)]
+    token = progressive.dump_continuation(digest, START, top)
+    assert len(token) < 200
+    assert progressive.load_continuation(token, digest)[1][:1] == [(0.5, 0)]
+    stored_states.clear()
+    with pytest.raises(InvalidContinuation):
+        progressive.load_continuation(token, digest)
+
+
+class Canceled(progressive.DBAPIError):
+    def __init__(self):
+        progressive.DBAPIError.__init__(self, 'SELECT', {}, type('Orig', (Exception,), {'pgcode': '57014'})())
+
+
+def test_chunks_cut_off_by_the_budget_are_halved_then_split_by_id(app, monkeypatch):
+    bands = [Band([10, 11, 9, 12], 1.0)]
+    slow = {(10, 11, 9, 12), (10, 11), (10,)}
+    scanned = []
+
+    def scan_band(result_type, params, popcounts, ids, limit, timeout):
+        scanned.append((tuple(popcounts), ids and tuple(ids)))
+        if tuple(popcounts) in slow and (ids is None or ids[1] > 2):
+            raise Canceled()
+        return []
+
+    monkeypatch.setattr(progressive, 'db', FakeDb())
+    monkeypatch.setattr(progressive, 'search_bands', lambda result_type, params, config=None: bands)
+    monkeypatch.setattr(progressive, '_scan_band', scan_band)
+    params = {'limit': 3, 'raw': '5', 'input_format': 'aggregator'}
+    positions, continuation = [], None
+    for _ in range(20):
+        result = progressive.progressive_similar_molecules(FakeModel, params, budget=10, continuation=continuation)
+        if not result.partial:
+            break
+        continuation = result.continuation
+        positions.append(progressive.load_continuation(continuation, progressive.search_digest(FakeModel, params))[0])
+    assert not result.partial
+    assert len(set(positions)) == len(positions)  # Every continuation moved on
+    assert positions[:3] == [ScanPosition(0, 0, 2, None), ScanPosition(0, 0, 1, None),
+                             ScanPosition(0, 0, 1, [1, 4, 8])]
+    assert ((10,), (1, 2, 8)) in scanned and ((10,), (3, 4, 8)) in scanned and ((11,), None) in scanned
+    assert ((9,), None) in scanned and ((12,), None) in scanned
+
+
+@pytest.mark.parametrize('path', ['/aggregators/similar.json', '/ligands/similar.json'])
+def test_similar_json_endpoints(client, monkeypatch, path):
+    searched = []
+
+    def search(model, params, budget, continuation=None):
+        searched.append((model, budget, continuation))
+        return progressive.ProgressiveResult([(Molecule(7, 'M7', 'CCO'), 0.75)], True, 'token', 1, 3, 0.5)
+
+    monkeypatch.setattr(views, 'snapshot_similar_molecules', lambda model, params: None)
+    monkeypatch.setattr(views, 'progressive_similar_molecules', search)
+    response = client.get(path + '?smiles=CCO&budget=0.5&continue=previous')
+    assert response.status_code == 200
+    data = views.json.loads(response.get_data(as_text=True))
+    assert data['partial'] is True and data['continuation'] == 'token'
+    assert data['molecules'][0]['id'] == 7 and data['molecules'][0]['similarity'] == 0.75
+    assert searched[0][1:] == (0.5, 'previous')
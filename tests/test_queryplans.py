@@ -0,0 +1,16 @@
+from aggregatorcomparor.queryplans import index_names
+
+
+def bitmap_plan(*names):
+    return {'Plan': {'Node Type': 'BitmapOr', 'Plans': [
+        {'Node Type': 'Bitmap Index Scan', 'Index Name': name} for name in names]}}
+
+
+def test_bitmap_scans_count_only_indexes_of_the_table():
+    plan = bitmap_plan('aggregator_structure_idx', 'aggregator_cluster_member_cluster_fk_idx', 'aggregator_pkey')
+    assert index_names(plan, 'aggregator') == ['aggregator_pkey', 'aggregator_structure_idx']
+
+
+def test_bitmap_scans_on_partitions_count_for_the_parent():
+    plan = bitmap_plan('csdcompound_p3_structure_idx', 'csdcompound_p3_unknown_idx')
+    assert index_names(plan, 'csdcompound') == ['csdcompound_p3_structure_idx']
@@ -0,0 +1,27 @@
+import pytest
+
+from aggregatorcomparor.models import Ligand
+from aggregatorcomparor.resolver import _batches, identifier_kind
+
+
+@pytest.mark.parametrize('identifier, kind', [
+    ('BSYNRYMUTXBXSQ-UHFFFAOYSA-N', 'inchikey'),
+    ('ABACAA', 'refcode'),
+    ('ABACAA01', 'refcode'),
+    ('ABACAA.2', 'refcode'),
+    ('ABACAA01.2', 'refcode'),
+    ('abacaa', 'name'),
+    ('BSYNRYMUTXBXSQ-UHFFFAOYSA', 'name'),
+    ('Congo red', 'name'),
+])
+def test_identifier_kind(identifier, kind):
+    assert identifier_kind(identifier) == kind
+
+
+def test_refcodes_parse_into_name_columns():
+    assert Ligand.parse_name('ABACAA01.2') == ('ABACAA01', 2)
+    assert Ligand.parse_name('ABACAA') == ('ABACAA', None)
+
+
+def test_batches_are_sorted_and_bounded():
+    assert list(_batches({5, 1, 4, 2, 3}, 2)) == [[1, 2], [3, 4], [5]]
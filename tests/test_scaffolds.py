@@ -0,0 +1,28 @@
+from rdkit import Chem as C
+
+from aggregatorcomparor.helpers import get_query_scaffold
+from aggregatorcomparor.models import compute_scaffolds, scaffold_columns, scaffold_hash
+
+
+def test_scaffold_hash_is_stable_and_fits_bigint():
+    assert scaffold_hash('c1ccccc1') == -8914870851703560528
+    assert scaffold_hash(u'c1ccccc1') == scaffold_hash('c1ccccc1')
+    for scaffold in ('c1ccccc1', 'C1CCCCC1', 'c1ccc2[nH]ccc2c1'):
+        assert -2 ** 63 <= scaffold_hash(scaffold) < 2 ** 63
+
+
+def test_acyclic_molecules_have_an_empty_scaffold_without_a_hash():
+    assert compute_scaffolds(C.MolFromSmiles('CCCCO')) == ('', '')
+    columns = scaffold_columns(C.MolFromSmiles('CCCCO'))
+    assert columns['scaffold_hash'] is None and columns['generic_scaffold_hash'] is None
+    assert compute_scaffolds(None) == (None, None)
+
+
+def test_scaffold_argument_matches_the_stored_scaffold():
+    # Tryptamine: an indole ring system with an aromatic [nH]
+    scaffold, generic = compute_scaffolds(C.MolFromSmiles('NCCc1c[nH]c2ccccc12'))
+    assert '[nH]' in scaffold
+    assert get_query_scaffold({'scaffold': scaffold}) == scaffold
+    assert get_query_scaffold({'scaffold': generic}, generic=True) == generic
+    assert scaffold_hash(get_query_scaffold({'scaffold': scaffold})) == scaffold_columns(
+        C.MolFromSmiles('NCCc1c[nH]c2ccccc12'))['scaffold_hash']
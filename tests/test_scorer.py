@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from aggregatorcomparor import scorer
+from aggregatorcomparor.scorer import TRIAGE_BORDERLINE, TRIAGE_NEGATIVE, TRIAGE_POSITIVE, fit_scorer
+
+
+def training_matrices():
+    positives = np.array([[1, 1, 0, 0]] * 8 + [[1, 0, 0, 0]] * 2, dtype=np.uint8)
+    negatives = np.array([[0, 0, 1, 1]] * 8 + [[0, 0, 0, 1]] * 2, dtype=np.uint8)
+    return positives, negatives
+
+
+def test_fit_scorer_separates_the_training_sets():
+    positives, negatives = training_matrices()
+    model = fit_scorer(positives, negatives, 'rdkit', recall=1.0, specificity=1.0)
+    assert model.weights[0] > 0 > model.weights[3]
+    assert model.low <= model.high
+    assert min(model.score_matrix(positives)) >= model.low
+    assert max(model.score_matrix(negatives)) <= model.high
+    assert model.triage(model.high) == TRIAGE_POSITIVE
+    assert model.triage(model.low - 1) == TRIAGE_NEGATIVE
+
+
+def test_triage_between_thresholds_is_borderline():
+    model = scorer.AggregationScorer([0.0], 0, 'rdkit', -1, 1)
+    assert model.triage(0) == TRIAGE_BORDERLINE
+    assert model.probability(0) == pytest.approx(0.5)
+
+
+def test_get_scorer_retries_a_failed_load_and_picks_up_retraining(tmpdir, monkeypatch):
+    monkeypatch.setattr(scorer, '_scorer', [])
+    path = str(tmpdir.join('scorer.npz'))
+    config = {'AGGREGATION_SCORER_PATH': path}
+    assert scorer.get_scorer(config) is None  # Not trained yet
+
+    positives, negatives = training_matrices()
+    fit_scorer(positives, negatives, 'rdkit').save(path)
+    first = scorer.get_scorer(config)
+    assert first is not None and scorer.get_scorer(config) is first
+
+    retrained = scorer.AggregationScorer(first.weights, first.bias + 1, 'rdkit', first.low, first.high)
+    retrained.save(path)
+    tmpdir.join('scorer.npz').setmtime(tmpdir.join('scorer.npz').mtime() + 10)
+    assert scorer.get_scorer(config).bias == pytest.approx(first.bias + 1)
@@ -0,0 +1,67 @@
+from aggregatorcomparor import snapshot
+from aggregatorcomparor.snapshot import Snapshot, SnapshotMolecule
+
+
+def make_snapshot(monkeypatch, scores):
+    requested = []
+
+    def molecules(table, ids, descriptors=None):
+        requested.append(list(ids))
+        return dict((molecule_id, SnapshotMolecule(molecule_id, 'M{0}'.format(molecule_id), 'C', None,
+                                                   molecule_id, None, None, None))
+                    for molecule_id in ids if descriptors is None or molecule_id % 2)
+
+    snap = Snapshot.__new__(Snapshot)
+    snap.fp_type = 'rdkit'
+    snap._fingerprints = {'aggregator': [None] * len(scores)}
+    snap._ids = {'aggregator': list(range(1, len(scores) + 1))}
+    snap.molecules = molecules
+    monkeypatch.setitem(snapshot.SNAPSHOT_FINGERPRINTS, 'rdkit', lambda mol: None)
+    monkeypatch.setitem(snapshot.SNAPSHOT_METRICS, 'tanimoto', lambda query, fingerprints: scores)
+    return snap, requested
+
+
+def test_similar_reads_only_the_rows_within_the_limit(monkeypatch):
+    snap, requested = make_snapshot(monkeypatch, [0.6, 0.9, 0.4, 0.8, 0.7])
+    results = snap.similar('aggregator', mol=None, cutoff=0.5, limit=2)
+    assert [(molecule.id, score) for molecule, score in results] == [(2, 0.9), (4, 0.8)]
+    assert requested == [[2, 4]]
+
+
+def test_similar_with_descriptor_filters_reads_every_hit(monkeypatch):
+    snap, requested = make_snapshot(monkeypatch, [0.6, 0.9, 0.4, 0.8, 0.7])
+    results = snap.similar('aggregator', mol=None, cutoff=0.5, limit=2, descriptors={'logp': (None, None)})
+    assert [molecule.id for molecule, _score in results] == [5, 1]
+    assert requested == [[2, 4, 5, 1]]
+
+
+def test_has_inchikey_reads_the_snapshot(tmpdir):
+    import sqlite3
+    import threading
+
+    path = str(tmpdir.join('snapshot.db'))
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE aggregator (id INTEGER PRIMARY KEY, inchikey TEXT)")
+    connection.execute("INSERT INTO aggregator VALUES (1, 'BSYNRYMUTXBXSQ-UHFFFAOYSA-N')")
+    connection.commit()
+    connection.close()
+    snap = Snapshot.__new__(Snapshot)
+    snap.path = path
+    snap._local = threading.local()
+    assert snap.has_inchikey('aggregator', 'BSYNRYMUTXBXSQ-UHFFFAOYSA-N')
+    assert not snap.has_inchikey('aggregator', 'XXXXXXXXXXXXXX-UHFFFAOYSA-N')
+
+
+def test_first_request_hooks_leave_postgres_alone_in_snapshot_mode(app, monkeypatch):
+    from aggregatorcomparor import views
+
+    def unreachable(*args, **kwargs):
+        raise AssertionError("PostgreSQL touched")
+
+    monkeypatch.setattr(views, 'upgrade_schema', unreachable)
+    monkeypatch.setattr(views, 'start_change_listener', unreachable)
+    monkeypatch.setattr(views, 'guard_query_plans', unreachable)
+    app.config.update(SNAPSHOT_PATH='snapshot.db', SCHEMA_UPGRADE_ON_START=True, QUERY_PLAN_GUARD='fail')
+    views.upgrade_database_schema()
+    views.start_listening_for_changes()
+    views.check_query_plans()
@@ -0,0 +1,39 @@
+import threading
+
+from aggregatorcomparor import summaries
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.info = {'summaries_stale': True}
+
+
+def test_commits_in_a_burst_get_one_background_refresh(app, monkeypatch):
+    refreshed = threading.Event()
+    calls = []
+
+    def refresh():
+        calls.append(threading.current_thread())
+        refreshed.set()
+
+    monkeypatch.setattr(summaries, 'refresh_summary_views', refresh)
+    monkeypatch.setattr(summaries, '_refresh_timer', [])
+    app.config['SUMMARY_REFRESH_DELAY'] = 0.2
+    for _ in range(3):
+        summaries.refresh_stale_summaries(FakeSession())
+    assert not calls  # The committing thread does not wait
+    assert refreshed.wait(5)
+    summaries._refresh_before_exit()
+    assert len(calls) == 1 and calls[0] is not threading.current_thread()
+
+
+def test_refresh_once_refreshes_at_the_end_of_the_block(monkeypatch):
+    calls = []
+    monkeypatch.setattr(summaries, 'refresh_summary_views', lambda: calls.append(True))
+    monkeypatch.setattr(summaries, 'schedule_refresh', lambda: calls.append('scheduled'))
+    with summaries.refresh_once():
+        with summaries.refresh_once():
+            summaries.refresh_stale_summaries(FakeSession())
+            summaries.refresh_stale_summaries(FakeSession())
+        assert not calls
+    assert calls == [True]
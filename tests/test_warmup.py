@@ -0,0 +1,24 @@
+import threading
+
+from aggregatorcomparor import warmup
+
+
+def test_ready_waits_for_the_background_warmup(app, client, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(warmup, '_ready', [])
+    monkeypatch.setattr(warmup, '_warming', [])
+    monkeypatch.setattr(warmup, 'warmup', lambda: release.wait(5))
+    app.config['WARMUP_ON_START'] = True
+
+    warmup.start_background_warmup()
+    assert client.get('/ready').status_code == 503  # Serving while warming up
+    assert warmup.start_background_warmup() is None  # Once per process
+    release.set()
+    warmup._warming[0].join(5)
+    assert client.get('/ready').status_code == 200
+
+
+def test_ready_without_warmup(app, client, monkeypatch):
+    monkeypatch.setattr(warmup, '_ready', [])
+    app.config['WARMUP_ON_START'] = False
+    assert client.get('/ready').status_code == 200